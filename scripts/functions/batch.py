@@ -0,0 +1,241 @@
+"""
+Parallel execution of the sessions of a batch
+"""
+
+import time
+import traceback
+import multiprocessing
+import pandas as pd
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+    FIRST_COMPLETED,
+)
+
+from functions.utils import _get_params, _use_params, _flush_params
+
+
+def run_sessions(
+    session_function,
+    sessions: list,
+    max_workers: int = 1,
+    memory_estimates: list = None,
+    memory_budget_gb: float = None,
+):
+    """
+    Runs session_function on each session of the batch, in a pool of worker
+    processes. Each session is run independently: an error in one session
+    is reported in the results and does not stop the others.
+
+    The workers are started with the "spawn" method, so they do not inherit
+    the state of the main process (matplotlib backend, open files, parameters
+    of a previous session...).
+
+    With a memory budget, the sessions are started from the largest to the
+    smallest estimated memory, and a session only starts when its estimate
+    fits in the budget left by the sessions running. A session larger than
+    the whole budget is run alone.
+
+    Inputs:
+        - session_function: function called as session_function(**session)
+        for each session. It has to be defined at the top level of a module,
+        to be sent to the workers. Its return value is the status of the
+        session (e.g. "done" or "review").
+        - sessions: list of dict, keyword arguments of each session, with at
+        least the key "session_ID"
+        - max_workers: int, number of worker processes. With 1 (default), the
+        sessions are run one after the other in the current process, so the
+        user can still interact with the figures and questions.
+        - memory_estimates: list, estimated peak memory of each session
+        (bytes, see probe.estimate_session_memory), None when unknown
+        - memory_budget_gb: float or None, largest total memory of the
+        sessions running at the same time (GB). None (default) only limits
+        the number of sessions to max_workers.
+
+    Returns:
+        - results: pd.DataFrame, one row per session, in the order of
+        sessions, with the columns session_ID, status ("error" if the session
+        failed), error (traceback of the error, None otherwise) and
+        duration_s
+    """
+
+    if max_workers == 1:
+        rows = [_run_session(session_function, session) for session in sessions]
+        return pd.DataFrame(rows, columns=["session_ID", "status", "error", "duration_s"])
+
+    if memory_estimates is None:
+        memory_estimates = [None] * len(sessions)
+    # sessions whose memory is unknown are counted as empty
+    memory = [estimate or 0 for estimate in memory_estimates]
+    budget = None if memory_budget_gb is None else memory_budget_gb * 1e9
+    # largest sessions first (sorted is stable: same order for equal sizes)
+    pending = sorted(range(len(sessions)), key=lambda i: -memory[i])
+
+    rows = [None] * len(sessions)
+    running = {}
+    with ProcessPoolExecutor(
+        max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        while pending or running:
+            # start the largest pending sessions that fit in the budget left
+            used = sum(memory[i] for i in running.values())
+            for i in list(pending):
+                if len(running) >= max_workers:
+                    break
+                if budget is not None and running and used + memory[i] > budget:
+                    continue
+                pending.remove(i)
+                future = executor.submit(_run_session, session_function, sessions[i])
+                running[future] = i
+                used += memory[i]
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                try:
+                    rows[i] = future.result()
+                except Exception:
+                    # the worker itself failed (e.g. killed when out of memory)
+                    rows[i] = {
+                        "session_ID": sessions[i]["session_ID"],
+                        "status": "error",
+                        "error": traceback.format_exc(),
+                        "duration_s": None,
+                    }
+
+    return pd.DataFrame(rows, columns=["session_ID", "status", "error", "duration_s"])
+
+
+def _run_session(session_function, session: dict):
+    "Runs one session and catches its errors"
+
+    start = time.perf_counter()
+    try:
+        status = session_function(**session)
+        error = None
+    except Exception:
+        status = "error"
+        error = traceback.format_exc()
+        print(f"Session {session['session_ID']} failed:\n{error}")
+    finally:
+        # the parameters of the session are saved even if it failed
+        _flush_params()
+
+    return {
+        "session_ID": session["session_ID"],
+        "status": status,
+        "error": error,
+        "duration_s": time.perf_counter() - start,
+    }
+
+
+class SessionPrefetcher:
+    """
+    Loads the recordings of the next sessions of a batch in a background
+    thread, while the current session is analyzed (and waits for the user).
+    The sessions are loaded in order, as long as the memory of the sessions
+    loaded in advance stays under memory_limit_gb.
+
+    Inputs:
+        - load_function: function called as load_function(**session) to load
+        a session, in the background thread
+        - sessions: list of dict, keyword arguments of each session, in the
+        order of the analysis, with at least the key "session_ID"
+        - memory_estimates: list, estimated memory of each session (bytes, see
+        probe.estimate_session_memory), None when unknown
+        - memory_limit_gb: float, largest memory of the sessions loaded in
+        advance (GB). A session whose memory is unknown or larger than the
+        limit is never loaded in advance.
+    """
+
+    def __init__(
+        self,
+        load_function,
+        sessions: list,
+        memory_estimates: list,
+        memory_limit_gb: float,
+    ):
+        self.load_function = load_function
+        self.sessions = sessions
+        self.memory_estimates = memory_estimates
+        self.memory_limit = memory_limit_gb * 1e9
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.futures = {}  # index of the session: future of its loading
+        self.next_index = 0  # next session to load in advance
+        self._prefetch()
+
+    def get(self, session_ID: str):
+        """
+        Returns the loaded session (see load_function), waiting for its loading
+        if it is in progress, or loading it now if it was not loaded in advance.
+        The loading of the next sessions then starts in the background.
+        """
+
+        index = next(
+            i for i, session in enumerate(self.sessions)
+            if session["session_ID"] == session_ID
+        )
+        # the sessions before are not needed anymore (skipped or failed)
+        for i in [i for i in self.futures if i < index]:
+            self.futures.pop(i).cancel()
+        future = self.futures.pop(index, None)
+        self.next_index = max(self.next_index, index + 1)
+
+        if future is None:
+            # not loaded in advance: loaded now, the next ones in the background
+            self._prefetch()
+            return self.load_function(**self.sessions[index])
+        try:
+            return future.result()
+        finally:
+            self._prefetch()
+
+    def close(self):
+        "Stops loading sessions in advance"
+        for future in self.futures.values():
+            future.cancel()
+        self.executor.shutdown(wait=True)
+
+    def _prefetch(self):
+        "Start loading the next sessions that fit in the memory limit"
+        used = sum(self.memory_estimates[i] for i in self.futures)
+        while self.next_index < len(self.sessions):
+            memory = self.memory_estimates[self.next_index]
+            if memory is None or used + memory > self.memory_limit:
+                break
+            self.futures[self.next_index] = self.executor.submit(
+                self.load_function, **self.sessions[self.next_index]
+            )
+            used += memory
+            self.next_index += 1
+
+
+def run_in_threads(*functions):
+    """
+    Runs independent parts of a session at the same time, each in its own
+    thread (e.g. the loading of the intracranial and of the external
+    recordings), and waits for all of them. The parameters saved by each
+    part are saved in the parameters of the session of the calling thread
+    (see utils._use_params). The figures and questions to the user have to stay
+    in the calling thread, as matplotlib is not thread-safe.
+
+    Inputs:
+        - functions: functions called without argument (see functools.partial)
+
+    Returns:
+        - results: list, the value returned by each function, in order. If a
+        function raised an error, it is raised again once all have finished.
+    """
+
+    session_parameters = _get_params()
+
+    def run(function):
+        _use_params(session_parameters)
+        return function()
+
+    with ThreadPoolExecutor(max_workers=len(functions)) as executor:
+        futures = [executor.submit(run, function) for function in functions]
+        wait(futures)
+
+    return [future.result() for future in futures]
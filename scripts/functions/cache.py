@@ -0,0 +1,163 @@
+"""
+On-disk cache of decoded recordings
+"""
+
+import os
+import json
+import hashlib
+import numpy as np
+from os.path import join
+
+
+class RecordingCache:
+    """
+    Cache of decoded recordings, to avoid decoding the same source files
+    again every time a session is re-run.
+
+    Each decoded recording is stored as a (channels, samples) .npy file,
+    opened as a read-only memmap on a cache hit, next to a .json sidecar
+    containing its metadata (channel names, sampling frequency...).
+    Entries are identified by the path, size and modification time of the
+    source file, optionally its content hash, and the loading options. When
+    the cache exceeds max_size_gb, the least recently used entries are
+    removed.
+
+    Inputs:
+        - cache_dir: str, folder where the decoded recordings are stored
+        - max_size_gb: float, maximum size of the cache (GB)
+        - hash_content: bool, if True, the content of the source file is
+        hashed to build the key (slower, but robust to files modified
+        without a change of size and modification time)
+    """
+
+    def __init__(self, cache_dir: str, max_size_gb: float = 20, hash_content=False):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_gb * 1e9)
+        self.hash_content = hash_content
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get(self, file_path: str, **options):
+        """
+        Returns the cached recording of file_path decoded with the given
+        options, or None if it is not in the cache.
+
+        Returns:
+            - data: np.memmap (channels, samples), read-only
+            - metadata: dict, metadata stored with the recording
+        """
+
+        npy_path, json_path = self._paths(self._key(file_path, options))
+        if not (os.path.isfile(npy_path) and os.path.isfile(json_path)):
+            return None
+
+        with open(json_path, "r") as f:
+            metadata = json.load(f)
+        os.utime(json_path)  # mark the entry as recently used
+
+        return np.load(npy_path, mmap_mode="r"), metadata["metadata"]
+
+    def put(self, file_path: str, data, metadata: dict, **options):
+        """
+        Stores the recording of file_path decoded with the given options,
+        and returns it from the cache (see get).
+
+        Inputs:
+            - file_path: str, path to the source file
+            - data: np.ndarray or Poly5SampleView (channels, samples), the
+            decoded recording. It is written in chunks of samples, so lazy
+            views are never decoded as a whole.
+            - metadata: dict, JSON-serializable metadata of the recording
+        """
+
+        key = self._key(file_path, options)
+        npy_path, json_path = self._paths(key)
+
+        # write to temporary files first, so that an interrupted write never
+        # leaves an incomplete entry in the cache (one per process, for the
+        # sessions analyzed in parallel)
+        tmp_npy_path = f"{npy_path}.{os.getpid()}.tmp"
+        stored = np.lib.format.open_memmap(
+            tmp_npy_path, mode="w+", dtype=data.dtype, shape=data.shape
+        )
+        # chunks of about 64 MB
+        sample_size = data.dtype.itemsize * max(1, data.shape[0])
+        chunk_size = max(1, (1 << 26) // sample_size)
+        for start in range(0, data.shape[1], chunk_size):
+            stored[:, start : start + chunk_size] = data[:, start : start + chunk_size]
+        stored.flush()
+        del stored
+        os.replace(tmp_npy_path, npy_path)
+
+        sidecar = {
+            "file_path": os.path.abspath(file_path),
+            "options": options,
+            "metadata": metadata,
+        }
+        tmp_json_path = f"{json_path}.{os.getpid()}.tmp"
+        with open(tmp_json_path, "w") as f:
+            json.dump(sidecar, f, indent=4, default=_to_builtin)
+        os.replace(tmp_json_path, json_path)
+
+        self._evict(keep=key)
+
+        return self.get(file_path, **options)
+
+    def _key(self, file_path: str, options: dict):
+        stat = os.stat(file_path)
+        identity = {
+            "file_path": os.path.abspath(file_path),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "options": options,
+        }
+        if self.hash_content:
+            identity["content_hash"] = _hash_file(file_path)
+
+        identity = json.dumps(identity, sort_keys=True, default=_to_builtin)
+        return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+
+    def _paths(self, key: str):
+        return join(self.cache_dir, key + ".npy"), join(self.cache_dir, key + ".json")
+
+    def _evict(self, keep: str):
+        "Remove the least recently used entries until the cache fits max_size"
+        entries = []
+        total_size = 0
+        for filename in os.listdir(self.cache_dir):
+            if not filename.endswith(".json"):
+                continue
+            key = filename[: -len(".json")]
+            npy_path, json_path = self._paths(key)
+            if not os.path.isfile(npy_path):
+                continue
+            size = os.path.getsize(npy_path)
+            entries.append((os.path.getmtime(json_path), key, size))
+            total_size += size
+
+        for _, key, size in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            if key == keep:
+                continue
+            for path in self._paths(key):
+                os.remove(path)
+            total_size -= size
+
+
+def _hash_file(file_path: str):
+    file_hash = hashlib.blake2b()
+    with open(file_path, "rb") as f:
+        while True:
+            block = f.read(1 << 24)
+            if not block:
+                break
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def _to_builtin(value):
+    "Convert numpy scalars for the JSON sidecars"
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
@@ -1,12 +1,31 @@
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from scipy.signal import find_peaks
-from itertools import compress
+
+
+# One row per artifact of a recording:
+#   - onset: sample index of the artifact
+#   - polarity: -1 for a downward deflection in the recorded signal, 1 for an
+#     upward one (0 if unknown, for manually selected artifacts)
+#   - amplitude: value of the recorded signal at the peak of the artifact
+#   - confidence: ratio between the detection feature at the artifact and
+#     the detection threshold (>= 1, the higher the more reliable)
+ARTIFACT_TRAIN_DTYPE = np.dtype(
+    [
+        ("onset", np.int64),
+        ("polarity", np.int8),
+        ("amplitude", np.float32),
+        ("confidence", np.float32),
+    ]
+)
 
 
 # Detection of artifacts in TMSi
 
 
-def find_external_sync_artifact(data: np.ndarray, sf_external: int, start_index=0):
+def find_external_sync_artifact(
+    data: np.ndarray, sf_external: int, start_index=0, return_all=False
+):
     """
     Function that finds artifacts caused by increasing/reducing
     stimulation from 0 to 1mA without ramp.
@@ -27,8 +46,12 @@ def find_external_sync_artifact(data: np.ndarray, sf_external: int, start_index=
             will start looking for artifacts from that index. This is useful when
             the recording was started in Stimulation ON or when there is another
             kind of artifact at the beginning of the recording
+        - return_all: bool, if True, the timestamps of all the samples
+            fulfilling the detection rule (all the pulses of all the artifacts)
+            are returned instead of the first one
     Returns:
-        - art_time_BIP: the timestamp where the artifact starts in external recording
+        - art_time_BIP: the timestamp where the artifact starts in external
+            recording (np.ndarray of all the timestamps if return_all is True)
 
     """
 
@@ -39,10 +62,83 @@ def find_external_sync_artifact(data: np.ndarray, sf_external: int, start_index=
     deflection instead, then the signal has to be inverted before detecting 
     artifacts.
     """
+    if return_all:
+        art_idx, _, _ = _find_external_artifact_pulses(data, sf_external, start_index)
+        return art_idx / sf_external
+
+    train = find_external_artifact_train(data, sf_external, start_index)
+    if len(train) == 0:
+        raise ValueError("No artifact was found in the external recording.")
+    art_time_BIP = train["onset"][0] / sf_external
+
+    return art_time_BIP
+
+
+def find_external_artifact_train(
+    data: np.ndarray, sf_external: int, start_index=0
+):
+    """
+    Finds all the artifacts of the external recording, with the same rule
+    as find_external_sync_artifact (which returns only the first one).
+    The rule finds each pulse of the stimulation: the pulses separated by
+    less than 1 second are grouped in one artifact, as the excursions of the
+    intracranial recording (see find_LFP_artifact_train). The onset of an
+    artifact is its first pulse, its amplitude and confidence those of its
+    largest pulse.
+
+    Inputs:
+        - data: np.ndarray, single external channel (from bipolar electrode),
+            detrended
+        - sf_external: int, sampling frequency of external recording
+        - start_index: int, index from which artifacts are searched
+
+    Returns:
+        - train: np.ndarray of dtype ARTIFACT_TRAIN_DTYPE, one row per
+            artifact, sorted by onset
+    """
+
+    art_idx, polarity, confidences = _find_external_artifact_pulses(
+        data, sf_external, start_index
+    )
+
+    # first and largest pulse of each artifact
+    first_pulses = np.flatnonzero(
+        np.diff(art_idx, prepend=-sf_external - 1) > sf_external
+    )
+    last_pulses = np.append(first_pulses[1:], len(art_idx))
+    largest_pulses = np.array(
+        [
+            first + np.argmax(confidences[first:last])
+            for first, last in zip(first_pulses, last_pulses)
+        ],
+        dtype=np.int64,
+    )
+
+    train = np.zeros(len(first_pulses), dtype=ARTIFACT_TRAIN_DTYPE)
+    train["onset"] = art_idx[first_pulses]
+    train["polarity"] = polarity
+    train["amplitude"] = data[art_idx[largest_pulses]]
+    train["confidence"] = confidences[largest_pulses]
+
+    return train
+
+
+def _find_external_artifact_pulses(
+    data: np.ndarray, sf_external: int, start_index=0
+):
+    """
+    Samples of the external recording fulfilling the detection rule of
+    find_external_sync_artifact: one per pulse of the stimulation. Returns
+    their indexes, the polarity of the artifacts and the ratio between the
+    signal at each of them and the detection threshold.
+    """
+
     # check polarity of artifacts before detection:
-    if abs(max(data[:-1000])) > abs(min(data[:-1000])):
+    polarity = -1
+    if abs(np.max(data[:-1000])) > abs(np.min(data[:-1000])):
         print("external signal is reversed")
         data = data * -1
+        polarity = 1
         print("invertion undone")
 
     # define thresh_BIP as 1.5 times the difference between the max and min
@@ -54,16 +150,19 @@ def find_external_sync_artifact(data: np.ndarray, sf_external: int, start_index=
     # the signal is below the threshold, and when the signal is lower than the
     # previous and next sample (first peak of the artifact).
 
-    for q in range(start_index, len(data) - 2):
-        if (
-            (data[q] <= thresh_BIP)
-            and (data[q] < data[q + 1])
-            and (data[q] < data[q - 1])
-        ):
-            art_time_BIP = q / sf_external
-            break
+    # data[q - 1] is data[-1] for q = 0, as in the former sample-by-sample loop
+    start_index = int(start_index)
+    current = data[start_index : len(data) - 2]
+    previous = data[start_index - 1 : len(data) - 3] if start_index > 0 else (
+        np.concatenate((data[-1:], data[: len(data) - 3]))
+    )
+    following = data[start_index + 1 : len(data) - 1]
+    is_artifact = (
+        (current <= thresh_BIP) & (current < following) & (current < previous)
+    )
+    art_idx = np.flatnonzero(is_artifact) + start_index
 
-    return art_time_BIP
+    return art_idx, polarity, data[art_idx] / thresh_BIP
 
 
 # Detection of artifacts in LFP
@@ -100,21 +199,67 @@ def find_LFP_sync_artifact(data: np.ndarray, sf_LFP: int, use_method: str):
         intracranial recording.
     """
 
+    train = find_LFP_artifact_train(data, sf_LFP, use_method)
+    art_time_LFP = train["onset"][0] / sf_LFP
+
+    return art_time_LFP
+
+
+def find_LFP_artifact_train(data: np.ndarray, sf_LFP: int, use_method: str):
+    """
+    Finds all the artifacts of the intracranial recording, with the same
+    methods as find_LFP_sync_artifact (which returns only the first one).
+    With the 'thresh' method, each excursion above the threshold separated
+    from the previous one by more than 1 second is an artifact, and its onset
+    is found as for the first artifact, on the signal since the previous one.
+
+    Input:
+        - data: np.ndarray, single data channel of intracranial recording, containing
+            the stimulation artifact
+        - sf_LFP: int, sampling frequency of intracranial recording
+        - use_method: str, '1' or '2' or 'thresh' (see find_LFP_sync_artifact)
+
+    Returns:
+        - train: np.ndarray of dtype ARTIFACT_TRAIN_DTYPE, one row per
+            artifact, sorted by onset
+    """
+
     # checks correct input for use_kernel variable
     assert use_method in ["1", "2", "thresh"], "use_method incorrect. Should be '1', '2' or 'thresh'"
 
+    # detection is computed in float64, whatever the dtype of the recording
+    data = np.asarray(data, dtype=np.float64)
+
     if use_method == "thresh":
         thres_window = sf_LFP * 2
         thres = np.ptp(data[:thres_window])
         # Compute absolute value to be invariant to the polarity of the signal
         abs_data = np.abs(data)
         # Check where the data exceeds the threshold
-        over_thres = np.where(abs_data > thres)[0][0]
-        # Take last sample that lies within the value distribution of the thres_window before the threshold passing
-        # The percentile is something that can be varied
-        stim_idx = np.where(
-            abs_data[:over_thres] <= np.percentile(abs_data[:over_thres], 95)
-        )[0][-1]
+        over_thres = np.where(abs_data > thres)[0]
+        # group the samples over the threshold in excursions separated by
+        # more than 1 second
+        new_excursion = np.flatnonzero(np.diff(over_thres) > sf_LFP) + 1
+        excursion_starts = over_thres[np.concatenate(([0], new_excursion))]
+        excursion_ends = over_thres[np.concatenate((new_excursion - 1, [-1]))]
+
+        stim_idx_all = []
+        amplitudes = []
+        for k, over_start in enumerate(excursion_starts):
+            baseline_start = excursion_ends[k - 1] + 1 if k > 0 else 0
+            # Take last sample that lies within the value distribution of the thres_window before the threshold passing
+            # The percentile is something that can be varied
+            baseline = abs_data[baseline_start:over_start]
+            stim_idx_all.append(
+                baseline_start
+                + np.where(baseline <= np.percentile(baseline, 95))[0][-1]
+            )
+            peak = over_start + np.argmax(abs_data[over_start : excursion_ends[k] + 1])
+            amplitudes.append(data[peak])
+        stim_idx_all = np.array(stim_idx_all)
+        amplitudes = np.array(amplitudes)
+        polarities = np.sign(amplitudes)
+        confidences = np.abs(amplitudes) / thres
 
 
 
@@ -129,16 +274,13 @@ def find_LFP_sync_artifact(data: np.ndarray, sf_LFP: int, use_method: str):
 
         
         # get dot-products between kernel and time-serie snippets
-        res = []  # store results of dot-products
-        for i in np.arange(0, len(data) - len(ker)):
-            res.append(ker @ data[i : i + len(ker)])
-            # calculate dot-product of vectors
-            # the dot-product result is high when the timeseries snippet
-            # is very similar to the kernel
-        res = np.array(res)  # convert list to array
+        # (res[i] = ker @ data[i : i + len(ker)], the last snippet is not used)
+        # the dot-product result is high when the timeseries snippet
+        # is very similar to the kernel
+        res = np.correlate(data, ker, mode="valid")[:-1]
 
         # normalise dot product results
-        res = res / max(res)
+        res = res / np.max(res)
 
         # calculate a ratio between std dev and maximum during
         # the first seconds to check whether an stim-artifact was present
@@ -146,8 +288,9 @@ def find_LFP_sync_artifact(data: np.ndarray, sf_LFP: int, use_method: str):
 
         # find peak of kernel dot products
         # pos_idx contains all the positive peaks, neg_idx all the negative peaks
-        pos_idx = find_peaks(x=res, height=0.3 * max(res), distance=sf_LFP)[0]
-        neg_idx = find_peaks(x=-res, height=-0.3 * min(res), distance=sf_LFP)[0]
+        res_max, res_min = np.max(res), np.min(res)
+        pos_idx = find_peaks(x=res, height=0.3 * res_max, distance=sf_LFP)[0]
+        neg_idx = find_peaks(x=-res, height=-0.3 * res_min, distance=sf_LFP)[0]
 
         # check warn if NO STIM artifacts are suspected
         if (len(neg_idx) > 20 and ratio_max_sd < 8) or (len(pos_idx) > 20 and ratio_max_sd < 8):
@@ -169,16 +312,10 @@ def find_LFP_sync_artifact(data: np.ndarray, sf_LFP: int, use_method: str):
             if (
                 pos_idx[0] - neg_idx[0]
             ) < 50:  # if first positive and negative are very close
-                width_pos = 0
-                r_i = pos_idx[0]
-                while res[r_i] > (max(res) * 0.3):
-                    r_i += 1
-                    width_pos += 1
-                width_neg = 0
-                r_i = neg_idx[0]
-                while res[r_i] < (min(res) * 0.3):
-                    r_i += 1
-                    width_neg += 1
+                # number of samples until the dot-product falls back within
+                # 30% of its extremum
+                width_pos = np.argmax(res[pos_idx[0] :] <= (res_max * 0.3))
+                width_neg = np.argmax(res[neg_idx[0] :] >= (res_min * 0.3))
                 # undo invertion if negative dot-product (pos lfp peak) is very narrow
                 if width_pos > (2 * width_neg):
                     signal_inverted = False
@@ -192,20 +329,192 @@ def find_LFP_sync_artifact(data: np.ndarray, sf_LFP: int, use_method: str):
             stim_idx = neg_idx
 
         # filter out inconsistencies in peak heights (assuming sync-stim-artifacts are stable)
-        abs_heights = [max(abs(data[i - 5 : i + 5])) for i in stim_idx]
+        # windows of 10 samples around each peak (data[i - 5 : i + 5]), the
+        # indexes are clipped at the edges of the recording
+        windows = data[
+            np.clip(stim_idx[:, np.newaxis] + np.arange(-5, 5), 0, len(data) - 1)
+        ]
+        abs_heights = np.max(np.abs(windows), axis=1)
 
         # check polarity of peak
         if not signal_inverted:
-            sel_idx = np.array([min(data[i - 5 : i + 5]) for i in stim_idx]) < (
-                np.median(abs_heights) * -0.5
-            )
+            sel_idx = np.min(windows, axis=1) < (np.median(abs_heights) * -0.5)
         elif signal_inverted:
-            sel_idx = np.array([max(data[i - 5 : i + 5]) for i in stim_idx]) > (
-                np.median(abs_heights) * 0.5
-            )
-        stim_idx_all = list(compress(stim_idx, sel_idx))
-        stim_idx = stim_idx_all[0]
+            sel_idx = np.max(windows, axis=1) > (np.median(abs_heights) * 0.5)
+        stim_idx_all = stim_idx[sel_idx]
+
+        # the recorded artifact is a negative peak in a 'normal' signal
+        if not signal_inverted:
+            amplitudes = np.min(windows[sel_idx], axis=1)
+            confidences = res[stim_idx_all] / (0.3 * res_max)
+        elif signal_inverted:
+            amplitudes = np.max(windows[sel_idx], axis=1)
+            confidences = res[stim_idx_all] / (0.3 * res_min)
+        polarities = 1 if signal_inverted else -1
+
+    train = np.zeros(len(stim_idx_all), dtype=ARTIFACT_TRAIN_DTYPE)
+    train["onset"] = stim_idx_all
+    train["polarity"] = polarities
+    train["amplitude"] = amplitudes
+    train["confidence"] = confidences
+
+    return train
+
+
+def rank_LFP_detection_methods(
+    data: np.ndarray,
+    sf_LFP: int,
+    external_train: np.ndarray = None,
+    sf_external: int = None,
+    methods=("thresh", "2", "1"),
+    max_workers: int = None,
+):
+    """
+    Runs the automatic detection methods of find_LFP_artifact_train
+    concurrently, and ranks their results by consistency with the artifacts
+    of the external recording (see score_LFP_artifact_train).
 
-    art_time_LFP = stim_idx / sf_LFP
+    Input:
+        - data: np.ndarray, single data channel of intracranial recording, containing
+            the stimulation artifact
+        - sf_LFP: int, sampling frequency of intracranial recording
+        - external_train: np.ndarray of dtype ARTIFACT_TRAIN_DTYPE, artifacts
+            of the external recording, or None if unknown
+        - sf_external: int, sampling frequency of external recording
+        - methods: tuple, methods to run ('1', '2' and/or 'thresh'). Methods
+            with the same score keep this order.
+        - max_workers: int, number of threads, None for one per method
 
-    return art_time_LFP
+    Returns:
+        - candidates: list of dict, one per method that found artifacts,
+            sorted from the most to the least consistent, with keys
+            "method": the method used
+            "train": the artifacts found (ARTIFACT_TRAIN_DTYPE)
+            "art_time_LFP": the timestamp of the first artifact (s)
+            "confidence": the score of the train, between 0 and 1
+    """
+
+    # detection is computed in float64, whatever the dtype of the recording
+    data = np.asarray(data, dtype=np.float64)
+
+    def detect(method):
+        try:
+            return find_LFP_artifact_train(data, sf_LFP, method)
+        except (IndexError, ValueError):
+            # the method did not find any artifact
+            return None
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(methods)) as executor:
+        trains = list(executor.map(detect, methods))
+
+    candidates = [
+        {
+            "method": method,
+            "train": train,
+            "art_time_LFP": train["onset"][0] / sf_LFP,
+        }
+        for method, train in zip(methods, trains)
+        if train is not None and len(train) > 0
+    ]
+
+    return rescore_LFP_candidates(candidates, sf_LFP, external_train, sf_external)
+
+
+def rescore_LFP_candidates(
+    candidates: list,
+    sf_LFP: int,
+    external_train: np.ndarray = None,
+    sf_external: int = None,
+):
+    """
+    Scores the candidates of rank_LFP_detection_methods again, e.g. once the
+    external artifacts are known when the intracranial ones were detected
+    without them, and sorts them again.
+
+    Input:
+        - candidates: list of dict, with at least the keys "method" and "train"
+        - sf_LFP: int, sampling frequency of intracranial recording
+        - external_train: np.ndarray of dtype ARTIFACT_TRAIN_DTYPE, artifacts
+            of the external recording, or None if unknown
+        - sf_external: int, sampling frequency of external recording
+
+    Returns:
+        - candidates: list of dict, the same candidates with their new
+            "confidence", sorted from the most to the least consistent
+    """
+
+    candidates = [
+        dict(
+            candidate,
+            confidence=score_LFP_artifact_train(
+                candidate["train"], sf_LFP, external_train, sf_external
+            ),
+        )
+        for candidate in candidates
+    ]
+    # sorted is stable: methods with the same score keep their order
+    candidates = sorted(candidates, key=lambda c: -c["confidence"])
+
+    return candidates
+
+
+def score_LFP_artifact_train(
+    train: np.ndarray,
+    sf_LFP: int,
+    external_train: np.ndarray = None,
+    sf_external: int = None,
+    tolerance_s: float = 0.05,
+):
+    """
+    Scores the consistency of the artifacts found in the intracranial
+    recording with those of the external recording. The artifacts of both
+    recordings are timed relative to their first artifact, and paired when
+    they are less than tolerance_s (plus 100 ppm of clock drift) apart. The
+    score is the fraction of the artifacts of both recordings that are
+    paired: a wrong first artifact shifts all the intracranial artifacts and
+    none of them is paired.
+
+    Without external artifacts, the score is only based on the detection
+    confidence of the first intracranial artifact (1 - 1 / confidence).
+
+    Input:
+        - train: np.ndarray of dtype ARTIFACT_TRAIN_DTYPE, artifacts of the
+            intracranial recording
+        - sf_LFP: int, sampling frequency of intracranial recording
+        - external_train: np.ndarray of dtype ARTIFACT_TRAIN_DTYPE, artifacts
+            of the external recording, or None if unknown
+        - sf_external: int, sampling frequency of external recording
+        - tolerance_s: float, largest delay between two paired artifacts (s)
+
+    Returns:
+        - score: float, between 0 and 1 (1 for a perfect agreement)
+    """
+
+    if external_train is None or len(external_train) == 0:
+        confidence = float(train["confidence"][0])
+        if not confidence > 1:
+            return 0.0
+        return 1 - 1 / confidence
+
+    artifacts_lfp = train["onset"] / sf_LFP
+    artifacts_external = external_train["onset"] / sf_external
+    artifacts_lfp = artifacts_lfp - artifacts_lfp[0]
+    artifacts_external = artifacts_external - artifacts_external[0]
+
+    # closest external artifact of each intracranial artifact
+    right = np.clip(
+        np.searchsorted(artifacts_external, artifacts_lfp),
+        0,
+        len(artifacts_external) - 1,
+    )
+    left = np.maximum(right - 1, 0)
+    distances = np.minimum(
+        np.abs(artifacts_external[left] - artifacts_lfp),
+        np.abs(artifacts_external[right] - artifacts_lfp),
+    )
+    n_paired = min(
+        np.count_nonzero(distances <= tolerance_s + 1e-4 * artifacts_lfp),
+        len(artifacts_external),
+    )
+
+    return 2 * n_paired / (len(artifacts_lfp) + len(artifacts_external))
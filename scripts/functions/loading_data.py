@@ -1,11 +1,25 @@
+import csv
 import json
+import numpy as np
 import pandas as pd
 from mne.io import read_raw_fieldtrip
 from os.path import join
-import scipy.io
+import h5py
 
-from functions.utils import _update_and_save_multiple_params
+from functions.utils import _update_and_save_multiple_params, _is_mat_v73, _h5_string
 from functions.tmsi_poly5reader import Poly5Reader
+from functions.probe import _read_mat5_variable
+
+try:
+    from pyarrow import csv as pa_csv
+    import pyarrow as pa
+except ImportError:
+    pa_csv = None
+
+try:
+    from pymatreader import read_mat
+except ImportError:
+    read_mat = None
 
 #### LFP DATASET ####
 def load_intracranial(
@@ -15,7 +29,10 @@ def load_intracranial(
         trial_idx_lfp,
         saving_path,
         source_path,
-        PREPROCESSING
+        PREPROCESSING,
+        dtype="float32",
+        cache=None,
+        USE_PYMATREADER=False
         ):
     
     """
@@ -31,6 +48,14 @@ def load_intracranial(
     source_path: str, path to the source file
     PREPROCESSING: str, "Perceive" or "DBScope" depending on which toolbox was 
     used to extract the recording from the original json file
+    dtype: str, data type of the returned recording, "float32" (default) or
+    "float64"
+    cache: RecordingCache or None, if given, the decoded recording is taken
+    from the cache when available, and stored in it otherwise
+    USE_PYMATREADER: bool, only used if PREPROCESSING is "Perceive". If True,
+    the FieldTrip .mat file is read directly with pymatreader, without creating
+    an MNE object (faster, requires pymatreader). If False (default), it is read
+    with mne.io.read_raw_fieldtrip
 
     ............................................................................
     
@@ -42,8 +67,57 @@ def load_intracranial(
     sf_LFP: int, the sampling frequency of the intracranial recording
 
     """
+
+    if type(ch_idx_lfp) == float:
+        ch_idx_lfp = int(ch_idx_lfp)
+    if type(trial_idx_lfp) == float:
+        trial_idx_lfp = int(trial_idx_lfp)
+
+    if cache is not None:
+        file_path = join(source_path, fname_lfp)
+        cache_options = {
+            "PREPROCESSING": PREPROCESSING if fname_lfp.endswith(".mat") else None,
+            "trial_idx_lfp": trial_idx_lfp if PREPROCESSING == "DBScope" else None,
+            "dtype": dtype,
+        }
+        cached = cache.get(file_path, **cache_options)
+        if cached is not None:
+            LFP_array, metadata = cached
+            LFP_rec_ch_names = metadata["ch_names"]
+            sf_LFP = metadata["sf"]
+            lfp_sig = LFP_array[ch_idx_lfp]
+
+            dictionary = {
+                "SUBJECT_ID": session_ID,
+                "FNAME_LFP": fname_lfp,
+                "CH_IDX_LFP": ch_idx_lfp,
+                "LFP_REC_CH_NAMES": LFP_rec_ch_names,
+                "LFP_REC_DURATION": LFP_array.shape[1] / sf_LFP,
+                "sf_LFP": sf_LFP,
+            }
+            if PREPROCESSING == "DBScope":
+                dictionary["TRIAL_IDX_LFP"] = trial_idx_lfp
+            _update_and_save_multiple_params(dictionary, session_ID, saving_path)
+
+            return LFP_array, lfp_sig, LFP_rec_ch_names, sf_LFP
     
-    if fname_lfp.endswith(".mat") and PREPROCESSING == "Perceive":
+    if fname_lfp.endswith(".mat") and PREPROCESSING == "Perceive" and USE_PYMATREADER:
+        # no MNE object is needed here, read the FieldTrip struct directly
+        if read_mat is None:
+            raise ImportError(
+                "USE_PYMATREADER is True but pymatreader is not installed: "
+                "install it with 'pip install pymatreader' or set USE_PYMATREADER "
+                "to False"
+            )
+        (LFP_array, lfp_sig, LFP_rec_ch_names, sf_LFP) = load_data_lfp_fieldtrip(
+            session_ID=session_ID,
+            fname_lfp=fname_lfp,
+            ch_idx_lfp=ch_idx_lfp,
+            source_path=source_path,
+            saving_path=saving_path,
+            dtype=dtype,
+        )
+    elif fname_lfp.endswith(".mat") and PREPROCESSING == "Perceive":
         dataset_lfp = load_mat_file(
             session_ID=session_ID,
             filename=fname_lfp,
@@ -55,6 +129,7 @@ def load_intracranial(
             dataset_lfp=dataset_lfp,
             ch_idx_lfp=ch_idx_lfp,
             saving_path=saving_path,
+            dtype=dtype,
         )
     if fname_lfp.endswith(".mat") and PREPROCESSING == "DBScope":
         (LFP_array, lfp_sig, LFP_rec_ch_names, sf_LFP) = load_data_lfp_DBScope(
@@ -64,6 +139,7 @@ def load_intracranial(
             trial_idx_lfp=trial_idx_lfp,
             source_path=source_path,
             saving_path=saving_path,
+            dtype=dtype,
         )
     if fname_lfp.endswith(".csv"):
         (LFP_array, lfp_sig, LFP_rec_ch_names, sf_LFP) = load_intracranial_csv_file(
@@ -72,8 +148,18 @@ def load_intracranial(
             ch_idx_lfp=ch_idx_lfp,
             saving_path=saving_path,
             source_path=source_path,
+            dtype=dtype,
         )    
 
+    if cache is not None:
+        LFP_array, _ = cache.put(
+            file_path,
+            LFP_array,
+            {"ch_names": LFP_rec_ch_names, "sf": sf_LFP},
+            **cache_options,
+        )
+        lfp_sig = LFP_array[ch_idx_lfp]
+
     return LFP_array, lfp_sig, LFP_rec_ch_names, sf_LFP
 
 
@@ -83,7 +169,10 @@ def load_external(
         fname_external,
         BIP_ch_name,
         saving_path,
-        source_path
+        source_path,
+        dtype="float32",
+        cache=None,
+        external_channels=None
     ):
 
     """
@@ -94,6 +183,16 @@ def load_external(
     BIP_ch_name: str, name of the external channel containing the sync artifacts
     saving_path: str, path to save the parameters
     source_path: str, path to the source file
+    dtype: str, data type of the returned recording, "float32" (default) or
+    "float64"
+    cache: RecordingCache or None, if given, the decoded recording is taken
+    from the cache when available, and stored in it otherwise. Poly5 files
+    are never cached: they are already memory-mapped and only the channels
+    used are read, while a cache entry would decode and write all of them
+    external_channels: list or None, names of the external channels to keep
+    in the synchronized recording. The bipolar channel is always kept. None
+    (default) keeps all the channels. Only these channels are read from .csv
+    files.
 
 
     ............................................................................
@@ -106,6 +205,7 @@ def load_external(
     for synchronization (the one containing deep brain stimulation
     artifacts = the	channel recorded with the bipolar electrode)
     external_rec_ch_names: list, the names of all the channels recorded externally
+    (only the kept ones if external_channels is given)
     sf_external: int, sampling frequency of external recording
     ch_index_external: int, index of the bipolar channel in the external recording
     (BIP_channel)
@@ -113,7 +213,45 @@ def load_external(
     """
 
     if fname_external.endswith(".Poly5"):
-        TMSi_data = Poly5Reader(join(source_path, fname_external))
+        # the memory-mapped reader is already as fast as the cache (see above)
+        cache = None
+
+    if cache is not None:
+        file_path = join(source_path, fname_external)
+        cache_options = {
+            "dtype": dtype,
+            "channels": (
+                sorted(set(external_channels) | {BIP_ch_name})
+                if external_channels is not None
+                else None
+            ),
+        }
+        cached = cache.get(file_path, **cache_options)
+        if cached is not None:
+            external_file, metadata = cached
+            external_rec_ch_names = metadata["ch_names"]
+            sf_external = metadata["sf"]
+
+            assert BIP_ch_name in external_rec_ch_names, "{} is not in externally recorded channels. Please choose from the available channels: {}".format(BIP_ch_name, external_rec_ch_names)
+
+            ch_index_external = external_rec_ch_names.index(BIP_ch_name)
+            BIP_channel = external_file[ch_index_external]
+
+            dictionary = {
+                "FNAME_EXTERNAL": fname_external,
+                "EXTERNAL_REC_CH_NAMES": external_rec_ch_names,
+                "EXTERNAL_REC_DURATION": external_file.shape[1] / sf_external,
+                "sf_EXTERNAL": sf_external,
+                "CH_IDX_EXTERNAL": ch_index_external,
+            }
+            _update_and_save_multiple_params(dictionary, session_ID, saving_path)
+
+            return external_file, BIP_channel, external_rec_ch_names, sf_external, ch_index_external
+
+    if fname_external.endswith(".Poly5"):
+        TMSi_data = Poly5Reader(
+            join(source_path, fname_external), mmap=True, dtype=dtype
+        )
         (
             external_file,
             BIP_channel,
@@ -125,7 +263,8 @@ def load_external(
             TMSi_data=TMSi_data,
             fname_external=fname_external,
             BIP_ch_name=BIP_ch_name,
-            saving_path=saving_path
+            saving_path=saving_path,
+            channels=external_channels,
         )
     if fname_external.endswith(".csv"):
         (
@@ -140,7 +279,18 @@ def load_external(
             BIP_ch_name=BIP_ch_name,
             saving_path=saving_path,
             source_path=source_path,
+            dtype=dtype,
+            channels=external_channels,
+        )
+
+    if cache is not None:
+        external_file, _ = cache.put(
+            file_path,
+            external_file,
+            {"ch_names": external_rec_ch_names, "sf": sf_external},
+            **cache_options,
         )
+        BIP_channel = external_file[ch_index_external]
 
     return external_file, BIP_channel, external_rec_ch_names, sf_external, ch_index_external
 
@@ -205,7 +355,8 @@ def load_intracranial_csv_file(
     filename: str, 
     ch_idx_lfp: int, 
     saving_path: str, 
-    source_path: str
+    source_path: str,
+    dtype: str = "float32"
     ):
 
     """
@@ -220,6 +371,7 @@ def load_intracranial_csv_file(
             - ch_idx_lfp: int, index of the channel of interest in the LFP recording
             - saving_path: str, path to save the parameters
             - source_path: str, path to the source file
+            - dtype: str, data type of the returned recording
 
     Returns:
             - LFP_array: np.ndarray, the LFP recording containing
@@ -232,13 +384,12 @@ def load_intracranial_csv_file(
     """
 
     sf_LFP = int(filename[filename.find("Hz") - 3 : filename.find("Hz")])
-    # load a csv file :
-    dataset_lfp = pd.read_csv(join(source_path, filename))
-    # convert to transposed array :
-    LFP_array = dataset_lfp.to_numpy().transpose()
-    # store the first column of dataset_lfp in an array called lfp_sig:
+    # load a csv file directly as a (channels, samples) array :
+    LFP_array, LFP_rec_ch_names = _read_csv_channels(
+        join(source_path, filename), dtype=dtype
+    )
+    # store the channel of interest in an array called lfp_sig:
     lfp_sig = LFP_array[ch_idx_lfp, :]
-    LFP_rec_ch_names = list(dataset_lfp.columns)
 
     time_duration_LFP = len(lfp_sig) / sf_LFP
 
@@ -255,7 +406,9 @@ def load_external_csv_file(
     filename: str, 
     BIP_ch_name: str, 
     saving_path: str, 
-    source_path: str
+    source_path: str,
+    dtype: str = "float32",
+    channels: list = None
     ):
     
     """
@@ -272,24 +425,33 @@ def load_external_csv_file(
             - BIP_ch_name: str, name of the bipolar channel, containing the artifacts
             - saving_path: str, path to save the parameters
             - source_path: str, path to the source file
+            - dtype: str, data type of the returned recording
+            - channels: list or None, names of the channels to read in
+                    addition to the bipolar channel. None (default) reads all
+                    the channels.
 
     Returns:
             - external_file: np.ndarray, the external recording containing all recorded
-                    channels
+                    channels (or only the selected ones)
             - BIP_channel: np.ndarray, the channel of the external recording to be used
                     for synchronization (the one containing deep brain stimulation
                     artifacts = the	channel recorded with the bipolar electrode)
             - external_rec_ch_names: list, the names of all the channels recorded externally
+                    (only the selected ones, in the order of the file)
             - sf_external: int, sampling frequency of external recording
             - ch_index_external: int, index of the bipolar channel in the external recording
                     (BIP_channel)
     """
 
     sf_external = int(filename[filename.find("Hz") - 4 : filename.find("Hz")])
-    # load a csv file :
-    dataset_external = pd.read_csv(join(source_path, filename))
-    external_file = dataset_external.to_numpy().transpose()
-    external_rec_ch_names = list(dataset_external.columns)
+    # load only the selected columns of the csv file :
+    if channels is not None:
+        channels = list(channels) + [BIP_ch_name]
+    external_file, external_rec_ch_names = _read_csv_channels(
+        join(source_path, filename), channels=channels, dtype=dtype
+    )
+
+    assert BIP_ch_name in external_rec_ch_names, "{} is not in externally recorded channels. Please choose from the available channels: {}".format(BIP_ch_name, external_rec_ch_names)
 
     ch_index_external = external_rec_ch_names.index(BIP_ch_name)
     BIP_channel = external_file[ch_index_external, :]
@@ -314,12 +476,68 @@ def load_external_csv_file(
     )
 
 
+def _read_csv_channels(file_path: str, channels: list = None, dtype: str = "float32"):
+    """
+    Reads the columns of a .csv recording directly into a (channels, samples)
+    array, without building a DataFrame of the whole file nor transposing it.
+    Only the selected columns are parsed. pyarrow is used when it is
+    installed (multi-threaded parser), pandas otherwise.
+
+    Inputs:
+            - file_path: str, path to the .csv file
+            - channels: list or None, names of the columns to read. None
+                    (default) reads all the columns.
+            - dtype: str, data type of the returned array
+
+    Returns:
+            - data: np.ndarray (channels, samples), C-contiguous, one row per
+                    channel, in the order of the file
+            - ch_names: list, the names of the channels read
+    """
+
+    with open(file_path, "r", newline="") as f:
+        header = next(csv.reader(f))
+    if channels is None:
+        ch_names = header
+    else:
+        missing = [ch for ch in channels if ch not in header]
+        assert not missing, "{} not in the channels of {}. Please choose from the available channels: {}".format(missing, file_path, header)
+        ch_names = [ch for ch in header if ch in channels]
+
+    if pa_csv is not None:
+        table = pa_csv.read_csv(
+            file_path,
+            convert_options=pa_csv.ConvertOptions(
+                include_columns=ch_names,
+                column_types={ch: pa.from_numpy_dtype(np.dtype(dtype)) for ch in ch_names},
+            ),
+        )
+        data = np.empty((len(ch_names), table.num_rows), dtype=dtype)
+        for i, ch in enumerate(ch_names):
+            start = 0
+            for chunk in table.column(ch).chunks:
+                data[i, start : start + len(chunk)] = chunk.to_numpy(
+                    zero_copy_only=False
+                )
+                start += len(chunk)
+    else:
+        columns = pd.read_csv(
+            file_path, usecols=ch_names, dtype=dtype, engine="c"
+        )
+        data = np.empty((len(ch_names), len(columns)), dtype=dtype)
+        for i, ch in enumerate(ch_names):
+            data[i] = columns[ch].to_numpy()
+
+    return data, list(ch_names)
+
+
 # extract variables from LFP recording:
 def load_data_lfp(
         session_ID: str, 
         dataset_lfp, 
         ch_idx_lfp: int, 
-        saving_path: str
+        saving_path: str,
+        dtype: str = "float32"
         ):
     
     """
@@ -333,6 +551,7 @@ def load_data_lfp(
             - dataset_lfp: mne-object of .mat file
             - ch_idx_lfp: int, index of the channel of interest in the LFP recording
             - saving_path: str, path to save the parameters
+            - dtype: str, data type of the returned recording
 
     Returns:
             - LFP_array: np.ndarray, the LFP recording containing
@@ -347,8 +566,8 @@ def load_data_lfp(
     if type(ch_idx_lfp) == float:
         ch_idx_lfp = int(ch_idx_lfp)
 
-    LFP_array = dataset_lfp.get_data()
-    lfp_sig = dataset_lfp.get_data()[ch_idx_lfp]
+    LFP_array = dataset_lfp.get_data().astype(dtype, copy=False)
+    lfp_sig = LFP_array[ch_idx_lfp]
     LFP_rec_ch_names = dataset_lfp.ch_names
     sf_LFP = int(dataset_lfp.info["sfreq"])
     time_duration_LFP = (dataset_lfp.n_times / dataset_lfp.info["sfreq"]).astype(float)
@@ -365,6 +584,100 @@ def load_data_lfp(
     return LFP_array, lfp_sig, LFP_rec_ch_names, sf_LFP
 
 
+def load_data_lfp_fieldtrip(
+    session_ID: str,
+    fname_lfp: str,
+    ch_idx_lfp: int,
+    source_path: str,
+    saving_path: str,
+    dtype: str = "float32",
+):
+
+    """
+    Reads a .mat file in FieldTrip structure (as exported by Perceive) directly
+    with pymatreader, without creating an MNE object, and extracts the LFP
+    signal from the channel of interest. The .mat file is read once, and the
+    LFP signal is a view of the whole LFP recording. Same outputs as
+    load_mat_file followed by load_data_lfp.
+
+    Inputs:
+            - session_ID: str, subject ID
+            - fname_lfp: str, name of the LFP recording session (.mat file)
+            - ch_idx_lfp: int, index of the channel of interest in the LFP recording
+            - source_path: str, path to the source file
+            - saving_path: str, path to save the parameters
+            - dtype: str, data type of the returned recording
+
+    Returns:
+            - LFP_array: np.ndarray, the LFP recording containing
+                    all recorded channels
+            - lfp_sig: np.ndarray, the LFP signal from the channel
+                    of interest
+            - LFP_rec_ch_names: list, the names of all the channels
+                    recorded
+            - sf_LFP: int, sampling frequency of LFP recording
+    """
+
+    # Error if filename doesn´t end with .mat
+    assert fname_lfp[-4:] == ".mat", f"filename no .mat INCORRECT extension: {fname_lfp}"
+
+    if type(ch_idx_lfp) == float:
+        ch_idx_lfp = int(ch_idx_lfp)
+
+    dataset_lfp = read_mat(
+        join(source_path, fname_lfp),
+        variable_names=["data"],
+        ignore_fields=["previous"],
+    )["data"]
+
+    LFP_array = np.array(dataset_lfp["trial"], dtype=dtype)
+    # same shape handling as mne.io.read_raw_fieldtrip
+    if LFP_array.ndim > 2:
+        LFP_array = np.squeeze(LFP_array)
+    if LFP_array.ndim == 1:
+        LFP_array = LFP_array[np.newaxis, ...]
+    if LFP_array.ndim != 2:
+        raise RuntimeError(
+            "The data you are trying to load does not seem to be raw data"
+        )
+    lfp_sig = LFP_array[ch_idx_lfp]
+    LFP_rec_ch_names = list(np.atleast_1d(dataset_lfp["label"]))
+    sfreq = _fieldtrip_sfreq(dataset_lfp)
+    sf_LFP = int(round(sfreq))
+    time_duration_LFP = LFP_array.shape[1] / sfreq
+
+    dictionary = {
+        "SUBJECT_ID": session_ID,
+        "FNAME_LFP": fname_lfp,
+        "CH_IDX_LFP": ch_idx_lfp, 
+        "LFP_REC_CH_NAMES": LFP_rec_ch_names, 
+        "LFP_REC_DURATION": time_duration_LFP, 
+        "sf_LFP": sf_LFP
+        }
+    _update_and_save_multiple_params(dictionary, session_ID, saving_path)
+
+    return LFP_array, lfp_sig, LFP_rec_ch_names, sf_LFP
+
+
+def _fieldtrip_sfreq(dataset_lfp: dict):
+    """
+    Sampling frequency of a FieldTrip struct, from its fsample field or, as in
+    mne.io.read_raw_fieldtrip, from its time vector when fsample is missing.
+    """
+
+    if "fsample" in dataset_lfp:
+        return float(dataset_lfp["fsample"])
+    if "time" in dataset_lfp:
+        time = dataset_lfp["time"]
+        # one time vector per trial
+        if isinstance(time, list):
+            time = time[0]
+        time = np.ravel(time)
+        if len(time) > 1:
+            return 1.0 / (time[1] - time[0])
+    raise ValueError("No Source for sfreq found")
+
+
 
 def load_data_lfp_DBScope(
     session_ID: str,
@@ -373,6 +686,7 @@ def load_data_lfp_DBScope(
     trial_idx_lfp: int,
     source_path: str,
     saving_path: str,
+    dtype: str = "float32",
 ):
     
     """
@@ -380,6 +694,11 @@ def load_data_lfp_DBScope(
     from the channel of interest. It also returns the whole LFP recording (in an
     array), the names of all the channels recorded, the sampling frequency of the
     LFP recording and the index of the channel of interest in the LFP recording.
+    Only the header and the requested trial are decoded: in v7.3 (HDF5) files,
+    the other trials are never read. Older .mat files (v5) are read as a
+    stream: the other trials are skipped without being stored, and without
+    being read if the file is not compressed. A compressed file is inflated
+    up to the end of the requested trial, as zlib streams cannot be seeked.
 
     Inputs:
             - session_ID: str, subject ID
@@ -390,6 +709,7 @@ def load_data_lfp_DBScope(
             "Select recording" - 1.
             - source_path: str, path to the source file
             - saving_path: str, path to save the parameters
+            - dtype: str, data type of the returned recording
 
     Returns:
             - LFP_array: np.ndarray, the LFP recording containing
@@ -407,18 +727,31 @@ def load_data_lfp_DBScope(
     if type(trial_idx_lfp) == float:
         trial_idx_lfp = int(trial_idx_lfp)
 
-    # load the mat file from DBScope:
-    mat = scipy.io.loadmat(join(source_path, fname_lfp))
+    file_path = join(source_path, fname_lfp)
 
     # extract the necessary information needed for synchronization:
     # We need: LFP_array, lfp_sig, LFP_rec_ch_names, sf_LFP
-    sf_LFP = mat["lfp_raw"]["hdr"][0][0]["fs"][0][0][0][0]
-    LFP_rec_ch_names = [
-        mat["lfp_raw"]["hdr"][0][0]["channel_names"][0][0][0][trial_idx_lfp][0][0][0],
-        mat["lfp_raw"]["hdr"][0][0]["channel_names"][0][0][0][trial_idx_lfp][0][1][0],
-    ]
-    LFP_array = mat["lfp_raw"]["trial"][0][0][0][trial_idx_lfp]
-    lfp_sig = mat["lfp_raw"]["trial"][0][0][0][trial_idx_lfp][ch_idx_lfp]
+    if _is_mat_v73(file_path):
+        # HDF5 file: datasets are only read when accessed
+        with h5py.File(file_path, "r") as f:
+            hdr = f["lfp_raw"]["hdr"]
+            sf_LFP = hdr["fs"][()].item()
+            names_ref = hdr["channel_names"][()].ravel()[trial_idx_lfp]
+            LFP_rec_ch_names = [
+                _h5_string(f, ref) for ref in f[names_ref][()].ravel()
+            ]
+            trial_ref = f["lfp_raw"]["trial"][()].ravel()[trial_idx_lfp]
+            # MATLAB arrays are stored transposed: (samples, channels)
+            LFP_array = np.ascontiguousarray(f[trial_ref].astype(dtype)[()].T)
+    else:
+        # read only the header and the requested trial of lfp_raw:
+        lfp_raw = _read_mat5_variable(
+            file_path, "lfp_raw", fields=("hdr", "trial"), items={"trial": trial_idx_lfp}
+        )
+        sf_LFP = lfp_raw["hdr"]["fs"].item()
+        LFP_rec_ch_names = list(lfp_raw["hdr"]["channel_names"][trial_idx_lfp][:2])
+        LFP_array = np.ascontiguousarray(lfp_raw["trial"], dtype=dtype)
+    lfp_sig = LFP_array[ch_idx_lfp]
     time_duration_LFP = len(lfp_sig) / sf_LFP
 
 
@@ -443,7 +776,8 @@ def load_TMSi_artifact_channel(
     TMSi_data, 
     fname_external: str, 
     BIP_ch_name: str, 
-    saving_path: str
+    saving_path: str,
+    channels: list = None
     ):
 
     """
@@ -456,18 +790,24 @@ def load_TMSi_artifact_channel(
 
     Input:
             - session_ID: str, subject ID
-            - TMSi_data: TMSiFileFormats.file_readers.poly5reader.Poly5Reader
+            - TMSi_data: TMSiFileFormats.file_readers.poly5reader.Poly5Reader,
+        if it was opened with mmap=True, only the bipolar channel is read
+        and external_file is returned as a lazy Poly5SampleView. Use
+        TMSi_data.read_data_MNE() if an MNE Raw object is needed.
             - fname_external: str, name of the external recording session
             - BIP_ch_name: str, name of the bipolar channel, containing the artifacts
             - saving_path: str, path to save the parameters
+            - channels: list or None, names of the channels to keep in
+        addition to the bipolar channel. None (default) keeps all the channels.
 
     Returns:
-            - external_file: np.ndarray, the external recording
-        containing all recorded channels
+            - external_file: np.ndarray or Poly5SampleView, the external
+        recording containing all recorded channels (or only the selected ones,
+        decoded in memory)
             - BIP_channel: np.ndarray, the channel of the external
         recording to be used for synchronization (the one containing deep brain
         stimulation artifacts = the channel recorded with the bipolar
-        electrode)
+        electrode), a view of external_file if it was decoded in memory
             - external_rec_ch_names: list, the names of all the channels
         recorded externally
             - sf_external: int, sampling frequency of external recording
@@ -475,18 +815,27 @@ def load_TMSi_artifact_channel(
                     (BIP_channel)
     """
 
-    # Conversion of .Poly5 to MNE raw array
-    toMNE = True
-    TMSi_rec = TMSi_data.read_data_MNE()
-    external_rec_ch_names = TMSi_rec.ch_names
+    # Samples are taken directly from the reader, converted to volts in place
+    # (no MNE object). For a memory-mapped recording, only the bipolar channel
+    # is read for artifact detection, the other channels stay on disk until
+    # the recordings are synchronized.
+    external_rec_ch_names = TMSi_data.ch_names
     
     assert BIP_ch_name in external_rec_ch_names, "{} is not in externally recorded channels. Please choose from the available channels: {}".format(BIP_ch_name, external_rec_ch_names)
 
-    time_duration_TMSi_s = (TMSi_rec.n_times / TMSi_rec.info["sfreq"]).astype(float)
-    sf_external = int(TMSi_rec.info["sfreq"])
-    ch_index = TMSi_rec.ch_names.index(BIP_ch_name)
-    BIP_channel = TMSi_rec.get_data()[ch_index]
-    external_file = TMSi_rec.get_data()
+    time_duration_TMSi_s = TMSi_data.num_samples / TMSi_data.sample_rate
+    sf_external = int(TMSi_data.sample_rate)
+    ch_index = external_rec_ch_names.index(BIP_ch_name)
+    external_file = TMSi_data.read_data_numpy()
+    if channels is not None:
+        selected = [
+            i for i, ch in enumerate(external_rec_ch_names)
+            if ch in channels or ch == BIP_ch_name
+        ]
+        external_file = np.ascontiguousarray(external_file[selected])
+        external_rec_ch_names = [external_rec_ch_names[i] for i in selected]
+        ch_index = external_rec_ch_names.index(BIP_ch_name)
+    BIP_channel = external_file[ch_index]
 
     dictionary = {
         "FNAME_EXTERNAL": fname_external, 
@@ -4,12 +4,16 @@ import matplotlib.pyplot as plt
 from matplotlib.pyplot import figure
 import mne
 from os.path import join
-import json
+import os
 import matplotlib
 
-matplotlib.use("Qt5Agg")
+# the interactive Qt backend is used, unless another backend is set in the
+# MPLBACKEND environment variable (e.g. MPLBACKEND=Agg on a compute node).
+# Without Qt (e.g. headless runs), matplotlib keeps its default backend.
+if "MPLBACKEND" not in os.environ:
+    matplotlib.use("Qt5Agg", force=False)
 
-from functions.utils import _detrend_data
+from functions.utils import _detrend_data, _load_params
 
 
 ## set font sizes and other parameters for the figures
@@ -89,7 +93,7 @@ def plot_channel(
 def plot_LFP_stim(
     session_ID: str,
     timescale: np.ndarray,
-    LFP_rec: mne.io.array.array.RawArray,
+    LFP_rec: mne.io.RawArray,
     saving_path: str,
     saving_folder=True,
 ):
@@ -100,7 +104,7 @@ def plot_LFP_stim(
     Input:
         - session_ID: str, the subject ID
         - timescale: np.ndarray, the timescale of the signal to be plotted
-        - LFP_rec: mne.io.array.array.RawArray (LFP recording as MNE object)
+        - LFP_rec: mne.io.RawArray (LFP recording as MNE object)
         - saving_path: str, the folder where the plot has to be saved
         - saving_folder: Boolean, default = True, plots automatically saved
 
@@ -255,9 +259,7 @@ def ecg(
     """
 
     # import settings
-    json_filename = join(saving_path, "parameters_" + str(session_ID) + ".json")
-    with open(json_filename, "r") as f:
-        loaded_dict = json.load(f)
+    loaded_dict = _load_params(session_ID, saving_path)
 
     # Reselect artifact channels in the aligned (= cropped) files
     LFP_channel_offset = LFP_synchronized[:, loaded_dict["CH_IDX_LFP"]]
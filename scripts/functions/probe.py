@@ -0,0 +1,587 @@
+"""
+Header-only metadata of the supported recording formats
+"""
+
+import os
+import re
+import zlib
+import struct
+import collections
+import numpy as np
+import pandas as pd
+import h5py
+from os.path import join
+
+from functions.tmsi_poly5reader import Poly5Reader
+from functions.utils import _is_mat_v73, _h5_string
+
+
+def probe_recording(
+    filename: str,
+    source_path: str,
+    PREPROCESSING: str = "Perceive",
+    trial_idx_lfp: int = None,
+):
+    """
+    Reads the metadata of a recording without loading its samples, when the
+    file format allows it:
+        - .Poly5: only the file header and the signal description are read
+        - .mat v7.3 (HDF5): only the header fields are read, the samples are
+        never decoded
+        - .mat (older versions): each variable is compressed as a whole, so
+        it is decompressed as a stream: only the header fields are parsed,
+        the samples are skipped without being stored. The decompression
+        still takes a time proportional to the size of the file.
+        - .csv: only the first line is parsed. The number of samples is
+        estimated from the size of the file and the length of the rows of
+        its first MB (it is exact for smaller files). The sampling frequency
+        is read in the filename (e.g. "..._250Hz.csv")
+
+    Inputs:
+        - filename: str, name of the recording
+        - source_path: str, path to the source file
+        - PREPROCESSING: str, "Perceive" or "DBScope", only used for .mat files
+        - trial_idx_lfp: int, only used if PREPROCESSING is 'DBScope'. It
+        corresponds to the number indicated in the DBScope viewer for
+        Streamings, under "Select recording" - 1.
+
+    Returns:
+        - metadata: dict, with keys
+            "sf": sampling frequency (Hz)
+            "ch_names": list of the channel names
+            "n_samples": number of samples per channel
+            "start_time": datetime.datetime of the recording start, None
+            when the format does not store it
+            "duration": duration of the recording (s)
+    """
+
+    file_path = join(source_path, filename)
+
+    if filename.endswith(".Poly5"):
+        metadata = _probe_poly5(file_path)
+    elif filename.endswith(".mat") and PREPROCESSING == "DBScope":
+        if type(trial_idx_lfp) == float:
+            trial_idx_lfp = int(trial_idx_lfp)
+        metadata = _probe_mat_DBScope(file_path, trial_idx_lfp)
+    elif filename.endswith(".mat"):
+        metadata = _probe_mat_fieldtrip(file_path)
+    elif filename.endswith(".csv"):
+        metadata = _probe_csv(file_path, filename)
+    else:
+        raise ValueError(f"Unsupported recording format: {filename}")
+
+    metadata["duration"] = metadata["n_samples"] / metadata["sf"]
+
+    return metadata
+
+
+def probe_manifest(
+    df: pd.DataFrame,
+    source_path: str,
+    PREPROCESSING: str = "Perceive",
+):
+    """
+    Reads the metadata of all the recordings listed in the batch manifest
+    (recording_information.xlsx) that are not done yet. A file that cannot
+    be probed is reported in the "error" column instead of stopping.
+
+    Inputs:
+        - df: pd.DataFrame, content of the manifest
+        - source_path: str, path to the source files
+        - PREPROCESSING: str, "Perceive" or "DBScope"
+
+    Returns:
+        - probed: pd.DataFrame, one row per recording with the columns
+        session_ID, recording ("intracranial" or "external"), filename, sf,
+        n_channels, n_samples, start_time, duration and error
+    """
+
+    rows = []
+    for index, row in df.iterrows():
+        if row["done"] == "yes" or pd.isna(row["session_ID"]):
+            continue
+        trial_idx_lfp = row["trial_idx_LFP"] if "trial_idx_LFP" in row else None
+        for recording, filename in (
+            ("intracranial", row["fname_lfp"]),
+            ("external", row["fname_external"]),
+        ):
+            if pd.isna(filename):
+                continue
+            probed = {
+                "session_ID": row["session_ID"],
+                "recording": recording,
+                "filename": filename,
+            }
+            try:
+                metadata = probe_recording(
+                    filename,
+                    source_path,
+                    PREPROCESSING=PREPROCESSING if recording == "intracranial" else None,
+                    trial_idx_lfp=trial_idx_lfp,
+                )
+                probed.update(
+                    {
+                        "sf": metadata["sf"],
+                        "n_channels": len(metadata["ch_names"]),
+                        "n_samples": metadata["n_samples"],
+                        "start_time": metadata["start_time"],
+                        "duration": metadata["duration"],
+                        "error": None,
+                    }
+                )
+            except Exception as e:
+                probed["error"] = repr(e)
+            rows.append(probed)
+
+    return pd.DataFrame(
+        rows,
+        columns=[
+            "session_ID",
+            "recording",
+            "filename",
+            "sf",
+            "n_channels",
+            "n_samples",
+            "start_time",
+            "duration",
+            "error",
+        ],
+    )
+
+
+def estimate_session_memory(probed_session: pd.DataFrame, dtype: str = "float32"):
+    """
+    Estimates the peak memory used by the analysis of a session, from the
+    metadata of its recordings (see probe_manifest). The estimate counts:
+        - the intracranial and external recordings loaded in dtype, and their
+        synchronized copies
+        - the float64 copies of the artifact channels used for detection
+        (about 4 per channel: raw, detrended, filter work arrays)
+        - a fixed overhead for the Python process and its libraries (300 MB)
+
+    Inputs:
+        - probed_session: pd.DataFrame, rows of probe_manifest of the session
+        - dtype: str, data type of the recordings, "float32" or "float64"
+
+    Returns:
+        - memory: int, estimated peak memory (bytes), or None if a recording
+        of the session could not be probed
+    """
+
+    if len(probed_session) == 0 or probed_session["error"].notna().any():
+        return None
+
+    itemsize = np.dtype(dtype).itemsize
+    memory = 300 * 1024**2
+    for _, recording in probed_session.iterrows():
+        n_samples = int(recording["n_samples"])
+        memory += 2 * int(recording["n_channels"]) * n_samples * itemsize
+        memory += 4 * n_samples * np.dtype(np.float64).itemsize
+
+    return memory
+
+
+def _probe_poly5(file_path: str):
+    # readAll=False only parses the header and the signal description
+    TMSi_data = Poly5Reader(file_path, readAll=False, verbose=False)
+    TMSi_data.close()
+
+    return {
+        "sf": TMSi_data.sample_rate,
+        "ch_names": TMSi_data.ch_names,
+        "n_samples": TMSi_data.num_samples,
+        "start_time": TMSi_data.start_time,
+    }
+
+
+def _probe_csv(file_path: str, filename: str):
+    sf = int(re.search(r"(\d+)Hz", filename).group(1))
+    ch_names = list(pd.read_csv(file_path, nrows=0).columns)
+
+    file_size = os.path.getsize(file_path)
+    with open(file_path, "rb") as f:
+        block = f.read(CSV_PROBE_BYTES)
+    header_end = block.index(b"\n") + 1
+
+    if len(block) == file_size:
+        # the whole file was read: the rows are counted
+        n_samples = block.count(b"\n", header_end)
+        if not block.endswith(b"\n"):
+            n_samples += 1  # last line without line break
+    else:
+        # the number of rows is estimated from the length of the first ones
+        rows_end = block.rindex(b"\n") + 1
+        bytes_per_row = (rows_end - header_end) / block.count(b"\n", header_end)
+        n_samples = round((file_size - header_end) / bytes_per_row)
+
+    return {
+        "sf": sf,
+        "ch_names": ch_names,
+        "n_samples": n_samples,
+        "start_time": None,
+    }
+
+
+def _probe_mat_fieldtrip(file_path: str):
+    if _is_mat_v73(file_path):
+        with h5py.File(file_path, "r") as f:
+            data = f["data"]
+            if "fsample" in data:
+                sf = float(np.squeeze(data["fsample"][()]))
+            else:
+                # first trial's time vector, as in mne.io.read_raw_fieldtrip
+                time_ref = data["time"][()].ravel()[0]
+                sf = _sfreq_from_time(f[time_ref][:2].ravel())
+            ch_names = [_h5_string(f, ref) for ref in data["label"][()].ravel()]
+            # MATLAB arrays are stored transposed: (samples, channels)
+            trials = data["trial"][()].ravel()
+            n_samples = sum(f[ref].shape[0] for ref in trials)
+
+    else:
+        data = _read_mat5_variable(
+            file_path, "data", fields=("fsample", "label", "trial", "time")
+        )
+        if "fsample" in data:
+            sf = float(np.squeeze(data["fsample"]))
+        else:
+            time = data["time"][0] if isinstance(data["time"], list) else data["time"]
+            if isinstance(time, Mat5SkippedArray):
+                time = time.head
+            sf = _sfreq_from_time(np.ravel(time))
+        ch_names = list(np.atleast_1d(data["label"]))
+        trials = data["trial"] if isinstance(data["trial"], list) else [data["trial"]]
+        n_samples = sum(trial.shape[-1] for trial in trials)
+
+    return {
+        "sf": sf,
+        "ch_names": ch_names,
+        "n_samples": n_samples,
+        "start_time": None,
+    }
+
+
+def _sfreq_from_time(time: np.ndarray):
+    "Sampling frequency of a time vector (s), from its first two values"
+
+    if len(time) < 2:
+        raise ValueError("No Source for sfreq found")
+    return 1.0 / float(time[1] - time[0])
+
+
+def _probe_mat_DBScope(file_path: str, trial_idx_lfp: int):
+    if _is_mat_v73(file_path):
+        with h5py.File(file_path, "r") as f:
+            hdr = f["lfp_raw"]["hdr"]
+            sf = float(np.squeeze(hdr["fs"][()]))
+            names_ref = hdr["channel_names"][()].ravel()[trial_idx_lfp]
+            ch_names = [_h5_string(f, ref) for ref in f[names_ref][()].ravel()]
+            trial_ref = f["lfp_raw"]["trial"][()].ravel()[trial_idx_lfp]
+            # MATLAB arrays are stored transposed: (samples, channels)
+            n_samples = f[trial_ref].shape[0]
+
+    else:
+        lfp_raw = _read_mat5_variable(file_path, "lfp_raw", fields=("hdr", "trial"))
+        sf = float(np.squeeze(lfp_raw["hdr"]["fs"]))
+        ch_names = list(lfp_raw["hdr"]["channel_names"][trial_idx_lfp][:2])
+        n_samples = lfp_raw["trial"][trial_idx_lfp].shape[-1]
+
+    return {
+        "sf": sf,
+        "ch_names": ch_names,
+        "n_samples": n_samples,
+        "start_time": None,
+    }
+
+
+# Streaming reader of the header fields of MAT-files v5 (see the "MAT-File
+# Format" documentation of MathWorks): each variable is a miMATRIX data
+# element, usually compressed in a miCOMPRESSED element.
+_MI_DTYPES = {
+    1: "i1", 2: "u1", 3: "i2", 4: "u2", 5: "i4", 6: "u4", 7: "f4", 9: "f8",
+    12: "i8", 13: "u8", 16: "u1", 17: "u2", 18: "u4",
+}
+_MI_MATRIX, _MI_COMPRESSED = 14, 15
+_MX_CELL, _MX_STRUCT, _MX_OBJECT, _MX_CHAR = 1, 2, 3, 4
+# arrays larger than this (the samples) are skipped, only their first
+# values are kept (e.g. to compute a sampling frequency from a time vector)
+_MAT5_MAX_ARRAY_BYTES = 1 << 16
+_MAT5_HEAD_VALUES = 8
+
+# large array of a MAT-file that was skipped: its shape and first values
+Mat5SkippedArray = collections.namedtuple("Mat5SkippedArray", ["shape", "head"])
+
+# bytes read at the beginning of a csv file to estimate its number of rows
+CSV_PROBE_BYTES = 1 << 20
+
+
+class _Mat5Stream:
+    "Sequential reader of n_bytes of a file, inflated if compressed"
+
+    def __init__(self, f, n_bytes: int, compressed: bool):
+        self.f = f
+        self.remaining = n_bytes  # bytes of the file not read yet
+        self.inflater = zlib.decompressobj() if compressed else None
+        self.buffer = b""
+        self.position = 0  # bytes returned or skipped
+
+    def read(self, n: int):
+        parts, size = [self.buffer], len(self.buffer)
+        while size < n:
+            data = self._more(n - size)
+            if not data:
+                raise EOFError("Unexpected end of the MAT-file")
+            parts.append(data)
+            size += len(data)
+        data = b"".join(parts)
+        data, self.buffer = data[:n], data[n:]
+        self.position += n
+        return data
+
+    def skip(self, n: int):
+        """
+        Skips n bytes without keeping them: they are not read if the stream
+        is not compressed, otherwise they are still inflated
+        """
+        if self.inflater is None and n > len(self.buffer):
+            seek = min(n - len(self.buffer), self.remaining)
+            self.f.seek(seek, os.SEEK_CUR)
+            self.remaining -= seek
+            self.position += len(self.buffer) + seek
+            n -= len(self.buffer) + seek
+            self.buffer = b""
+            if n > 0:
+                raise EOFError("Unexpected end of the MAT-file")
+            return
+        while n > 0:
+            if not self.buffer:
+                self.buffer = self._more(min(n, 1 << 20))
+                if not self.buffer:
+                    raise EOFError("Unexpected end of the MAT-file")
+            skipped = min(n, len(self.buffer))
+            self.buffer = self.buffer[skipped:]
+            self.position += skipped
+            n -= skipped
+
+    def _more(self, n: int):
+        "At most n new bytes, empty at the end of the stream"
+        if self.inflater is None:
+            data = self.f.read(min(n, self.remaining))
+            self.remaining -= len(data)
+            return data
+        while True:
+            if self.inflater.unconsumed_tail:
+                compressed = self.inflater.unconsumed_tail
+            elif self.remaining > 0:
+                compressed = self.f.read(min(1 << 16, self.remaining))
+                self.remaining -= len(compressed)
+            else:
+                return b""
+            data = self.inflater.decompress(compressed, n)
+            if data:
+                return data
+
+
+def _read_mat5_variable(
+    file_path: str, variable_name: str, fields: tuple = None, items: dict = None
+):
+    """
+    Reads a variable of a MAT-file v5 (saved by MATLAB before v7.3) without
+    storing its large arrays: they are returned as Mat5SkippedArray.
+
+    Inputs:
+        - file_path: str, path to the .mat file
+        - variable_name: str, name of the variable to read
+        - fields: tuple of str, if the variable is a struct, only these
+        fields are read, the others are skipped
+        - items: dict, {field name: index}, if the variable is a struct whose
+        fields are cells: only the element at index of these cells is
+        returned (instead of the cell), read in full even if it is large.
+        The other elements are skipped.
+
+    Returns:
+        - value: the variable, with structs as dict (list of dict for struct
+        arrays), cells as lists (in MATLAB order), char arrays as str (list
+        of str for several rows) and the other arrays as np.ndarray
+    """
+
+    with open(file_path, "rb") as f:
+        header = f.read(128)
+        endian = "<" if header[126:128] == b"IM" else ">"
+        while True:
+            tag = f.read(8)
+            if len(tag) < 8:
+                raise KeyError(f"{variable_name} is not a variable of {file_path}")
+            mtype, n_bytes = struct.unpack(endian + "II", tag)
+            start = f.tell()
+            compressed = mtype == _MI_COMPRESSED
+            stream = _Mat5Stream(f, n_bytes, compressed)
+            matrix_type, matrix_bytes = (
+                struct.unpack(endian + "II", stream.read(8)) if compressed
+                else (mtype, n_bytes)
+            )
+            if matrix_type == _MI_MATRIX and matrix_bytes > 0:
+                name, value = _read_mat5_matrix(
+                    stream,
+                    endian,
+                    fields=fields,
+                    variable_name=variable_name,
+                    items=items,
+                    partial=True,
+                )
+                if name == variable_name:
+                    return value
+            # next variable: uncompressed data elements are aligned on 8 bytes
+            f.seek(start + n_bytes + (0 if compressed else -n_bytes % 8))
+
+
+def _read_mat5_element(stream: _Mat5Stream, endian: str, max_bytes: int = None):
+    """
+    Reads a data element: returns its type and its data, only the first
+    _MAT5_HEAD_VALUES values when it is larger than max_bytes
+    """
+
+    tag = stream.read(8)
+    mtype, n_bytes = struct.unpack(endian + "II", tag)
+    if mtype >> 16:
+        # small data element: the data is in the last 4 bytes of the tag
+        small_bytes, mtype = mtype >> 16, mtype & 0xFFFF
+        return mtype, tag[4 : 4 + small_bytes], small_bytes
+
+    if max_bytes is not None and n_bytes > max_bytes:
+        head_bytes = _MAT5_HEAD_VALUES * np.dtype(_MI_DTYPES[mtype]).itemsize
+        data = stream.read(head_bytes)
+        stream.skip(n_bytes - head_bytes + (-n_bytes % 8))
+    else:
+        data = stream.read(n_bytes)
+        stream.skip(-n_bytes % 8)
+
+    return mtype, data, n_bytes
+
+
+def _read_mat5_value(
+    stream: _Mat5Stream,
+    endian: str,
+    item: int = None,
+    max_bytes: int = _MAT5_MAX_ARRAY_BYTES,
+    partial: bool = False,
+):
+    """
+    Reads a miMATRIX element (field of a struct or element of a cell). If
+    item is given, the element is a cell and only its element at this index
+    is returned. If partial, the stream is left after the last byte needed
+    instead of the end of the element.
+    """
+
+    mtype, n_bytes = struct.unpack(endian + "II", stream.read(8))
+    if mtype != _MI_MATRIX or n_bytes == 0:
+        stream.skip(n_bytes)
+        return np.zeros(0)
+    end = stream.position + n_bytes
+    _, value = _read_mat5_matrix(
+        stream, endian, item=item, max_bytes=max_bytes, partial=partial
+    )
+    if not partial:
+        stream.skip(end - stream.position)  # e.g. imaginary part, sparse indices
+
+    return value
+
+
+def _skip_mat5_element(stream: _Mat5Stream, endian: str):
+    "Skips a data element (e.g. a field of a struct that is not requested)"
+
+    _, n_bytes = struct.unpack(endian + "II", stream.read(8))
+    stream.skip(n_bytes)
+
+
+def _read_mat5_matrix(
+    stream,
+    endian,
+    fields=None,
+    variable_name=None,
+    items=None,
+    item=None,
+    max_bytes=_MAT5_MAX_ARRAY_BYTES,
+    partial=False,
+):
+    """
+    Reads the content of a miMATRIX element, returns its name and its value
+    (None if its name is not variable_name, when given). fields and items
+    select the fields of a struct, item the element of a cell (see
+    _read_mat5_variable), arrays larger than max_bytes are skipped. If
+    partial, the reading stops as soon as the requested fields of a scalar
+    struct are read: the stream is then left in the middle of the element.
+    """
+
+    _, flags, _ = _read_mat5_element(stream, endian)
+    mx_class = np.frombuffer(flags, endian + "u4")[0] & 0xFF
+    _, dims, _ = _read_mat5_element(stream, endian)
+    shape = tuple(int(dim) for dim in np.frombuffer(dims, endian + "i4"))
+    _, name, _ = _read_mat5_element(stream, endian)
+    name = name.decode("ascii")
+    if variable_name is not None and name != variable_name:
+        return name, None
+    n_elements = int(np.prod(shape))
+
+    if mx_class == _MX_CELL:
+        if item is None:
+            return name, [
+                _read_mat5_value(stream, endian, max_bytes=max_bytes)
+                for _ in range(n_elements)
+            ]
+        if not 0 <= item < n_elements:
+            raise IndexError(
+                f"index {item} is out of bounds for the cell {name} of {n_elements} elements"
+            )
+        for _ in range(item):
+            _skip_mat5_element(stream, endian)
+        return name, _read_mat5_value(stream, endian, max_bytes=None, partial=partial)
+
+    if mx_class in (_MX_STRUCT, _MX_OBJECT):
+        if mx_class == _MX_OBJECT:
+            _read_mat5_element(stream, endian)  # class name
+        _, name_length, _ = _read_mat5_element(stream, endian)
+        name_length = int(np.frombuffer(name_length, endian + "i4")[0])
+        _, field_names, _ = _read_mat5_element(stream, endian)
+        field_names = [
+            field_names[i : i + name_length].split(b"\0")[0].decode("ascii")
+            for i in range(0, len(field_names), name_length)
+        ]
+        # scalar struct: the fields after the requested ones are not read
+        stop_early = partial and fields is not None and n_elements == 1
+        n_requested = len(set(field_names) & set(fields or ()))
+        items = items or {}
+        elements = []
+        for _ in range(n_elements):
+            element = {}
+            for field_name in field_names:
+                if stop_early and len(element) == n_requested:
+                    break
+                if fields is None or field_name in fields:
+                    element[field_name] = _read_mat5_value(
+                        stream,
+                        endian,
+                        item=items.get(field_name),
+                        max_bytes=max_bytes,
+                        partial=stop_early and len(element) == n_requested - 1,
+                    )
+                else:
+                    _skip_mat5_element(stream, endian)
+            elements.append(element)
+        return name, elements[0] if n_elements == 1 else elements
+
+    mtype, data, n_bytes = _read_mat5_element(stream, endian, max_bytes=max_bytes)
+    values = np.frombuffer(data, endian + _MI_DTYPES[mtype])
+    if len(data) < n_bytes:
+        return name, Mat5SkippedArray(shape, values)
+
+    if mx_class == _MX_CHAR:
+        if values.size == 0:
+            return name, ""
+        if mtype == 16:
+            values = np.frombuffer(data.decode("utf-8").encode("utf-32-le"), "<u4")
+        rows = np.reshape(values, shape, order="F").reshape(shape[0], -1)
+        rows = ["".join(chr(c) for c in row) for row in rows]
+        return name, rows[0] if len(rows) == 1 else rows
+
+    return name, np.reshape(values, shape, order="F")
+
@@ -0,0 +1,274 @@
+"""
+Index of the results of all sessions in a SQLite database
+
+The parameters of each session are saved in results/<session_ID>/parameters_<session_ID>.json.
+Each run of main or main_batch also saves them, with the status and the
+duration of the run and the files written, in results/results_index.sqlite,
+so the sessions can be selected without reading all the json files, e.g.:
+
+    python scripts/functions/results_index.py query "abs(timeshift_ms) > 100"
+    python scripts/functions/results_index.py query "method = 'manual'"
+    python scripts/functions/results_index.py backfill
+
+This module only depends on the standard library and pandas, so that it can
+be run on its own.
+"""
+
+import os
+import json
+import sqlite3
+import argparse
+import datetime
+import pandas as pd
+from os.path import join
+
+
+INDEX_FILENAME = "results_index.sqlite"
+
+# columns of the sessions table filled from the parameters of the session:
+# column name: (parameter key, SQLite type)
+INDEXED_PARAMETERS = {
+    "subject_ID": ("SUBJECT_ID", "TEXT"),
+    "fname_lfp": ("FNAME_LFP", "TEXT"),
+    "fname_external": ("FNAME_EXTERNAL", "TEXT"),
+    "sf_lfp": ("sf_LFP", "REAL"),
+    "sf_external": ("sf_EXTERNAL", "REAL"),
+    "art_time_bip": ("ART_TIME_BIP", "REAL"),
+    "art_time_lfp": ("ART_TIME_LFP", "REAL"),
+    "method": ("METHOD", "TEXT"),
+    "method_confidence": ("METHOD_CONFIDENCE", "REAL"),
+    "alignment_offset_ms": ("ALIGNMENT_OFFSET_MS", "REAL"),
+    "drift_correction_ppm": ("DRIFT_CORRECTION_PPM", "REAL"),
+    "timeshift_mode": ("TIMESHIFT_MODE", "TEXT"),
+    "timeshift_ms": ("TIMESHIFT", "REAL"),
+    "drift_ppm": ("DRIFT_PPM", "REAL"),
+    "saving_format": ("SAVING_FORMAT", "TEXT"),
+}
+# other columns: the run that saved the session
+RUN_COLUMNS = {
+    "status": "TEXT",
+    "error": "TEXT",
+    "duration_s": "REAL",
+    "saving_path": "TEXT",
+    "output_files": "TEXT",  # json list of the files of saving_path
+    "parameters": "TEXT",  # json of all the parameters
+    "updated_at": "TEXT",
+}
+INDEXED_COLUMNS = ("subject_ID", "method", "timeshift_ms", "status")
+
+
+def open_results_index(results_path: str):
+    """
+    Opens the index of the results folder, and creates it if needed.
+
+    Inputs:
+        - results_path: str, the results folder
+
+    Returns:
+        - connection: sqlite3.Connection, to be closed by the caller
+    """
+
+    # several worker processes can save their session at the same time: the
+    # writes wait for each other up to the timeout
+    connection = sqlite3.connect(join(results_path, INDEX_FILENAME), timeout=60)
+    columns = [f"{name} {sql_type}" for name, (_, sql_type) in INDEXED_PARAMETERS.items()]
+    columns += [f"{name} {sql_type}" for name, sql_type in RUN_COLUMNS.items()]
+    with connection:
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS sessions "
+            f"(session_ID TEXT PRIMARY KEY, {', '.join(columns)})"
+        )
+        for column in INDEXED_COLUMNS:
+            connection.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_sessions_{column} ON sessions ({column})"
+            )
+
+    return connection
+
+
+def index_session(
+    session_ID: str,
+    results_path: str,
+    parameters: dict = None,
+    status: str = None,
+    error: str = None,
+    duration_s: float = None,
+):
+    """
+    Saves a session in the index of the results folder, replacing its
+    previous entry.
+
+    Inputs:
+        - session_ID: str, the session identifier
+        - results_path: str, the results folder, containing the folder of the
+        session
+        - parameters: dict, the parameters of the session, None to read them
+        from its json file (empty if the session has no json file yet)
+        - status: str, the status of the run (see batch.run_sessions), None
+        if unknown
+        - error: str, the error of the run, None if it did not fail
+        - duration_s: float, the duration of the run (s), None if unknown
+    """
+
+    saving_path = join(results_path, str(session_ID))
+    if parameters is None:
+        parameters = _read_parameters(session_ID, saving_path)
+    if os.path.isdir(saving_path):
+        output_files = sorted(
+            filename for filename in os.listdir(saving_path)
+            if not filename.endswith(".tmp")
+        )
+    else:
+        output_files = []
+
+    row = {"session_ID": str(session_ID)}
+    for name, (key, _) in INDEXED_PARAMETERS.items():
+        row[name] = _to_sql(parameters.get(key))
+    row.update(
+        {
+            "status": status,
+            "error": error,
+            "duration_s": duration_s,
+            "saving_path": saving_path,
+            "output_files": json.dumps(output_files),
+            "parameters": json.dumps(parameters, default=str),
+            "updated_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        }
+    )
+
+    connection = open_results_index(results_path)
+    try:
+        with connection:
+            connection.execute(
+                f"INSERT OR REPLACE INTO sessions ({', '.join(row)}) "
+                f"VALUES ({', '.join('?' * len(row))})",
+                list(row.values()),
+            )
+    finally:
+        connection.close()
+
+
+def backfill_results_index(results_path: str):
+    """
+    Saves in the index all the sessions of the results folder that have a
+    parameters json file, e.g. those analyzed before the index existed. The
+    status, error and duration of the sessions already in the index are
+    kept.
+
+    Inputs:
+        - results_path: str, the results folder
+
+    Returns:
+        - n_sessions: int, number of sessions saved
+    """
+
+    connection = open_results_index(results_path)
+    try:
+        runs = {
+            session_ID: (status, error, duration_s)
+            for session_ID, status, error, duration_s in connection.execute(
+                "SELECT session_ID, status, error, duration_s FROM sessions"
+            )
+        }
+    finally:
+        connection.close()
+
+    n_sessions = 0
+    for session_ID in sorted(os.listdir(results_path)):
+        json_file_path = join(
+            results_path, session_ID, "parameters_" + session_ID + ".json"
+        )
+        if not os.path.isfile(json_file_path):
+            continue
+        status, error, duration_s = runs.get(session_ID, (None, None, None))
+        index_session(
+            session_ID,
+            results_path,
+            status=status,
+            error=error,
+            duration_s=duration_s,
+        )
+        n_sessions += 1
+
+    return n_sessions
+
+
+def query_results_index(
+    results_path: str, where: str = None, arguments: tuple = (), columns: list = None
+):
+    """
+    Selects sessions in the index of the results folder.
+
+    Inputs:
+        - results_path: str, the results folder
+        - where: str, SQL condition on the columns of the sessions table, e.g.
+        "abs(timeshift_ms) > 100" or "method = ?", None to select all sessions
+        - arguments: tuple, values of the ? of the condition
+        - columns: list of str, columns to return, None for all of them
+
+    Returns:
+        - sessions: pd.DataFrame, one row per session selected, sorted by
+        session_ID
+    """
+
+    query = f"SELECT {', '.join(columns) if columns else '*'} FROM sessions"
+    if where:
+        query += f" WHERE {where}"
+    query += " ORDER BY session_ID"
+
+    connection = open_results_index(results_path)
+    try:
+        sessions = pd.read_sql_query(query, connection, params=tuple(arguments))
+    finally:
+        connection.close()
+
+    return sessions
+
+
+def _read_parameters(session_ID: str, saving_path: str):
+    "Parameters saved in the json file of a session, empty if there is none"
+
+    json_file_path = join(saving_path, "parameters_" + str(session_ID) + ".json")
+    if not os.path.isfile(json_file_path):
+        return {}
+    with open(json_file_path, "r") as json_file:
+        return json.load(json_file)
+
+
+def _to_sql(value):
+    "Value of a parameter as stored in its column (lists are stored as json)"
+
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return json.dumps(value, default=str)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Query the index of the results of all sessions."
+    )
+    parser.add_argument(
+        "--results", default="results", help="results folder (default: results)"
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser(
+        "backfill", help="index the sessions of the results folder from their json files"
+    )
+    query_parser = commands.add_parser("query", help="print the sessions selected")
+    query_parser.add_argument(
+        "where", nargs="?", help="SQL condition, e.g. \"method = 'manual'\""
+    )
+    query_parser.add_argument(
+        "--columns",
+        default="session_ID,status,method,method_confidence,timeshift_ms",
+        help="comma-separated columns to print, * for all",
+    )
+    args = parser.parse_args()
+
+    if args.command == "backfill":
+        n_sessions = backfill_results_index(args.results)
+        print(f"{n_sessions} sessions indexed in {join(args.results, INDEX_FILENAME)}")
+    else:
+        columns = None if args.columns == "*" else args.columns.split(",")
+        sessions = query_results_index(args.results, args.where, columns=columns)
+        print(sessions.to_string(index=False))
@@ -3,6 +3,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 from os.path import join
 import pickle
+from concurrent.futures import ThreadPoolExecutor
+import scipy.signal
 from scipy.io import savemat
 from pybv import write_brainvision
 
@@ -10,7 +12,16 @@ from pybv import write_brainvision
 from functions.find_artifacts import *
 from functions.plotting import *
 from functions.interactive import select_sample
-from functions.utils import _detrend_data
+from functions.utils import (
+    _detrend_data,
+    _update_and_save_artifact_train,
+    _update_and_save_params,
+    _update_and_save_multiple_params,
+    _get_input_y_n,
+    _get_user_input,
+    _load_artifact_trains,
+    _add_to_review_queue,
+)
 
 
 
@@ -38,6 +49,8 @@ def detect_artifacts_in_external_recording(
 
     Output:
         - art_start_BIP: the timestamp when the artifact starts in external recording
+
+    All the artifacts detected are saved in artifacts_<session_ID>.npz.
     """
 
     # Generate timescale:
@@ -67,9 +80,17 @@ def detect_artifacts_in_external_recording(
     ### DETECT ARTIFACTS ###
 
     # find artifacts in external bipolar channel:
-    art_start_BIP = find_external_sync_artifact(
+    external_train = find_external_artifact_train(
         data=filtered_external, sf_external=sf_external, start_index=start_index
     )
+    if len(external_train) == 0:
+        raise ValueError("No artifact was found in the external recording.")
+    art_start_BIP = external_train["onset"][0] / sf_external
+
+    # save all the artifacts found, next to the parameters:
+    _update_and_save_artifact_train(
+        "external", external_train, sf_external, session_ID, saving_path
+    )
 
     # PLOT 2 : plot the external channel with the first artifact detected:
     plot_channel(
@@ -108,7 +129,12 @@ def detect_artifacts_in_external_recording(
 
 
 def detect_artifacts_in_intracranial_recording(
-    session_ID: str, lfp_sig: np.ndarray, sf_LFP: int, saving_path: str, method: str
+    session_ID: str,
+    lfp_sig: np.ndarray,
+    sf_LFP: int,
+    saving_path: str,
+    method: str,
+    intracranial_train: np.ndarray = None,
 ):
     """
     This function detects the first artifact in the intracranial recording and plots it.
@@ -121,11 +147,16 @@ def detect_artifacts_in_intracranial_recording(
         - saving_path: str, path to the folder where the figures will be saved
         - method: str, method used for artifact detection in intracranial recording
         (1, 2, thresh, manual)
+        - intracranial_train: np.ndarray, artifacts already found with this
+        method (see rank_LFP_detection_methods), to only plot and save them.
+        None (default) runs the detection.
 
 
     Returns:
         - art_start_LFP: the timestamp when the artifact starts in intracranial recording
 
+    All the artifacts detected are saved in artifacts_<session_ID>.npz.
+
     """
 
     # Generate timescale:
@@ -150,9 +181,11 @@ def detect_artifacts_in_intracranial_recording(
 
     ### DETECT ARTIFACTS ###
     if method in ["1", "2", "thresh"]:
-        art_start_LFP = find_LFP_sync_artifact(
-            data=lfp_sig, sf_LFP=sf_LFP, use_method=method
-        )
+        if intracranial_train is None:
+            intracranial_train = find_LFP_artifact_train(
+                data=lfp_sig, sf_LFP=sf_LFP, use_method=method
+            )
+        art_start_LFP = intracranial_train["onset"][0] / sf_LFP
         
         # PLOT 5 :
         # plot the intracranial channel with its artifacts detected:
@@ -198,6 +231,12 @@ def detect_artifacts_in_intracranial_recording(
             signal=lfp_sig, sf=sf_LFP, color1="peachpuff", color2="darkorange"
         )
 
+        # only the artifact selected by the user is known:
+        intracranial_train = np.zeros(1, dtype=ARTIFACT_TRAIN_DTYPE)
+        intracranial_train["onset"] = round(art_start_LFP * sf_LFP)
+        intracranial_train["amplitude"] = lfp_sig[round(art_start_LFP * sf_LFP)]
+        intracranial_train["confidence"] = np.nan
+
         # PLOT 7 : plot the artifact adjusted by user in the intracranial channel:
         idx_start = round(np.where(LFP_timescale_s == art_start_LFP)[0][0] - (0.1*sf_LFP))
         idx_end = round(np.where(LFP_timescale_s == art_start_LFP)[0][0] + (0.3*sf_LFP))
@@ -215,9 +254,318 @@ def detect_artifacts_in_intracranial_recording(
         )
         plt.show(block=False)
 
+    # save all the artifacts found, next to the parameters:
+    _update_and_save_artifact_train(
+        "intracranial", intracranial_train, sf_LFP, session_ID, saving_path
+    )
+
     return art_start_LFP
 
 
+def detect_artifacts_in_both_recordings(
+    session_ID: str,
+    lfp_sig: np.ndarray,
+    sf_LFP: int,
+    BIP_channel: np.ndarray,
+    sf_external: int,
+    saving_path: str,
+    results_path: str = None,
+    auto_accept_confidence: float = None,
+    HEADLESS: bool = False,
+):
+    """
+    This function detects the first artifact of both recordings, asking the
+    user to confirm them. The automatic methods of the intracranial recording
+    are run in a background thread while the external artifacts are detected
+    and confirmed, the figures and questions staying in the calling thread.
+    The intracranial methods are then ranked by consistency with the external
+    artifacts.
+
+    Inputs:
+        - session_ID: str, session identifier
+        - lfp_sig: np.ndarray, the channel of the intracranial recording
+        containing the artifacts
+        - sf_LFP: int, sampling frequency of intracranial recording
+        - BIP_channel: np.ndarray, the channel of the external recording
+        containing the artifacts
+        - sf_external: int, sampling frequency of external recording
+        - saving_path: str, path to the folder where the parameters and
+        figures are saved
+        - results_path: str, path to the results folder, containing the
+        review queue (only used if HEADLESS)
+        - auto_accept_confidence: float or None, the intracranial artifacts of
+        a method are accepted without asking when their consistency with the
+        external artifacts is at least this value. None always asks.
+        - HEADLESS: bool, if True, nothing is asked: the external artifact is
+        accepted, and the session is added to the review queue when no
+        intracranial method reaches auto_accept_confidence
+
+    Returns:
+        - art_times: tuple (art_start_BIP, art_start_LFP) of the timestamps of
+        the first artifact in the external and intracranial recordings, or None
+        if the session was added to the review queue
+    """
+
+    # the intracranial artifacts do not depend on the external ones, only their
+    # ranking does:
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        LFP_detection = executor.submit(
+            rank_LFP_detection_methods, data=lfp_sig, sf_LFP=sf_LFP
+        )
+        art_start_BIP = _detect_external_artifact(
+            session_ID, BIP_channel, sf_external, saving_path, HEADLESS
+        )
+        candidates = LFP_detection.result()
+
+    # Find artifacts in intracranial recording:
+    # The automatic methods are ranked by consistency with the artifacts found in
+    # the external recording:
+    # thresh takes the last sample that lies within the value distribution of the
+    # thres_window (aka: baseline window) before the threshold passing
+    # kernel 1 only searches for the steep decrease
+    # kernel 2 is more custom and takes into account the steep decrease and slow recovery
+    # manual kernel is when none of the three previous methods work. Then the artifact
+    # has to be manually selected by the user, in a pop up window that will automatically open.
+    trains = _load_artifact_trains(session_ID, saving_path)
+    candidates = rescore_LFP_candidates(
+        candidates, sf_LFP, trains.get("external"), sf_external
+    )
+    if HEADLESS:
+        # only the most consistent method can be accepted automatically
+        if not candidates or candidates[0]["confidence"] < auto_accept_confidence:
+            _add_to_review_queue(
+                session_ID=session_ID,
+                stage="intracranial artifact",
+                reason="no automatic method above auto_accept_confidence",
+                confidence=candidates[0]["confidence"] if candidates else None,
+                results_path=results_path,
+            )
+            plt.close("all")
+            return None
+        candidates = candidates[:1]
+    else:
+        candidates.append({"method": "manual", "train": None, "confidence": None})
+    for candidate in candidates:
+        method = candidate["method"]
+        print("Running resync with method = {}...".format(method))
+        art_start_LFP = detect_artifacts_in_intracranial_recording(
+            session_ID=session_ID,
+            lfp_sig=lfp_sig,
+            sf_LFP=sf_LFP,
+            saving_path=saving_path,
+            method=method,
+            intracranial_train=candidate["train"],
+        )
+        if candidate["confidence"] is not None:
+            print("Consistency with the external artifacts: {:.2f}".format(candidate["confidence"]))
+        if (
+            auto_accept_confidence is not None
+            and candidate["confidence"] is not None
+            and candidate["confidence"] >= auto_accept_confidence
+        ):
+            artifact_correct = "y"
+        else:
+            artifact_correct = _get_input_y_n(
+                "Is the intracranial DBS artifact properly selected ? "
+            )
+        if artifact_correct in ("y","Y"):
+            dictionary = {
+                "ART_TIME_LFP": art_start_LFP,
+                "METHOD": method,
+                "METHOD_CONFIDENCE": candidate["confidence"],
+            }
+            _update_and_save_multiple_params(dictionary,session_ID,saving_path)
+            break
+
+    return art_start_BIP, art_start_LFP
+
+
+def _detect_external_artifact(
+    session_ID: str,
+    BIP_channel: np.ndarray,
+    sf_external: int,
+    saving_path: str,
+    HEADLESS: bool = False,
+):
+    "First artifact of the external recording, confirmed by the user unless HEADLESS"
+
+    art_start_BIP = detect_artifacts_in_external_recording(
+        session_ID=session_ID,
+        BIP_channel=BIP_channel,
+        sf_external=sf_external,
+        saving_path=saving_path,
+        start_index=0,
+    )
+    if HEADLESS:
+        # checked afterwards, by the consistency of the intracranial artifacts
+        artifact_correct = "y"
+    else:
+        artifact_correct = _get_input_y_n(
+            "Is the external DBS artifact properly selected ? "
+        )
+    if artifact_correct not in ("y", "Y"):
+        # if there's an unrelated artifact or if the stimulation is ON at the beginning
+        # of the recording, the user can input the number of seconds to ignore at the
+        # beginning of the recording, and the function will start looking for artifacts
+        # after that time.
+        start_later = _get_user_input(
+            "How many seconds in the beginning should be ignored "
+        )
+        start_later_index = start_later * round(sf_external)
+        art_start_BIP = detect_artifacts_in_external_recording(
+            session_ID=session_ID,
+            BIP_channel=BIP_channel,
+            sf_external=sf_external,
+            saving_path=saving_path,
+            start_index=start_later_index,
+        )
+    _update_and_save_params(
+        key="ART_TIME_BIP",
+        value=art_start_BIP,
+        session_ID=session_ID,
+        saving_path=saving_path,
+    )
+
+    return art_start_BIP
+
+
+def refine_alignment(
+    lfp_sig: np.ndarray,
+    BIP_channel: np.ndarray,
+    art_start_LFP: float,
+    art_start_BIP: float,
+    sf_LFP: int,
+    sf_external: int,
+    window_s: float = 2,
+    max_lag_ms: float = 10,
+    min_confidence: float = 0.5,
+    max_shift_ms: float = None,
+):
+    """
+    This function refines the alignment of the first artifact below the
+    sampling period of the intracranial recording (4 ms at 250 Hz).
+
+    The envelopes of both recordings around the first artifact (absolute
+    value of the signal minus its median before the artifact) are upsampled
+    to a common rate (a multiple of sf_LFP at least as high as sf_external)
+    and low-passed to the same bandwidth, then cross-correlated (FFT) over
+    lags of +/- max_lag_ms around the initial offset. The peak of the
+    normalized cross-correlation is interpolated with a parabola. The
+    refinement is only accepted when the envelopes match (min_confidence) and
+    the correction stays below the precision of the detection (max_shift_ms):
+    a larger correction means that another part of the envelopes was matched.
+
+    Inputs:
+        - lfp_sig: np.ndarray, the channel of the intracranial recording
+        containing the artifacts
+        - BIP_channel: np.ndarray, the channel of the external recording
+        containing the artifacts
+        - art_start_LFP: float, the timestamp when the artifact starts in
+        intracranial recording (see find_LFP_sync_artifact)
+        - art_start_BIP: float, the timestamp when the artifact starts in
+        external recording
+        - sf_LFP: int, sampling frequency of intracranial recording
+        - sf_external: int, sampling frequency of external recording
+        - window_s: float, duration of the envelopes compared after the first
+        artifact (s)
+        - max_lag_ms: float, maximum correction of the initial offset
+        searched (ms)
+        - min_confidence: float, minimum confidence to accept the refinement
+        - max_shift_ms: float, maximum correction accepted (ms), None for one
+        sampling period of the intracranial recording
+
+    Returns:
+        - art_start_BIP_refined: float, the timestamp in the external
+        recording aligned with art_start_LFP (art_start_BIP if the refinement
+        is not accepted)
+        - offset_ms: float, correction found for art_start_BIP (ms)
+        - confidence: float, normalized cross-correlation of the envelopes at
+        the refined offset (between -1 and 1, 1 for identical envelopes)
+        - accepted: bool, True if the refinement is accepted
+    """
+
+    if max_shift_ms is None:
+        max_shift_ms = 1000 / sf_LFP
+
+    upsampling = int(np.ceil(sf_external / sf_LFP))
+    sf_common = sf_LFP * upsampling
+    max_lag = int(np.ceil(max_lag_ms / 1000 * sf_common))
+    b, a = scipy.signal.butter(4, 0.4 * sf_LFP, "lowpass", fs=sf_common)
+
+    # intracranial envelope, from 0.5s before the first artifact:
+    index_start = max(0, int(round((art_start_LFP - 0.5) * sf_LFP)))
+    index_end = min(len(lfp_sig), int(round((art_start_LFP + window_s) * sf_LFP)))
+    segment_LFP = np.asarray(lfp_sig[index_start:index_end], dtype=np.float64)
+    n_baseline = int(round(art_start_LFP * sf_LFP)) - index_start
+    segment_LFP = segment_LFP - _median_baseline(segment_LFP, n_baseline)
+    segment_LFP = scipy.signal.resample_poly(segment_LFP, upsampling, 1)
+    envelope_LFP = scipy.signal.filtfilt(b, a, np.abs(segment_LFP))
+
+    # external envelope at the same times (initial offset), +/- max_lag:
+    times_external = (
+        art_start_BIP
+        + (index_start / sf_LFP - art_start_LFP)
+        + np.arange(-max_lag, len(envelope_LFP) + max_lag) / sf_common
+    )
+    margin = int(sf_external)  # 1s margin for the filters
+    index_start_external = max(0, int(times_external[0] * sf_external) - margin)
+    index_end_external = min(
+        len(BIP_channel), int(times_external[-1] * sf_external) + margin
+    )
+    # same preprocessing as the intracranial envelope: a high-pass filter
+    # (_detrend_data) would change the shape of the envelope and bias the lag
+    segment_external = np.asarray(
+        BIP_channel[index_start_external:index_end_external], dtype=np.float64
+    )
+    n_baseline = int(round(art_start_BIP * sf_external)) - index_start_external
+    segment_external = segment_external - _median_baseline(segment_external, n_baseline)
+    envelope_external = scipy.signal.filtfilt(
+        *scipy.signal.butter(4, 0.4 * sf_LFP, "lowpass", fs=sf_external),
+        np.abs(segment_external),
+    )
+    envelope_external = np.interp(
+        times_external,
+        np.arange(index_start_external, index_end_external) / sf_external,
+        envelope_external,
+    )
+
+    # normalized cross-correlation for each lag:
+    envelope_LFP = envelope_LFP - envelope_LFP.mean()
+    envelope_external = envelope_external - envelope_external.mean()
+    xcorr = scipy.signal.correlate(
+        envelope_external, envelope_LFP, mode="valid", method="fft"
+    )
+    n = len(envelope_LFP)
+    cumsum = np.concatenate(([0], np.cumsum(envelope_external)))
+    cumsum_sq = np.concatenate(([0], np.cumsum(envelope_external**2)))
+    window_sum = cumsum[n:] - cumsum[:-n]
+    window_sum_sq = cumsum_sq[n:] - cumsum_sq[:-n]
+    # the LFP envelope has a zero mean, so the window mean does not change
+    # the correlation, only the norm of the external window:
+    window_norm = np.sqrt(np.maximum(window_sum_sq - window_sum**2 / n, 1e-30))
+    ncc = xcorr / (np.linalg.norm(envelope_LFP) * window_norm)
+
+    best = int(np.argmax(ncc))
+    confidence = float(ncc[best])
+    lag = float(best)
+    if 0 < best < len(ncc) - 1:
+        left, centre, right = ncc[best - 1 : best + 2]
+        curvature = left - 2 * centre + right
+        if curvature < 0:
+            lag += 0.5 * (left - right) / curvature
+
+    offset_s = (lag - max_lag) / sf_common
+    accepted = confidence >= min_confidence and abs(offset_s) * 1000 <= max_shift_ms
+    art_start_BIP_refined = art_start_BIP + offset_s if accepted else art_start_BIP
+
+    return art_start_BIP_refined, offset_s * 1000, confidence, accepted
+
+
+def _median_baseline(segment: np.ndarray, n_baseline: int):
+    "Median of the first n_baseline samples (before the first artifact), if any"
+    return np.median(segment[:n_baseline] if n_baseline > 0 else segment)
+
+
 def synchronize_recordings(
     LFP_array: np.ndarray,
     external_file: np.ndarray,
@@ -226,6 +574,8 @@ def synchronize_recordings(
     sf_LFP: int,
     sf_external: int,
     CROP_BOTH: bool,
+    dtype: str = "float32",
+    drift_ppm: float = None,
 ):
     """
     This function synchronizes the intracranial recording with
@@ -241,24 +591,47 @@ def synchronize_recordings(
         - CROP_BOTH: bool, if True, both recordings are cropped 1 second before
         first artifact. If False, only external recording is cropped to match
         intracranial recording
+        - dtype: str, data type of the synchronized recordings, "float32"
+        (default) or "float64"
+        - drift_ppm: float or None, clock drift of the external recording
+        relative to the intracranial one (ppm, see timeshift.estimate_drift).
+        If given, the external recording is resampled onto the clock of the
+        intracranial recording, the first artifact staying aligned (see
+        _correct_external_drift). None (default) only applies the offset.
 
     Returns:
         - LFP_synchronized: np.ndarray, intracranial recording synchronized with external recording
         - external_synchronized: np.ndarray, external recording synchronized with intracranial recording
     """
 
+    index_start_LFP, index_start_external = _synchronization_start_indexes(
+        art_start_LFP, art_start_BIP, sf_LFP, sf_external, CROP_BOTH
+    )
+
+    ## External ##
+    # Crop beginning of external recording (1s before first artifact if
+    # CROP_BOTH, at the start of the LFP recording otherwise):
+    if drift_ppm is None:
+        external_cropped = external_file[:, index_start_external:].T
+    else:
+        LFP_rec_duration = (LFP_array.shape[1] - index_start_LFP) / sf_LFP
+        external_cropped = _correct_external_drift(
+            external_file=external_file,
+            index_start_external=index_start_external,
+            index_first_artifact=art_start_BIP * sf_external,
+            drift_ppm=drift_ppm,
+            max_samples=int(np.ceil(LFP_rec_duration * sf_external)),
+            dtype=dtype,
+        )
+        print(
+            "External recording resampled to correct a clock drift of "
+            f"{drift_ppm:.2f} ppm"
+        )
+
     if CROP_BOTH: 
         ## Intracranial ##
         # Crop beginning of LFP intracranial recording 1 second before first artifact:
-        index_start_LFP = (art_start_LFP - 1) * sf_LFP
-        LFP_cropped = LFP_array[:, int(index_start_LFP) :].T
-
-        ## External ##
-        # Crop beginning of external recordings 1s before first artifact:
-        time_start_external = (art_start_BIP) - 1
-        index_start_external = time_start_external * sf_external
-
-        external_cropped = external_file[:, int(index_start_external) :].T
+        LFP_cropped = LFP_array[:, index_start_LFP:].T
 
         # Check which recording is the longest,
         # crop it to give it the same duration as the other one:
@@ -282,12 +655,6 @@ def synchronize_recordings(
         )
 
     else:
-        # find the timestamp in the external recording corresponding to the start of LFP recording :
-        time_start_external = art_start_BIP - art_start_LFP
-        index_start_external = time_start_external * sf_external
-
-        external_cropped = external_file[:, int(index_start_external) :].T
-
         # check duration and crop external recording if longer:
         LFP_rec_duration = len(LFP_array.T) / sf_LFP
         external_rec_duration = len(external_cropped) / sf_external
@@ -306,10 +673,142 @@ def synchronize_recordings(
             "Alignment performed, only external recording as been cropped "
             "to match LFP recording !"
         )
+
+    LFP_synchronized = LFP_synchronized.astype(dtype, copy=False)
+    external_synchronized = external_synchronized.astype(dtype, copy=False)
     
     return LFP_synchronized, external_synchronized
 
 
+# half-width (in samples) of the windowed-sinc interpolator of _correct_external_drift,
+# and number of fractional delays it is computed for
+_DRIFT_FILTER_HALF_WIDTH = 8
+_DRIFT_FILTER_PHASES = 1024
+
+
+def _correct_external_drift(
+    external_file: np.ndarray,
+    index_start_external: int,
+    index_first_artifact: float,
+    drift_ppm: float,
+    max_samples: int = None,
+    dtype: str = "float32",
+):
+    """
+    Resamples the external recording, from index_start_external, onto the
+    clock of the intracranial recording. The first artifact stays in place, and
+    the n-th sample after it is interpolated at n * (1 + drift_ppm * 1e-6)
+    samples after it in the external recording, with a Hann-windowed sinc
+    fractional-delay filter (2 * _DRIFT_FILTER_HALF_WIDTH taps, fractional
+    delays rounded to 1 / _DRIFT_FILTER_PHASES sample). The
+    recording is processed in chunks of output samples, so only the samples
+    needed for a chunk are read (and decoded, for a lazy Poly5SampleView)
+    at once.
+
+    Inputs:
+        - external_file: np.ndarray or Poly5SampleView (channels, samples),
+        external recording
+        - index_start_external: int, first sample of the external recording
+        kept in the synchronized recording
+        - index_first_artifact: float, position of the first artifact in the
+        external recording (samples)
+        - drift_ppm: float, clock drift of the external recording (ppm)
+        - max_samples: int or None, largest number of samples to return
+        - dtype: str, data type of the returned recording
+
+    Returns:
+        - external_cropped: np.ndarray (samples, channels), external recording
+        resampled from index_start_external
+    """
+
+    num_channels = external_file.shape[0]
+    num_samples = external_file.shape[1] - index_start_external
+    ratio = 1 + drift_ppm * 1e-6
+    anchor = index_first_artifact - index_start_external
+
+    # last output sample whose position is still inside the recording
+    num_output = max(0, int(np.floor((num_samples - 1 - anchor) / ratio + anchor)) + 1)
+    if max_samples is not None:
+        num_output = min(num_output, max_samples)
+
+    taps = np.arange(-_DRIFT_FILTER_HALF_WIDTH + 1, _DRIFT_FILTER_HALF_WIDTH + 1)
+    # polyphase bank of windowed-sinc filters, one per fractional delay,
+    # normalized to keep the signal offset
+    distance = (
+        np.arange(_DRIFT_FILTER_PHASES + 1)[:, np.newaxis] / _DRIFT_FILTER_PHASES - taps
+    )
+    filter_bank = np.sinc(distance) * (
+        0.5 + 0.5 * np.cos(np.pi * distance / _DRIFT_FILTER_HALF_WIDTH)
+    )
+    filter_bank /= filter_bank.sum(axis=1, keepdims=True)
+    # about 8 MB of float64 samples per chunk
+    chunk_size = max(256, (1 << 20) // num_channels)
+
+    external_cropped = np.empty((num_output, num_channels), dtype=dtype)
+    for start in range(0, num_output, chunk_size):
+        n = np.arange(start, min(start + chunk_size, num_output))
+        positions = anchor + (n - anchor) * ratio
+        base = np.floor(positions).astype(np.int64)
+        phases = np.rint((positions - base) * _DRIFT_FILTER_PHASES).astype(np.int64)
+        weights = filter_bank[phases]
+
+        # samples needed for this chunk, repeated at the edges of the recording
+        first = base[0] + taps[0]
+        last = base[-1] + taps[-1] + 1
+        block = np.asarray(
+            external_file[
+                :,
+                index_start_external + max(first, 0) : index_start_external
+                + min(last, num_samples),
+            ],
+            dtype=np.float64,
+        )
+        block = np.pad(
+            block, ((0, 0), (max(0, -first), max(0, last - num_samples))), mode="edge"
+        )
+
+        # the input samples are consecutive between the points where the
+        # drift makes the interpolation skip (or repeat) one sample
+        breaks = np.flatnonzero(np.diff(base) != 1) + 1
+        resampled = np.zeros((num_channels, len(n)))
+        for a, b in zip(np.append(0, breaks), np.append(breaks, len(n))):
+            for k, tap in enumerate(taps):
+                source = base[a] + tap - first
+                resampled[:, a:b] += weights[a:b, k] * block[:, source : source + b - a]
+        external_cropped[start : start + len(n)] = resampled.T
+
+    return external_cropped
+
+
+def _synchronization_start_indexes(
+    art_start_LFP: float,
+    art_start_BIP: float,
+    sf_LFP: int,
+    sf_external: int,
+    CROP_BOTH: bool,
+):
+    """
+    Returns the index of the first sample of each recording kept in the
+    synchronized recordings (see synchronize_recordings).
+
+    Returns:
+        - index_start_LFP: int, first sample of the intracranial recording
+        - index_start_external: int, first sample of the external recording
+    """
+
+    if CROP_BOTH:
+        # both recordings start 1 second before the first artifact
+        index_start_LFP = (art_start_LFP - 1) * sf_LFP
+        time_start_external = (art_start_BIP) - 1
+    else:
+        # the external recording starts at the start of the LFP recording
+        index_start_LFP = 0
+        time_start_external = art_start_BIP - art_start_LFP
+    index_start_external = time_start_external * sf_external
+
+    return int(index_start_LFP), int(index_start_external)
+
+
 def save_synchronized_recordings(
     session_ID: str,
     LFP_synchronized: np.ndarray,
@@ -320,6 +819,7 @@ def save_synchronized_recordings(
     sf_external: int,
     saving_format: str,
     saving_path: str,
+    dtype: str = "float32",
 ):
     """
     This function saves the synchronized intracranial and external recordings.
@@ -336,6 +836,8 @@ def save_synchronized_recordings(
         - sf_external: int, sampling frequency of external recording
         - saving_format: str, format in which the recordings will be saved
         - saving_path: str, path to the folder where the recordings will be saved
+        - dtype: str, data type in which the recordings are written, "float32"
+        (default) or "float64". Brainvision files are always written as float32.
 
     """
 
@@ -343,6 +845,9 @@ def save_synchronized_recordings(
         "saving_format incorrect." "Choose in: csv, mat, pickle, brainvision"
     )
 
+    LFP_synchronized = LFP_synchronized.astype(dtype, copy=False)
+    external_synchronized = external_synchronized.astype(dtype, copy=False)
+
     LFP_df_offset = pd.DataFrame(LFP_synchronized)
     LFP_df_offset.columns = LFP_rec_ch_names
     external_df_offset = pd.DataFrame(external_synchronized)
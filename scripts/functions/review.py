@@ -0,0 +1,310 @@
+"""
+Review of the artifacts detected in batch, from cached previews
+"""
+
+import os
+import json
+import numpy as np
+import matplotlib.pyplot as plt
+from os.path import join
+
+from functions.find_artifacts import (
+    ARTIFACT_TRAIN_DTYPE,
+    rescore_LFP_candidates,
+)
+from functions.interactive import select_sample
+from functions.utils import (
+    _get_input_y_n,
+    _get_user_input,
+    _update_and_save_artifact_train,
+)
+
+
+# number of points of the overview of the external recording
+PREVIEW_BINS = 20000
+# samples plotted around the first artifact of the external recording (Fig3)
+EXTERNAL_ZOOM_SAMPLES = 60
+
+
+def save_detection_candidates(
+    session_ID: str,
+    saving_path: str,
+    lfp_sig: np.ndarray,
+    sf_LFP: int,
+    filtered_external: np.ndarray,
+    sf_external: int,
+    external_train: np.ndarray,
+    candidates: list,
+):
+    """
+    Saves the artifacts detected in a session, with the data needed to review
+    them later without loading the recordings again, in
+    candidates_<session_ID>.npz:
+        - the intracranial channel containing the artifacts (small, 250 Hz)
+        - an overview of the detrended external channel: its minimum and
+        maximum in PREVIEW_BINS bins
+        - the detrended external channel around the onset of each artifact,
+        at full resolution
+        - the external artifacts, and the intracranial artifacts found by each
+        automatic method with their consistency score
+
+    Inputs:
+        - session_ID: str, the session identifier
+        - saving_path: str, the path where to save the npz file
+        - lfp_sig: np.ndarray, the channel of the intracranial recording
+        containing the artifacts
+        - sf_LFP: int, sampling frequency of intracranial recording
+        - filtered_external: np.ndarray, the detrended channel of the external
+        recording containing the artifacts
+        - sf_external: int, sampling frequency of external recording
+        - external_train: np.ndarray, artifacts of the external recording
+        (ARTIFACT_TRAIN_DTYPE)
+        - candidates: list of dict, see find_artifacts.rank_LFP_detection_methods
+    """
+
+    # overview of the external channel, as the envelope of its bins:
+    bin_size = max(1, int(np.ceil(len(filtered_external) / PREVIEW_BINS)))
+    n_bins = int(np.ceil(len(filtered_external) / bin_size))
+    padded = np.pad(
+        filtered_external, (0, n_bins * bin_size - len(filtered_external)), mode="edge"
+    ).reshape(n_bins, bin_size)
+
+    # onset of each artifact, at full resolution:
+    zoom_onsets = external_train["onset"]
+    zoom_indexes = np.clip(
+        zoom_onsets[:, np.newaxis]
+        + np.arange(-EXTERNAL_ZOOM_SAMPLES, EXTERNAL_ZOOM_SAMPLES + 1),
+        0,
+        len(filtered_external) - 1,
+    )
+
+    arrays = {
+        "lfp_sig": np.asarray(lfp_sig, dtype=np.float32),
+        "sf_LFP": np.float64(sf_LFP),
+        "external_min": padded.min(axis=1).astype(np.float32),
+        "external_max": padded.max(axis=1).astype(np.float32),
+        "external_bin_size": np.int64(bin_size),
+        "external_zoom_onsets": zoom_onsets,
+        "external_zooms": filtered_external[zoom_indexes].astype(np.float32),
+        "sf_external": np.float64(sf_external),
+        "external_train": external_train,
+        "methods": np.array([candidate["method"] for candidate in candidates]),
+        "confidences": np.array(
+            [candidate["confidence"] for candidate in candidates], dtype=np.float64
+        ),
+    }
+    for candidate in candidates:
+        arrays["train_" + candidate["method"]] = candidate["train"]
+
+    npz_file_path = join(saving_path, "candidates_" + str(session_ID) + ".npz")
+    # write to a temporary file first, so that the file is never left incomplete
+    with open(npz_file_path + ".tmp", "wb") as npz_file:
+        np.savez(npz_file, **arrays)
+    os.replace(npz_file_path + ".tmp", npz_file_path)
+
+
+def load_detection_candidates(session_ID: str, saving_path: str):
+    """
+    Loads the file saved by save_detection_candidates.
+
+    Returns:
+        - candidates: dict, the arrays of the file, or None if the session was
+        not detected yet
+    """
+
+    npz_file_path = join(saving_path, "candidates_" + str(session_ID) + ".npz")
+    if not os.path.isfile(npz_file_path):
+        return None
+
+    with np.load(npz_file_path) as npz_file:
+        candidates = {key: npz_file[key] for key in npz_file.files}
+
+    return candidates
+
+
+def review_session(session_ID: str, saving_path: str):
+    """
+    Shows the artifacts detected in a session from its cached previews (see
+    save_detection_candidates) and asks the user to accept them: first the
+    first external artifact, then the intracranial artifacts of each method,
+    from the most to the least consistent, and finally a manual selection.
+    The accepted picks are saved in review_<session_ID>.json, and the
+    accepted intracranial artifacts in artifacts_<session_ID>.npz.
+
+    Inputs:
+        - session_ID: str, the session identifier
+        - saving_path: str, the path where the candidates were saved
+
+    Returns:
+        - picks: dict, with the keys ART_TIME_BIP, ART_TIME_LFP, METHOD and
+        METHOD_CONFIDENCE, or None if the session was not detected yet
+    """
+
+    cached = load_detection_candidates(session_ID, saving_path)
+    if cached is None:
+        return None
+
+    sf_LFP = cached["sf_LFP"].item()
+    sf_external = cached["sf_external"].item()
+    lfp_sig = cached["lfp_sig"]
+    external_train = cached["external_train"]
+    zoom_onsets = cached["external_zoom_onsets"]
+
+    # 1. first artifact of the external recording:
+    first_artifact = 0
+    while True:
+        art_start_BIP = zoom_onsets[first_artifact] / sf_external
+        _plot_external_preview(session_ID, cached, first_artifact)
+        artifact_correct = _get_input_y_n(
+            "Is the external DBS artifact properly selected ? "
+        )
+        plt.close("all")
+        if artifact_correct in ("y", "Y"):
+            break
+        # the artifacts before the given time are ignored, as in main_batch:
+        start_later = _get_user_input(
+            "How many seconds in the beginning should be ignored "
+        )
+        later_artifacts = np.flatnonzero(zoom_onsets >= start_later * sf_external)
+        if len(later_artifacts) == 0:
+            print("No artifact was found after this time.")
+            continue
+        first_artifact = later_artifacts[0]
+
+    # the consistency of the intracranial artifacts is scored again when the
+    # first external artifacts are ignored:
+    external_train = external_train[external_train["onset"] >= zoom_onsets[first_artifact]]
+    candidates = rescore_LFP_candidates(
+        [
+            {"method": str(method), "train": cached["train_" + str(method)]}
+            for method in cached["methods"]
+        ],
+        sf_LFP,
+        external_train,
+        sf_external,
+    )
+
+    # 2. first artifact of the intracranial recording:
+    for candidate in candidates:
+        art_start_LFP = candidate["train"]["onset"][0] / sf_LFP
+        _plot_LFP_preview(session_ID, lfp_sig, sf_LFP, art_start_LFP, candidate)
+        artifact_correct = _get_input_y_n(
+            "Is the intracranial DBS artifact properly selected ? "
+        )
+        plt.close("all")
+        if artifact_correct in ("y", "Y"):
+            intracranial_train = candidate["train"]
+            method = candidate["method"]
+            confidence = candidate["confidence"]
+            break
+    else:
+        print(
+            f"Automatic detection of intracranial artifacts failed, using manual method. \n"
+            f"In the pop up window, zoom on the first artifact until you can select properly  "
+            f"the last sample before the deflection, click on it and close the window."
+        )
+        art_start_LFP = select_sample(
+            signal=lfp_sig, sf=sf_LFP, color1="peachpuff", color2="darkorange"
+        )
+        intracranial_train = np.zeros(1, dtype=ARTIFACT_TRAIN_DTYPE)
+        intracranial_train["onset"] = round(art_start_LFP * sf_LFP)
+        intracranial_train["amplitude"] = lfp_sig[round(art_start_LFP * sf_LFP)]
+        intracranial_train["confidence"] = np.nan
+        method = "manual"
+        confidence = None
+
+    if first_artifact > 0:
+        _update_and_save_artifact_train(
+            "external", external_train, sf_external, session_ID, saving_path
+        )
+    _update_and_save_artifact_train(
+        "intracranial", intracranial_train, sf_LFP, session_ID, saving_path
+    )
+    picks = {
+        "ART_TIME_BIP": float(art_start_BIP),
+        "ART_TIME_LFP": float(art_start_LFP),
+        "METHOD": method,
+        "METHOD_CONFIDENCE": confidence,
+    }
+    json_file_path = join(saving_path, "review_" + str(session_ID) + ".json")
+    with open(json_file_path, "w") as json_file:
+        json.dump(picks, json_file, indent=4)
+
+    return picks
+
+
+def load_reviewed_picks(session_ID: str, saving_path: str):
+    """
+    Loads the picks saved by review_session.
+
+    Returns:
+        - picks: dict, see review_session, or None if the session was not
+        reviewed yet
+    """
+
+    json_file_path = join(saving_path, "review_" + str(session_ID) + ".json")
+    if not os.path.isfile(json_file_path):
+        return None
+
+    with open(json_file_path, "r") as json_file:
+        picks = json.load(json_file)
+
+    return picks
+
+
+def _plot_external_preview(session_ID: str, cached: dict, artifact: int):
+    "Overview of the external channel and zoom on the onset of an artifact"
+
+    sf_external = cached["sf_external"].item()
+    bin_size = cached["external_bin_size"].item()
+    art_start_BIP = cached["external_zoom_onsets"][artifact] / sf_external
+    bin_times = np.arange(len(cached["external_min"])) * bin_size / sf_external
+    zoom_times = (
+        cached["external_zoom_onsets"][artifact]
+        + np.arange(-EXTERNAL_ZOOM_SAMPLES, EXTERNAL_ZOOM_SAMPLES + 1)
+    ) / sf_external
+
+    fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(10, 8))
+    fig.suptitle(str(session_ID) + " - external recording")
+    ax1.fill_between(
+        bin_times, cached["external_min"], cached["external_max"], color="darkcyan"
+    )
+    ax1.axvline(x=art_start_BIP, color="black", linestyle="dashed", alpha=0.3)
+    ax1.set_ylabel("Artifact channel BIP (mV)")
+    ax2.plot(zoom_times, cached["external_zooms"][artifact], color="darkcyan", zorder=1)
+    ax2.scatter(zoom_times, cached["external_zooms"][artifact], color="darkcyan", s=8)
+    ax2.axvline(x=art_start_BIP, color="black", linestyle="dashed", alpha=0.3)
+    ax2.set_xlabel("Time (s)")
+    ax2.set_ylabel("Artifact channel BIP - Voltage (mV)")
+    plt.show(block=False)
+    plt.pause(0.1)
+
+
+def _plot_LFP_preview(
+    session_ID: str, lfp_sig: np.ndarray, sf_LFP: int, art_start_LFP: float, candidate: dict
+):
+    "Intracranial channel and zoom on the first artifact found by a method"
+
+    timescale = np.arange(len(lfp_sig)) / sf_LFP
+    idx_start = max(0, round((art_start_LFP - 0.1) * sf_LFP))
+    idx_end = round((art_start_LFP + 0.3) * sf_LFP)
+
+    fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(10, 8))
+    fig.suptitle(
+        f"{session_ID} - intracranial recording - method {candidate['method']} "
+        f"(consistency {candidate['confidence']:.2f})"
+    )
+    ax1.plot(timescale, lfp_sig, color="darkorange", linewidth=0.5)
+    ax1.axvline(x=art_start_LFP, color="black", linestyle="dashed", alpha=0.3)
+    ax1.set_ylabel("Intracranial LFP channel (µV)")
+    ax2.plot(
+        timescale[idx_start:idx_end], lfp_sig[idx_start:idx_end], color="peachpuff", zorder=1
+    )
+    ax2.scatter(
+        timescale[idx_start:idx_end], lfp_sig[idx_start:idx_end], color="darkorange", s=8
+    )
+    ax2.axvline(x=art_start_LFP, color="black", linestyle="dashed", alpha=0.3)
+    ax2.set_xlabel("Time (s)")
+    ax2.set_ylabel("Intracranial LFP channel (µV)")
+    plt.show(block=False)
+    plt.pause(0.1)
@@ -1,10 +1,15 @@
-import json
 import numpy as np
 import matplotlib.pyplot as plt
 from os.path import join
 
 from functions.interactive import select_sample
-from functions.utils import _update_and_save_multiple_params, _detrend_data
+from functions.utils import (
+    _update_and_save_multiple_params,
+    _load_params,
+    _detrend_data,
+    _load_artifact_trains,
+)
+from functions.resync_function import _synchronization_start_indexes
 
 
 def check_timeshift(
@@ -14,17 +19,28 @@ def check_timeshift(
     external_synchronized: np.ndarray,
     sf_external: int,
     saving_path: str,
+    CROP_BOTH: bool = False,
+    AUTOMATIC: bool = True,
+    max_residual_ms: float = 10,
+    INTERACTIVE: bool = True,
 ):
     """
     Check the timeshift between the intracranial and external recordings after
     synchronization. As the two recording systems are different, it may happen
     that the internal clocks are not completely identical. This function allows
     to check this and to warn in case of a large timeshift.
-    To do so, the function plots the intracranial recording and the external one.
-    On each plot, the user is asked to select the sample corresponding to the
-    last artifact in the recording. The function then computes the time difference
-    between the two times. If the difference is large, it may indicate a problem
-    in the recording, such as a packet loss in the intracranial recording.
+    In automatic mode, the artifacts detected in both recordings (saved in
+    artifacts_<session_ID>.npz) are placed in the synchronized recordings and
+    paired, from the first to the last one. The delay between the recordings
+    is then fitted as an offset plus a clock drift (see estimate_drift), and
+    the timeshift is the delay at the last artifact.
+    If the artifacts cannot be paired, or if the fit residual is larger than
+    max_residual_ms, or in manual mode, the function plots the intracranial
+    recording and the external one. On each plot, the user is asked to select
+    the sample corresponding to the last artifact in the recording. The
+    function then computes the time difference between the two times.
+    If the difference is large, it may indicate a problem in the recording,
+    such as a packet loss in the intracranial recording.
 
     Inputs:
         - session_ID: str, the subject ID
@@ -36,13 +52,24 @@ def check_timeshift(
         - sf_external: int, sampling frequency of external recording
         - saving_path: str, path to the folder where the parameters.json file is
         saved
+        - CROP_BOTH: bool, value used in synchronize_recordings
+        - AUTOMATIC: bool, if True (default), the timeshift is first estimated
+        from the artifacts detected, and the user is only asked to select the
+        last artifacts if this estimation fails
+        - max_residual_ms: float, largest residual of the drift fit (ms)
+        accepted in automatic mode
+        - INTERACTIVE: bool, if False, the user is never asked to select the
+        last artifacts nor to look at the figure (headless mode): the
+        timeshift is only computed automatically
+
+    Returns:
+        - timeshift_ms: float, the timeshift at the last artifact (ms), or None
+        if it could not be computed automatically in non-interactive mode
 
     """
 
     # import settings
-    json_filename = saving_path + "\\parameters_" + str(session_ID) + ".json"
-    with open(json_filename, "r") as f:
-        loaded_dict = json.load(f)
+    loaded_dict = _load_params(session_ID, saving_path)
 
     LFP_channel_offset = LFP_synchronized[:, loaded_dict["CH_IDX_LFP"]]
     BIP_channel_offset = external_synchronized[:, loaded_dict["CH_IDX_EXTERNAL"]]
@@ -58,21 +85,61 @@ def check_timeshift(
     # detrend external recording with high-pass filter before processing:
     filtered_external_offset = _detrend_data(BIP_channel_offset)
 
-    print("Select the first sample of the last artifact in the intracranial recording")
-    last_artifact_lfp_x = select_sample(
-        signal=LFP_channel_offset, sf=sf_LFP, color1="peachpuff", color2="darkorange"
-    )
-    print("Select the first sample of the last artifact in the external recording")
-    last_artifact_external_x = select_sample(
-        signal=filtered_external_offset,
-        sf=sf_external,
-        color1="paleturquoise",
-        color2="darkcyan",
-    )
+    drift = None
+    if AUTOMATIC:
+        drift = _estimate_drift_from_saved_artifacts(
+            session_ID=session_ID,
+            loaded_dict=loaded_dict,
+            LFP_duration_s=len(LFP_channel_offset) / sf_LFP,
+            sf_LFP=sf_LFP,
+            external_duration_s=len(BIP_channel_offset) / sf_external,
+            sf_external=sf_external,
+            saving_path=saving_path,
+            CROP_BOTH=CROP_BOTH,
+        )
+        if drift is None:
+            print("Automatic timeshift analysis failed: not enough artifacts paired.")
+        elif drift["residual_ms"] > max_residual_ms:
+            print(
+                "Automatic timeshift analysis failed: the residual of the drift fit "
+                f"({drift['residual_ms']:.2f} ms) is larger than {max_residual_ms} ms."
+            )
+            drift = None
+
+    if drift is not None:
+        last_artifact_lfp_x = drift["last_artifact_lfp"]
+        last_artifact_external_x = drift["last_artifact_external"]
+        dictionary = {
+            "TIMESHIFT_MODE": "automatic",
+            "DRIFT_OFFSET_MS": drift["offset_ms"],
+            "DRIFT_PPM": drift["drift_ppm"],
+            "DRIFT_RESIDUAL_MS": drift["residual_ms"],
+            "DRIFT_N_ARTIFACTS": drift["n_artifacts"],
+        }
+
+    elif not INTERACTIVE:
+        _update_and_save_multiple_params(
+            {"TIMESHIFT_MODE": "failed"}, session_ID, saving_path
+        )
+        return None
+
+    else:
+        print("Select the first sample of the last artifact in the intracranial recording")
+        last_artifact_lfp_x = select_sample(
+            signal=LFP_channel_offset, sf=sf_LFP, color1="peachpuff", color2="darkorange"
+        )
+        print("Select the first sample of the last artifact in the external recording")
+        last_artifact_external_x = select_sample(
+            signal=filtered_external_offset,
+            sf=sf_external,
+            color1="paleturquoise",
+            color2="darkcyan",
+        )
+        dictionary = {"TIMESHIFT_MODE": "manual"}
 
     timeshift_ms = (last_artifact_external_x - last_artifact_lfp_x) * 1000
     
-    dictionary = {"TIMESHIFT": timeshift_ms, "REC DURATION FOR TIMESHIFT": last_artifact_external_x}
+    dictionary.update({"TIMESHIFT": timeshift_ms, "REC DURATION FOR TIMESHIFT": last_artifact_external_x})
     _update_and_save_multiple_params(dictionary, session_ID, saving_path)
 
     if abs(timeshift_ms) > 100:
@@ -127,13 +194,187 @@ def check_timeshift(
         transform=ax1.transAxes,
     )
 
+    if drift is not None:
+        ax1.text(
+            0.05,
+            0.75,
+            s="drift: " + str(round(drift["drift_ppm"], 1)) + "ppm",
+            fontsize=14,
+            transform=ax1.transAxes,
+        )
+
     plt.gcf()
-    plt.show(block=True)
+    if drift is None:
+        plt.show(block=True)
     fig.savefig(
         join(
             saving_path,
             "FigA-Timeshift - Intracranial and external recordings aligned - last artifact.png",
         ),
         bbox_inches="tight",
-        dpi=1200,
+        # the figure is only checked by eye when the timeshift was computed
+        # automatically, a lower resolution is faster to render
+        dpi=1200 if drift is None else 300,
+    )
+    if drift is not None:
+        plt.close(fig)
+
+    return timeshift_ms
+
+
+def estimate_drift(
+    artifacts_lfp: np.ndarray,
+    artifacts_external: np.ndarray,
+    max_pairing_distance_s: float = 0.5,
+):
+    """
+    Estimates the clock drift between the intracranial and the external
+    recordings from the times of their artifacts in the synchronized
+    recordings. Each intracranial artifact is paired with the closest external
+    artifact (if closer than max_pairing_distance_s), and the delay between
+    the paired artifacts (external - intracranial) is fitted as a linear
+    function of time: delay = offset + drift * time.
+
+    Inputs:
+        - artifacts_lfp: np.ndarray, times of the intracranial artifacts (s),
+        sorted
+        - artifacts_external: np.ndarray, times of the external artifacts (s),
+        sorted
+        - max_pairing_distance_s: float, largest delay between two paired
+        artifacts (s)
+
+    Returns:
+        - drift: dict, with keys
+            "offset_ms": delay between the recordings at time 0 (ms)
+            "drift_ppm": drift of the external clock relative to the
+            intracranial one (ppm, positive if the delay increases with time)
+            "residual_ms": largest absolute residual of the fit (ms)
+            "n_artifacts": number of paired artifacts
+            "last_artifact_lfp", "last_artifact_external": times of the last
+            paired artifacts (s)
+        or None if less than 2 artifacts could be paired
+    """
+
+    artifacts_lfp = np.asarray(artifacts_lfp, dtype=np.float64)
+    artifacts_external = np.asarray(artifacts_external, dtype=np.float64)
+    if len(artifacts_lfp) == 0 or len(artifacts_external) == 0:
+        return None
+
+    # closest external artifact of each intracranial artifact
+    right = np.clip(
+        np.searchsorted(artifacts_external, artifacts_lfp), 1, len(artifacts_external) - 1
+    )
+    left = right - 1
+    if len(artifacts_external) == 1:
+        left = right = np.zeros(len(artifacts_lfp), dtype=int)
+    closest = np.where(
+        np.abs(artifacts_external[left] - artifacts_lfp)
+        <= np.abs(artifacts_external[right] - artifacts_lfp),
+        left,
+        right,
+    )
+    delays = artifacts_external[closest] - artifacts_lfp
+    paired = np.abs(delays) < max_pairing_distance_s
+    if np.count_nonzero(paired) < 2:
+        return None
+
+    times = artifacts_lfp[paired]
+    delays = delays[paired]
+    drift, offset = np.polyfit(times, delays, 1)
+    residuals = delays - (offset + drift * times)
+
+    return {
+        "offset_ms": float(offset * 1000),
+        "drift_ppm": float(drift * 1e6),
+        "residual_ms": float(np.max(np.abs(residuals)) * 1000),
+        "n_artifacts": int(len(times)),
+        "last_artifact_lfp": float(times[-1]),
+        "last_artifact_external": float(times[-1] + delays[-1]),
+    }
+
+
+def estimate_drift_from_artifacts(
+    session_ID: str,
+    saving_path: str,
+    art_start_LFP: float,
+    art_start_BIP: float,
+):
+    """
+    Estimates the clock drift between the intracranial and the external
+    recordings before their synchronization, from the artifacts saved during
+    detection (artifacts_<session_ID>.npz). The times of the artifacts are
+    taken relative to the first artifact of each recording.
+
+    Inputs:
+        - session_ID: str, the subject ID
+        - saving_path: str, path to the folder where the artifacts are saved
+        - art_start_LFP: float, the timestamp when the artifact starts in
+        intracranial recording
+        - art_start_BIP: float, the timestamp when the artifact starts in
+        external recording
+
+    Returns:
+        - drift: dict, see estimate_drift, or None if the artifacts were not
+        saved or could not be paired
+    """
+
+    trains = _load_artifact_trains(session_ID, saving_path)
+    if "intracranial" not in trains or "external" not in trains:
+        return None
+
+    sf_LFP = trains["intracranial_sf"]
+    sf_external = trains["external_sf"]
+    artifacts_lfp = trains["intracranial"]["onset"] / sf_LFP - art_start_LFP
+    artifacts_external = trains["external"]["onset"] / sf_external - art_start_BIP
+
+    return estimate_drift(artifacts_lfp, artifacts_external)
+
+
+def _estimate_drift_from_saved_artifacts(
+    session_ID: str,
+    loaded_dict: dict,
+    LFP_duration_s: float,
+    sf_LFP: int,
+    external_duration_s: float,
+    sf_external: int,
+    saving_path: str,
+    CROP_BOTH: bool,
+):
+    "Runs estimate_drift on the artifacts saved during detection, if any"
+
+    trains = _load_artifact_trains(session_ID, saving_path)
+    if (
+        "intracranial" not in trains
+        or "external" not in trains
+        or "ART_TIME_LFP" not in loaded_dict
+        or "ART_TIME_BIP" not in loaded_dict
+    ):
+        return None
+
+    # times of the artifacts in the synchronized recordings
+    index_start_LFP, index_start_external = _synchronization_start_indexes(
+        loaded_dict["ART_TIME_LFP"],
+        loaded_dict["ART_TIME_BIP"],
+        sf_LFP,
+        sf_external,
+        CROP_BOTH,
     )
+    artifacts_lfp = (trains["intracranial"]["onset"] - index_start_LFP) / sf_LFP
+    artifacts_external = (
+        trains["external"]["onset"] - index_start_external
+    ) / sf_external
+    if loaded_dict.get("DRIFT_CORRECTION_PPM") is not None:
+        # the external recording was resampled around its first artifact
+        first_artifact = loaded_dict["ART_TIME_BIP"] - index_start_external / sf_external
+        artifacts_external = first_artifact + (artifacts_external - first_artifact) / (
+            1 + loaded_dict["DRIFT_CORRECTION_PPM"] * 1e-6
+        )
+    artifacts_lfp = artifacts_lfp[
+        (artifacts_lfp >= 0) & (artifacts_lfp < LFP_duration_s)
+    ]
+    artifacts_external = artifacts_external[
+        (artifacts_external >= 0) & (artifacts_external < external_duration_s)
+    ]
+
+    return estimate_drift(artifacts_lfp, artifacts_external)
+
@@ -36,13 +36,17 @@ import numpy as np
 import struct
 import datetime
 import mne
-import tkinter as tk
-from tkinter import filedialog
 
 
 class Poly5Reader:
-    def __init__(self, filename=None, readAll=True):
+    def __init__(
+        self, filename=None, readAll=True, mmap=False, dtype=np.float32, verbose=True
+    ):
         if filename == None:
+            # only needed to choose the file, not available on headless machines
+            import tkinter as tk
+            from tkinter import filedialog
+
             root = tk.Tk()
 
             filename = filedialog.askopenfilename()
@@ -50,7 +54,14 @@ class Poly5Reader:
 
         self.filename = filename
         self.readAll = readAll
-        print("Reading file ", filename)
+        self.mmap = mmap
+        # float32 is the native sample format of Poly5 files
+        self.dtype = np.dtype(dtype)
+        self._samples_in_volts = False
+        # verbose=False only keeps the error messages
+        self.verbose = verbose
+        if self.verbose:
+            print("Reading file ", filename)
         self._readFile(filename)
 
     def read_data_MNE(
@@ -97,11 +108,50 @@ class Poly5Reader:
         info = mne.create_info(ch_names=labels, sfreq=fs, ch_types=types_clean)
 
         # convert from microvolts to volts if necessary
-        scale = np.array([1e-6 if u == "µVolt" else 1 for u in units])
+        scale = self._unitScale()
+
+        samples = np.asarray(self.samples)
+        if not self._samples_in_volts:
+            samples = samples * np.expand_dims(scale, axis=1)
 
-        raw = mne.io.RawArray(self.samples * np.expand_dims(scale, axis=1), info)
+        raw = mne.io.RawArray(samples, info)
         return raw
 
+    def read_data_numpy(self):
+        """Return the samples converted from microvolts to volts if necessary,
+        without building an MNE object.
+
+        The conversion is done in place on the decoded samples, so that no copy
+        of the recording is made. In memory-mapped mode, a scaled view is
+        returned and samples are only converted when they are read.
+
+        Returns
+        -------
+        np.ndarray or Poly5SampleView (channels, samples)
+        """
+
+        if self.mmap:
+            return self.samples.with_scale(self._unitScale(), self.dtype)
+
+        if not self._samples_in_volts:
+            scale = self._unitScale().astype(self.dtype)
+            self.samples *= np.expand_dims(scale, axis=1)
+            self._samples_in_volts = True
+        return self.samples
+
+    def get_channel(self, name):
+        """Return the samples of a single channel, given its name.
+
+        In memory-mapped mode only this channel is read from the file.
+        """
+        ch_index = self.ch_names.index(name)
+        return self.samples[ch_index]
+
+    def _unitScale(self):
+        "Scaling factor per channel to convert from microvolts to volts if necessary"
+        units = [s._Channel__unit_name for s in self.channels]
+        return np.array([1e-6 if u == "µVolt" else 1 for u in units])
+
     def _readFile(self, filename):
         try:
             self.file_obj = open(filename, "rb")
@@ -109,61 +159,31 @@ class Poly5Reader:
             try:
                 self._readHeader(file_obj)
                 self.channels = self._readSignalDescription(file_obj)
-                self._myfmt = "f" * self.num_channels * self.num_samples_per_block
                 self._buffer_size = self.num_channels * self.num_samples_per_block
+                self._data_offset = file_obj.tell()
+                self._next_block = 0
 
-                if self.readAll:
-                    sample_buffer = np.zeros(self.num_channels * self.num_samples)
-
-                    for i in range(self.num_data_blocks):
-                        print(
-                            "\rProgress: % 0.1f %%" % (100 * i / self.num_data_blocks),
-                            end="\r",
-                        )
-
-                        # Check whether final data block is filled completely or not
-                        if i == self.num_data_blocks - 1:
-                            _final_block_size = self.num_samples / self.num_data_blocks
-                            if _final_block_size % self.num_samples_per_block != 0:
-                                data_block = self._readSignalBlock(
-                                    file_obj,
-                                    buffer_size=(
-                                        self.num_samples % self.num_samples_per_block
-                                    )
-                                    * self.num_channels,
-                                    myfmt="f"
-                                    * (self.num_samples % self.num_samples_per_block)
-                                    * self.num_channels,
-                                )
-                            else:
-                                data_block = self._readSignalBlock(
-                                    file_obj, self._buffer_size, self._myfmt
-                                )
-                        else:
-                            data_block = self._readSignalBlock(
-                                file_obj, self._buffer_size, self._myfmt
-                            )
-
-                        # Get indices that need to be filled in the samples array
-                        i1 = i * self.num_samples_per_block * self.num_channels
-                        i2 = (i + 1) * self.num_samples_per_block * self.num_channels
-
-                        # Correct for final data block if this is not fully filled
-                        if i2 >= self.num_samples * self.num_channels:
-                            i2 = self.num_samples * self.num_channels
-
-                        # Insert the read data_block into the sample_buffer array
-                        sample_buffer[i1:i2] = data_block
+                self.ch_names = [s._Channel__name for s in self.channels]
+                self.ch_unit_names = [s._Channel__unit_name for s in self.channels]
+
+                if self.mmap:
+                    # Map the data blocks without reading them, samples are
+                    # only decoded when indexing self.samples
+                    self.samples = self._mapSignalBlocks(file_obj)
+                    self.file_obj.close()
+
+                elif self.readAll:
+                    # Decode all data blocks at once: every block is an 86-byte
+                    # header followed by the interleaved float32 samples.
+                    sample_buffer = self._readSignalBlocks(file_obj)
 
                     samples = np.transpose(
                         np.reshape(sample_buffer, [self.num_samples, self.num_channels])
                     )
 
-                    self.ch_names = [s._Channel__name for s in self.channels]
-                    self.ch_unit_names = [s._Channel__unit_name for s in self.channels]
-
                     self.samples = samples
-                    print("Done reading data.")
+                    if self.verbose:
+                        print("Done reading data.")
                     self.file_obj.close()
 
             except Exception as e:
@@ -177,23 +197,12 @@ class Poly5Reader:
         if n_blocks == None:
             n_blocks = self.num_data_blocks
 
-        sample_buffer = np.zeros(
-            self.num_channels * n_blocks * self.num_samples_per_block
+        sample_buffer = self._readSignalBlocks(
+            self.file_obj, first_block=self._next_block, n_blocks=n_blocks
         )
+        self._next_block = min(self._next_block + n_blocks, self.num_data_blocks)
 
-        for i in range(n_blocks):
-            data_block = self._readSignalBlock(
-                self.file_obj, self._buffer_size, self._myfmt
-            )
-            i1 = i * self.num_samples_per_block * self.num_channels
-            i2 = (i + 1) * self.num_samples_per_block * self.num_channels
-            sample_buffer[i1:i2] = data_block
-
-        samples = np.transpose(
-            np.reshape(
-                sample_buffer, [self.num_samples_per_block * (i + 1), self.num_channels]
-            )
-        )
+        samples = np.transpose(np.reshape(sample_buffer, [-1, self.num_channels]))
         return samples
 
     def _readHeader(self, f):
@@ -218,7 +227,7 @@ class Poly5Reader:
             print("This is not a Poly5 file.")
         elif version_number != 203:
             print("Version number of file is invalid.")
-        else:
+        elif self.verbose:
             print("\t Number of samples:  %s " % self.num_samples)
             print("\t Number of channels:  %s " % self.num_channels)
             print("\t Sample rate: %s Hz" % self.sample_rate)
@@ -234,17 +243,189 @@ class Poly5Reader:
             f.read(136)
         return chan_list
 
-    def _readSignalBlock(self, f, buffer_size, myfmt):
-        f.read(86)
-        sampleData = f.read(buffer_size * 4)
-        DataBlock = struct.unpack(myfmt, sampleData)
-        SignalBlock = np.asarray(DataBlock)
-        return SignalBlock
+    def _blockDtype(self, num_samples_per_block=None):
+        "Structured dtype of one data block: 86-byte header + float32 payload"
+        if num_samples_per_block == None:
+            num_samples_per_block = self.num_samples_per_block
+        return np.dtype(
+            [
+                ("header", "V86"),
+                ("data", "<f4", (num_samples_per_block * self.num_channels,)),
+            ]
+        )
+
+    def _readSignalBlocks(self, f, first_block=0, n_blocks=None):
+        """Read n_blocks data blocks in one pass, starting at the current position
+        of f which is the start of block first_block. A short final block is
+        read as such."""
+        if n_blocks == None:
+            n_blocks = self.num_data_blocks - first_block
+
+        num_full_blocks = min(
+            self.num_samples // self.num_samples_per_block, self.num_data_blocks
+        )
+        num_final_samples = self.num_samples - (
+            num_full_blocks * self.num_samples_per_block
+        )
+        last_block = min(first_block + n_blocks, self.num_data_blocks)
+        num_full_blocks_read = max(0, min(last_block, num_full_blocks) - first_block)
+        # the short final block is only read if it is in the requested range
+        if first_block >= last_block or last_block <= num_full_blocks:
+            num_final_samples = 0
+
+        sample_buffer = np.zeros(
+            self.num_channels
+            * (num_full_blocks_read * self.num_samples_per_block + num_final_samples),
+            dtype=self.dtype,
+        )
+        i2 = num_full_blocks_read * self._buffer_size
+
+        # Block headers are skipped by the structured dtype, payloads are
+        # copied straight into the sample buffer
+        blocks = np.fromfile(f, dtype=self._blockDtype(), count=num_full_blocks_read)
+        full_blocks_buffer = sample_buffer[:i2].reshape(
+            num_full_blocks_read, self._buffer_size
+        )
+        full_blocks_buffer[:] = blocks["data"]
+
+        if num_final_samples > 0:
+            final_block = np.fromfile(
+                f, dtype=self._blockDtype(num_final_samples), count=1
+            )
+            sample_buffer[i2:] = final_block["data"][0]
+
+        return sample_buffer
+
+    def _mapSignalBlocks(self, f):
+        "Memory-map all data blocks of the file, including a short final block"
+        num_full_blocks = min(
+            self.num_samples // self.num_samples_per_block, self.num_data_blocks
+        )
+        num_final_samples = self.num_samples - (
+            num_full_blocks * self.num_samples_per_block
+        )
+        offset = self._data_offset
+
+        full_blocks = np.memmap(
+            self.filename,
+            dtype=self._blockDtype(),
+            mode="r",
+            offset=offset,
+            shape=(num_full_blocks,),
+        )
+        final_block = None
+        if num_final_samples > 0:
+            final_block = np.memmap(
+                self.filename,
+                dtype=self._blockDtype(num_final_samples),
+                mode="r",
+                offset=offset + num_full_blocks * self._blockDtype().itemsize,
+                shape=(1,),
+            )["data"].reshape(num_final_samples, self.num_channels)
+
+        return Poly5SampleView(
+            full_blocks["data"].reshape(
+                num_full_blocks, self.num_samples_per_block, self.num_channels
+            ),
+            final_block,
+            dtype=self.dtype,
+        )
 
     def close(self):
         self.file_obj.close()
 
 
+class Poly5SampleView:
+    """Read-only (channels, samples) view over memory-mapped Poly5 data blocks.
+
+    The samples of a Poly5 file are stored interleaved in blocks that are
+    separated by block headers, so they cannot be exposed as a plain strided
+    array. This view behaves like a 2D array for indexing: only the requested
+    channels and samples are read from the file and returned as np.ndarray.
+
+    full_blocks : np.ndarray (blocks, samples per block, channels), mapped payloads
+    final_block : np.ndarray (samples, channels) or None, short final block
+    scale : np.ndarray or None, factor per channel applied to the returned samples
+    dtype : dtype of the returned samples
+    """
+
+    def __init__(self, full_blocks, final_block=None, scale=None, dtype=np.float32):
+        self._full_blocks = full_blocks
+        self._final_block = final_block
+        self._scale = scale
+        self.dtype = np.dtype(dtype)
+
+        num_full_blocks, self._samples_per_block, num_channels = full_blocks.shape
+        num_samples = num_full_blocks * self._samples_per_block
+        if final_block is not None:
+            num_samples += len(final_block)
+        self.shape = (num_channels, num_samples)
+        self.ndim = 2
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        samples = self[:, :]
+        return samples if dtype is None else samples.astype(dtype)
+
+    def with_scale(self, scale, dtype=None):
+        "Return a view over the same blocks with a scaling factor per channel"
+        if dtype == None:
+            dtype = self.dtype
+        return Poly5SampleView(
+            self._full_blocks, self._final_block, np.asarray(scale), dtype
+        )
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        ch_key, sample_key = key
+
+        if isinstance(sample_key, slice) and (sample_key.step or 1) > 0:
+            start, stop, step = sample_key.indices(self.shape[1])
+            samples = self._readRange(ch_key, start, max(start, stop))[::step]
+        elif isinstance(sample_key, (int, np.integer)):
+            if sample_key < 0:
+                sample_key += self.shape[1]
+            if not 0 <= sample_key < self.shape[1]:
+                raise IndexError("sample index out of range")
+            samples = self._readRange(ch_key, sample_key, sample_key + 1)[0]
+        else:
+            # any other index is resolved on the smallest range covering it
+            indices = np.arange(self.shape[1])[sample_key]
+            start = indices.min() if indices.size else 0
+            stop = indices.max() + 1 if indices.size else 0
+            samples = self._readRange(ch_key, start, stop)[indices - start]
+
+        # samples along the last axis, as for a (channels, samples) array
+        return np.moveaxis(samples, 0, -1) if samples.ndim > 1 else samples
+
+    def _readRange(self, ch_key, start, stop):
+        "Read samples [start, stop) of the selected channels, samples first"
+        num_full_blocks = len(self._full_blocks)
+        first_block = start // self._samples_per_block
+        last_block = min(-(-stop // self._samples_per_block), num_full_blocks)
+
+        parts = []
+        if last_block > first_block:
+            part = self._full_blocks[first_block:last_block, :, ch_key]
+            parts.append(np.reshape(part, (-1,) + part.shape[2:]))
+        if stop > num_full_blocks * self._samples_per_block:
+            parts.append(self._final_block[:, ch_key])
+        if not parts:
+            parts.append(self._full_blocks[0:0, 0, ch_key])
+
+        first_sample = min(first_block, num_full_blocks) * self._samples_per_block
+        samples = np.array(
+            np.concatenate(parts) if len(parts) > 1 else parts[0], dtype=self.dtype
+        )
+        samples = samples[start - first_sample : stop - first_sample]
+        if self._scale is not None:
+            samples *= self._scale.astype(self.dtype)[ch_key]
+        return samples
+
+
 class Channel:
     """'Channel' represents a device channel. It has the next properties:
 
@@ -2,42 +2,203 @@
 utilisation function
 """
 
+import io
 import os
+import atexit
+import csv
 import json
-from tkinter.filedialog import askdirectory
+import datetime
+import threading
 import scipy
 import operator
 import pandas as pd
 import numpy as np
 
 
-parameters = {}
+class SessionParameters:
+    """
+    Parameters of a session, saved in parameters_<session_ID>.json. The
+    updates are kept in memory and the file is only written by flush, at the
+    end of each stage of the analysis and when the session ends. It is
+    written to a temporary file first and then renamed, so it is never left
+    incomplete. The store can be updated by several threads at once (see
+    batch.run_in_threads).
+
+    Inputs:
+        - session_ID: str, the session identifier
+        - saving_path: str, the path where to save the json file
+    """
+
+    def __init__(self, session_ID: str, saving_path: str):
+        self.session_ID = str(session_ID)
+        self.saving_path = saving_path
+        self.values = {}
+        self.modified = False  # updates not written yet
+        self._lock = threading.RLock()
+
+    def update(self, dictionary: dict):
+        "Updates the parameters, without writing them"
+        with self._lock:
+            self.values.update(dictionary)
+            self.modified = True
+
+    def as_dict(self):
+        "Returns a copy of the parameters"
+        with self._lock:
+            return dict(self.values)
+
+    def flush(self):
+        "Writes the parameters in the json file, if they were updated"
+        with self._lock:
+            if not self.modified:
+                return
+            json_file_path = os.path.join(
+                self.saving_path, "parameters_" + self.session_ID + ".json"
+            )
+            tmp_file_path = f"{json_file_path}.{os.getpid()}.tmp"
+            with open(tmp_file_path, "w") as json_file:
+                json.dump(self.values, json_file, indent=4)
+            os.replace(tmp_file_path, json_file_path)
+            self.modified = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+
+# parameters of the session analyzed in each thread: the sessions loaded in the
+# background (see batch.SessionPrefetcher) do not mix their parameters with the
+# session analyzed in the main thread
+_thread_parameters = threading.local()
+
+
+def _start_session(session_ID: str, saving_path: str):
+    """
+    This function starts the parameters of a new session in the current
+    thread, so the parameters of the previous session are not saved with the
+    new one. The parameters of the previous session not written yet are
+    written first.
+
+    Inputs:
+        - session_ID: str, the session identifier
+        - saving_path: str, the path where to save the json file
+
+    Returns:
+        - session_parameters: SessionParameters, the parameters of the session
+    """
+
+    _flush_params()
+    _thread_parameters.parameters = SessionParameters(session_ID, saving_path)
+
+    return _thread_parameters.parameters
+
+
+def _get_params():
+    """
+    This function returns the parameters of the session analyzed in the
+    current thread (SessionParameters), or None if no session was started.
+    """
+
+    return getattr(_thread_parameters, "parameters", None)
+
+
+def _use_params(session_parameters: SessionParameters):
+    """
+    This function makes the current thread update the parameters of the
+    session of another thread (see batch.run_in_threads).
+
+    Inputs:
+        - session_parameters: SessionParameters, returned by _get_params in
+        the other thread
+    """
+
+    _thread_parameters.parameters = session_parameters
+
+
+def _flush_params():
+    """
+    This function writes the parameters of the session of the current
+    thread that were not written yet. It is called at the end of each stage
+    of the analysis, and when the program exits.
+    """
+
+    session_parameters = _get_params()
+    if session_parameters is not None:
+        session_parameters.flush()
+
+
+# the parameters of the last session of the main thread are written on exit,
+# even if the analysis failed:
+atexit.register(_flush_params)
+
+
+def _session_params(session_ID: str, saving_path: str):
+    "Parameters of the given session, started if it is not the current one"
+
+    session_parameters = _get_params()
+    if (
+        session_parameters is None
+        or session_parameters.session_ID != str(session_ID)
+        or os.path.normpath(session_parameters.saving_path) != os.path.normpath(saving_path)
+    ):
+        session_parameters = _start_session(session_ID, saving_path)
+
+    return session_parameters
+
+
+def _load_params(session_ID: str, saving_path: str):
+    """
+    This function returns the parameters of a session: those of the current
+    session if it is this one (including the updates not written yet),
+    otherwise those saved in its json file.
+
+    Inputs:
+        - session_ID: str, the session identifier
+        - saving_path: str, the path where to find the json file
+
+    Returns:
+        - loaded_dict: dict, the parameters of the session
+    """
+
+    session_parameters = _get_params()
+    if (
+        session_parameters is not None
+        and session_parameters.session_ID == str(session_ID)
+        and os.path.normpath(session_parameters.saving_path) == os.path.normpath(saving_path)
+    ):
+        return session_parameters.as_dict()
+
+    json_filename = os.path.join(saving_path, "parameters_" + str(session_ID) + ".json")
+    with open(json_filename, "r") as f:
+        loaded_dict = json.load(f)
+
+    return loaded_dict
+
+
 def _update_and_save_multiple_params(
         dictionary: dict, 
         session_ID: str, 
         saving_path: str
         ):
     """
-    This function is used to update the parameters dictionary and save it in a json file.
+    This function is used to update the parameters of the session. They are
+    saved in its json file at the end of the current stage (see _flush_params).
 
     Inputs:
         - dictionary: dict, contains multiple keys and their values
         - session_ID: str, the session identifier
         - saving_path: str, the path where to save/find the json file
     """
-    for key, value in dictionary.items():
-        parameters[key] = value
-    
-    parameter_filename = "parameters_" + str(session_ID) + ".json"
-    json_file_path = os.path.join(saving_path, parameter_filename)
-    with open(json_file_path, "w") as json_file:
-        json.dump(parameters, json_file, indent=4)
 
+    _session_params(session_ID, saving_path).update(dictionary)
 
 
 def _update_and_save_params(key, value, session_ID: str, saving_path: str):
     """
-    This function is used to update the parameters dictionary and save it in a json file.
+    This function is used to update a parameter of the session. It is saved
+    in its json file at the end of the current stage (see _flush_params).
 
     Inputs:
         - key: the key of the parameter to update
@@ -46,11 +207,115 @@ def _update_and_save_params(key, value, session_ID: str, saving_path: str):
         - saving_path: str, the path where to save/find the json file
     """
 
-    parameters[key] = value
-    parameter_filename = "parameters_" + str(session_ID) + ".json"
-    json_file_path = os.path.join(saving_path, parameter_filename)
-    with open(json_file_path, "w") as json_file:
-        json.dump(parameters, json_file, indent=4)
+    _session_params(session_ID, saving_path).update({key: value})
+
+
+
+def _update_and_save_artifact_train(
+        recording: str,
+        train: np.ndarray,
+        sf: float,
+        session_ID: str,
+        saving_path: str
+        ):
+    """
+    This function is used to save the artifacts detected in a recording in
+    the artifacts_<session_ID>.npz file, next to the parameters json file.
+    The artifacts of the other recording already saved in the file are kept.
+
+    Inputs:
+        - recording: str, "external" or "intracranial"
+        - train: np.ndarray, artifacts of the recording (ARTIFACT_TRAIN_DTYPE
+        of find_artifacts.py)
+        - sf: float, sampling frequency of the recording
+        - session_ID: str, the session identifier
+        - saving_path: str, the path where to save/find the npz file
+    """
+
+    trains = _load_artifact_trains(session_ID, saving_path)
+    trains[recording] = train
+    trains[recording + "_sf"] = np.float64(sf)
+
+    artifacts_filename = "artifacts_" + str(session_ID) + ".npz"
+    npz_file_path = os.path.join(saving_path, artifacts_filename)
+    # write to a temporary file first, so that the file is never left incomplete
+    with open(npz_file_path + ".tmp", "wb") as npz_file:
+        np.savez(npz_file, **trains)
+    os.replace(npz_file_path + ".tmp", npz_file_path)
+
+
+
+def _load_artifact_trains(session_ID: str, saving_path: str):
+    """
+    This function is used to load the artifacts saved with
+    _update_and_save_artifact_train.
+
+    Inputs:
+        - session_ID: str, the session identifier
+        - saving_path: str, the path where to find the npz file
+
+    Returns:
+        - trains: dict, with the artifacts of each recording saved ("external",
+        "intracranial") and their sampling frequency ("external_sf",
+        "intracranial_sf"). Empty if no artifacts were saved yet.
+    """
+
+    artifacts_filename = "artifacts_" + str(session_ID) + ".npz"
+    npz_file_path = os.path.join(saving_path, artifacts_filename)
+    if not os.path.isfile(npz_file_path):
+        return {}
+
+    with np.load(npz_file_path) as npz_file:
+        trains = {key: npz_file[key] for key in npz_file.files}
+
+    return trains
+
+
+
+def _add_to_review_queue(
+        session_ID: str,
+        stage: str,
+        reason: str,
+        confidence,
+        results_path: str
+        ):
+    """
+    This function is used in headless mode to list the sessions that could
+    not be processed without a user decision, in the review_queue.csv file
+    of the results folder. A row is appended for each session to review.
+
+    Inputs:
+        - session_ID: str, the session identifier
+        - stage: str, the step of the analysis that needs a review
+        - reason: str, why the session needs a review
+        - confidence: float or None, the confidence of the automatic decision
+        - results_path: str, the path where to save/find the csv file
+    """
+
+    queue_file_path = os.path.join(results_path, "review_queue.csv")
+    # sessions analyzed in parallel may add rows at the same time: the header
+    # is only written by the process creating the file, and each row is
+    # appended with a single write
+    try:
+        with open(queue_file_path, "x", newline="") as queue_file:
+            csv.writer(queue_file).writerow(
+                ["session_ID", "stage", "reason", "confidence", "date"]
+            )
+    except FileExistsError:
+        pass
+    row = io.StringIO()
+    csv.writer(row).writerow(
+        [
+            session_ID,
+            stage,
+            reason,
+            "" if confidence is None else confidence,
+            datetime.datetime.now().isoformat(timespec="seconds"),
+        ]
+    )
+    with open(queue_file_path, "a", newline="") as queue_file:
+        queue_file.write(row.getvalue())
+    print(f"Session {session_ID} added to the review queue ({stage}): {reason}")
 
 
 
@@ -172,6 +437,29 @@ def _get_user_input(message: str) -> int:
     return user_input
 
 
+def _is_mat_v73(file_path: str):
+    """
+    This function checks if a .mat file was saved in the v7.3 format, which
+    is an HDF5 file that cannot be read with scipy.io.loadmat.
+
+    Inputs:
+        - file_path: str, path to the .mat file
+
+    Returns:
+        - bool, indicates if the file is a v7.3 .mat file
+    """
+
+    with open(file_path, "rb") as f:
+        header = f.read(128)
+
+    return b"MATLAB 7.3" in header
+
+
+def _h5_string(f, ref):
+    "Decode a MATLAB char array referenced in a v7.3 .mat file"
+    return "".join(chr(c) for c in f[ref][()].ravel())
+
+
 def _detrend_data(data: np.ndarray):
     """
     This function is used to detrend the data using a high-pass filter.
@@ -196,6 +484,9 @@ def _define_folders():
     """
 
     # import settings
+    # only imported here, tkinter is not available on headless machines
+    from tkinter.filedialog import askdirectory
+
     json_path = os.path.join(os.getcwd(), "config")
     json_filename = "config.json"
     with open(os.path.join(json_path, json_filename), "r") as f:
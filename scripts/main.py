@@ -1,4 +1,6 @@
 import os
+import time
+import functools
 from os.path import join
 
 from functions.loading_data import (
@@ -7,15 +9,18 @@ from functions.loading_data import (
     load_sourceJSON
 )
 from functions.plotting import plot_LFP_external, ecg
-from functions.timeshift import check_timeshift
-from functions.utils import _update_and_save_params, _update_and_save_multiple_params, _get_input_y_n, _get_user_input
+from functions.timeshift import check_timeshift, estimate_drift_from_artifacts
+from functions.utils import _update_and_save_params, _update_and_save_multiple_params, _start_session, _flush_params
 from functions.resync_function import (
-    detect_artifacts_in_external_recording,
-    detect_artifacts_in_intracranial_recording,
+    detect_artifacts_in_both_recordings,
     synchronize_recordings,
+    refine_alignment,
     save_synchronized_recordings,
 )
 from functions.packet_loss import check_packet_loss
+from functions.cache import RecordingCache
+from functions.batch import run_in_threads
+from functions.results_index import index_session
 
 
 def main(
@@ -29,8 +34,16 @@ def main(
     CROP_BOTH=False,
     CHECK_FOR_TIMESHIFT=True,
     CHECK_FOR_PACKET_LOSS=False,
+    CORRECT_DRIFT=False,
+    REFINE_ALIGNMENT=False,
     PREPROCESSING="Perceive",
+    USE_PYMATREADER=False,
     trial_idx_lfp=3,
+    dtype="float32",
+    cache_dir=None,
+    cache_max_size_gb=20,
+    external_channels=None,
+    auto_accept_confidence=None,
 ):
 
     """
@@ -61,19 +74,58 @@ def main(
     CROP_BOTH: boolean, if True, crop both LFP and external data to the shortest
                 if False, crop only the external data to match the intracranial
 
-    CHECK_FOR_TIMESHIFT: boolean, if True, perform timeshift analysis
+    CHECK_FOR_TIMESHIFT: boolean, if True, perform timeshift analysis. The clock drift
+                    is estimated automatically from the artifacts detected, the
+                    last artifacts only have to be selected by hand if it fails
 
     CHECK_FOR_PACKET_LOSS: boolean, if True, perform packet loss analysis
 
+    CORRECT_DRIFT: boolean, if True, the clock drift between the two recordings is
+                    estimated from the artifacts detected, and the external
+                    recording is resampled onto the clock of the intracranial one
+
+    REFINE_ALIGNMENT: boolean, if True, the alignment of the first artifact is refined
+                    below the sampling period of the intracranial recording, by
+                    cross-correlating the artifact envelopes of both recordings
+
     PREPROCESSING: string, 'Perceive' or 'DBScope'. The preprocessing toolbox used
                     to preprocess the LFP data (convert the JSON file to a 
                     Fieldtrip .mat file). If 'DBScope', the trial_idx_lfp parameter
                     will be used to select the correct trial in the DBScope file.
     
+    USE_PYMATREADER: boolean, only used if PREPROCESSING is 'Perceive'. If True,
+                    the Fieldtrip .mat file is read directly with pymatreader
+                    (faster, without creating an MNE object, requires pymatreader).
+                    If False (default), it is read with MNE.
+
     trial_idx_lfp: int, only used if PREPROCESSING is 'DBScope'. It corresponds to
                     the number indicated in the DBScope viewer for Streamings, under
                     "Select recording" - 1.
 
+    dtype: string, 'float32' or 'float64'. Data type used to load, synchronize
+                    and save the recordings. 'float32' (default) is the native
+                    format of Poly5 files and halves memory use and output size.
+                    Artifact detection is always computed in float64.
+
+    cache_dir: string or None, folder where decoded recordings are cached
+                    (e.g. "cache"). When a session is re-run, its recordings are
+                    then opened from the cache instead of being decoded again.
+                    Poly5 files are not cached, they are already read lazily.
+                    None (default) disables the cache.
+
+    cache_max_size_gb: float, maximum size of the cache folder. The least recently
+                    used recordings are removed from the cache above this size.
+
+    external_channels: list or None, names of the external channels to keep in
+                    the synchronized recording (the BIP channel is always kept).
+                    Only these channels are read from .csv files. None (default)
+                    keeps all the channels.
+
+    auto_accept_confidence: float or None, the intracranial artifacts found by the
+                    most consistent automatic method are accepted without asking
+                    when their consistency with the external artifacts (between
+                    0 and 1) is at least this value. None (default) always asks.
+
     .................................................................................
 
     Results
@@ -97,6 +149,7 @@ def main(
     - Fig A : Timeshift - Intracranial and external recordings aligned - last artifact
 
     """
+    start = time.perf_counter()
     working_path = os.getcwd()
 
     #  Set saving path
@@ -104,10 +157,16 @@ def main(
     saving_path = join(results_path, session_ID)
     if not os.path.isdir(saving_path):
         os.makedirs(saving_path)
+    _start_session(session_ID, saving_path)
 
     #  Set source path
     source_path = join(working_path, "sourcedata")
 
+    #  Set cache of decoded recordings
+    cache = None
+    if cache_dir is not None:
+        cache = RecordingCache(join(working_path, cache_dir), cache_max_size_gb)
+
     #  1. LOADING DATASETS
 
     ##  Intracranial LFP
@@ -117,19 +176,18 @@ def main(
     # 3. the names of all the channels recorded intracerebrally (LFP_rec_ch_names)
     # 4. the sampling frequency of the intracranial recording (sf_LFP)
 
-    (
-        LFP_array, 
-        lfp_sig, 
-        LFP_rec_ch_names, 
-        sf_LFP
-    ) = load_intracranial(
+    load_LFP = functools.partial(
+        load_intracranial,
         session_ID=session_ID,
         fname_lfp=fname_lfp,
         ch_idx_lfp=ch_idx_lfp,
         trial_idx_lfp=trial_idx_lfp,
         saving_path=saving_path,
         source_path=source_path,
-        PREPROCESSING=PREPROCESSING
+        PREPROCESSING=PREPROCESSING,
+        dtype=dtype,
+        cache=cache,
+        USE_PYMATREADER=USE_PYMATREADER,
     )
 
         ##  External data recorder
@@ -140,86 +198,81 @@ def main(
     # 4. the sampling frequency of the external recording (sf_external)
     # 5. the index of the bipolar channel in the external recording (ch_index_external)
 
+    load_BIP = functools.partial(
+        load_external,
+        session_ID=session_ID,
+        fname_external=fname_external,
+        BIP_ch_name=BIP_ch_name,
+        saving_path=saving_path,
+        source_path=source_path,
+        dtype=dtype,
+        cache=cache,
+        external_channels=external_channels,
+    )
+
+    # both recordings are read at the same time:
     (
-        external_file, 
-        BIP_channel, 
-        external_rec_ch_names, 
-        sf_external, 
-        ch_index_external
-        ) = load_external(
-            session_ID=session_ID,
-            fname_external=fname_external,
-            BIP_ch_name=BIP_ch_name,
-            saving_path=saving_path,
-            source_path=source_path
-        )
+        (LFP_array, lfp_sig, LFP_rec_ch_names, sf_LFP),
+        (external_file, BIP_channel, external_rec_ch_names, sf_external, ch_index_external),
+    ) = run_in_threads(load_LFP, load_BIP)
+    _flush_params()
 
     #  2. FIND ARTIFACTS IN BOTH RECORDINGS:
-    # 2.1. Find artifacts in external recording:
-    art_start_BIP = detect_artifacts_in_external_recording(
+    (art_start_BIP, art_start_LFP) = detect_artifacts_in_both_recordings(
         session_ID=session_ID,
+        lfp_sig=lfp_sig,
+        sf_LFP=sf_LFP,
         BIP_channel=BIP_channel,
         sf_external=sf_external,
         saving_path=saving_path,
-        start_index=0,
-    )
-    artifact_correct = _get_input_y_n(
-        "Is the external DBS artifact properly selected ? "
+        auto_accept_confidence=auto_accept_confidence,
     )
-    if artifact_correct in ("y", "Y"):
-        _update_and_save_params(
-            key="ART_TIME_BIP",
-            value=art_start_BIP,
-            session_ID=session_ID,
-            saving_path=saving_path
-        )
-    else:
-        # if there's an unrelated artifact or if the stimulation is ON at the beginning
-        # of the recording, the user can input the number of seconds to ignore at the
-        # beginning of the recording, and the function will start looking for artifacts
-        # after that time.
-        start_later = _get_user_input(
-            "How many seconds in the beginning should be ignored "
-        )
-        start_later_index = start_later * sf_external
-        art_start_BIP = detect_artifacts_in_external_recording(
-            session_ID=session_ID,
+    _flush_params()
+
+    # OPTIONAL : refine the alignment below the intracranial sampling period:
+    if REFINE_ALIGNMENT:
+        (art_start_BIP_refined, offset_ms, confidence, accepted) = refine_alignment(
+            lfp_sig=lfp_sig,
             BIP_channel=BIP_channel,
+            art_start_LFP=art_start_LFP,
+            art_start_BIP=art_start_BIP,
+            sf_LFP=sf_LFP,
             sf_external=sf_external,
-            saving_path=saving_path,
-            start_index=start_later_index,
         )
-        _update_and_save_params(
-            key="ART_TIME_BIP",
-            value=art_start_BIP,
-            session_ID=session_ID,
-            saving_path=saving_path,
+        print(
+            f"Alignment refined by {offset_ms:.3f} ms (confidence {confidence:.2f})."
         )
-
-        # 2.2. Find artifacts in intracranial recording:
-    methods = ["thresh", "2", "1", "manual"]
-    # thresh takes the last sample that lies within the value distribution of the 
-        # thres_window (aka: baseline window) before the threshold passing
-    # kernel 1 only searches for the steep decrease
-    # kernel 2 is more custom and takes into account the steep decrease and slow recover
-    # manual kernel is for none of the three previous methods work. Then the artifact
-        # has to be manually selected by the user, in a pop up window that will automatically open.
-    for method in methods:
-        print("Running resync with method = {}...".format(method))
-        art_start_LFP = detect_artifacts_in_intracranial_recording(
+        if accepted:
+            dictionary = {
+                "ART_TIME_BIP_DETECTED": art_start_BIP,
+                "ART_TIME_BIP": art_start_BIP_refined,
+                "ALIGNMENT_OFFSET_MS": offset_ms,
+                "ALIGNMENT_CONFIDENCE": confidence,
+            }
+            _update_and_save_multiple_params(dictionary, session_ID, saving_path)
+            art_start_BIP = art_start_BIP_refined
+        else:
+            print("WARNING: the refinement is not reliable, the alignment is not refined.")
+
+    # OPTIONAL : estimate the clock drift to correct it:
+    drift_ppm = None
+    if CORRECT_DRIFT:
+        drift = estimate_drift_from_artifacts(
             session_ID=session_ID,
-            lfp_sig=lfp_sig,
-            sf_LFP=sf_LFP,
             saving_path=saving_path,
-            method=method
+            art_start_LFP=art_start_LFP,
+            art_start_BIP=art_start_BIP,
         )
-        artifact_correct = _get_input_y_n(
-            "Is the intracranial DBS artifact properly selected ? "
-        )
-        if artifact_correct in ("y","Y"):
-            dictionary = {"ART_TIME_LFP": art_start_LFP, "METHOD": method}
-            _update_and_save_multiple_params(dictionary,session_ID,saving_path)
-            break
+        if drift is None:
+            print("WARNING: the clock drift could not be estimated, it is not corrected.")
+        else:
+            drift_ppm = drift["drift_ppm"]
+    _update_and_save_params(
+        key="DRIFT_CORRECTION_PPM",
+        value=drift_ppm,
+        session_ID=session_ID,
+        saving_path=saving_path,
+    )
 
     # 3. SYNCHRONIZE RECORDINGS TOGETHER:
     (LFP_synchronized, external_synchronized) = synchronize_recordings(
@@ -230,15 +283,17 @@ def main(
         sf_LFP=sf_LFP,
         sf_external=sf_external,
         CROP_BOTH=CROP_BOTH,
+        dtype=dtype,
+        drift_ppm=drift_ppm,
     )
 
     # 4. SAVE SYNCHRONIZED RECORDINGS:
-    _update_and_save_params(
-        key="SAVING_FORMAT",
-        value=saving_format,
-        session_ID=session_ID,
-        saving_path=saving_path,
+    _update_and_save_multiple_params(
+        {"SAVING_FORMAT": saving_format, "DTYPE": dtype},
+        session_ID,
+        saving_path,
     )
+    _flush_params()
     save_synchronized_recordings(
         session_ID=session_ID,
         LFP_synchronized=LFP_synchronized,
@@ -249,6 +304,7 @@ def main(
         sf_external=sf_external,
         saving_format=saving_format,
         saving_path=saving_path,
+        dtype=dtype,
     )
 
     # 5. PLOT SYNCHRONIZED RECORDINGS:
@@ -273,6 +329,7 @@ def main(
             external_synchronized=external_synchronized,
             sf_external=sf_external,
             saving_path=saving_path,
+            CROP_BOTH=CROP_BOTH,
         )
 
     # OPTIONAL : check for packet loss:
@@ -288,6 +345,15 @@ def main(
         )
         check_packet_loss(json_object=json_object)
 
+    _flush_params()
+    # Save the session in the index of all the results (see results_index):
+    index_session(
+        session_ID=session_ID,
+        results_path=results_path,
+        status="done",
+        duration_s=time.perf_counter() - start,
+    )
+
 
 """
         # OPTIONAL : plot cardiac artifact:
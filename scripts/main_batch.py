@@ -1,5 +1,7 @@
 import os
+import functools
 import pandas as pd
+import matplotlib.pyplot as plt
 from os.path import join
 
 from functions.loading_data import (
@@ -8,22 +10,42 @@ from functions.loading_data import (
     load_sourceJSON
     )
 from functions.plotting import plot_LFP_external, ecg
-from functions.timeshift import check_timeshift
+from functions.timeshift import check_timeshift, estimate_drift_from_artifacts
 from functions.utils import (
     _update_and_save_params, 
     _update_and_save_multiple_params, 
-    _get_input_y_n, 
-    _get_user_input, 
-    _check_for_empties
+    _check_for_empties,
+    _add_to_review_queue,
+    _start_session,
+    _get_params,
+    _use_params,
+    _flush_params,
+    SessionParameters,
+    _update_and_save_artifact_train,
+    _detrend_data,
     )
+from functions.find_artifacts import (
+    rank_LFP_detection_methods,
+    rescore_LFP_candidates,
+    find_external_artifact_train,
+)
 from functions.tmsi_poly5reader import Poly5Reader
 from functions.resync_function import (
-    detect_artifacts_in_external_recording,
-    detect_artifacts_in_intracranial_recording,
+    detect_artifacts_in_both_recordings,
     synchronize_recordings,
+    refine_alignment,
     save_synchronized_recordings
 )
 from functions.packet_loss import check_packet_loss
+from functions.cache import RecordingCache
+from functions.probe import probe_manifest, estimate_session_memory
+from functions.batch import run_sessions, run_in_threads, SessionPrefetcher
+from functions.results_index import index_session
+from functions.review import (
+    save_detection_candidates,
+    review_session,
+    load_reviewed_picks,
+)
 
 
 def main_batch(
@@ -32,7 +54,20 @@ def main_batch(
     CROP_BOTH=False,
     CHECK_FOR_TIMESHIFT=True,
     CHECK_FOR_PACKET_LOSS=False,
+    CORRECT_DRIFT=False,
+    REFINE_ALIGNMENT=False,
     PREPROCESSING="Perceive",  # 'Perceive' or 'DBScope'
+    USE_PYMATREADER=False,
+    dtype="float32",  # 'float32' or 'float64'
+    cache_dir=None,  # e.g. 'cache', None disables the cache
+    cache_max_size_gb=20,
+    external_channels=None,  # e.g. ['BIP 01', 'ECG'], None keeps all channels
+    auto_accept_confidence=None,  # e.g. 0.9, None always asks
+    HEADLESS=False,
+    n_workers=1,
+    memory_budget_gb=None,  # e.g. 64, None only limits the number of workers
+    PHASE="all",  # 'all', 'detect', 'review' or 'synchronize'
+    prefetch_memory_gb=0,  # e.g. 8, 0 disables the prefetching
 ):
 
     """
@@ -48,14 +83,93 @@ def main_batch(
     CROP_BOTH: boolean, if True, crop both LFP and external data to the shortest
                 if False, crop only the external data to match the intracranial
 
-    CHECK_FOR_TIMESHIFT: boolean, if True, perform timeshift analysis
+    CHECK_FOR_TIMESHIFT: boolean, if True, perform timeshift analysis. The clock drift
+                    is estimated automatically from the artifacts detected, the
+                    last artifacts only have to be selected by hand if it fails
 
     CHECK_FOR_PACKET_LOSS: boolean, if True, perform packet loss analysis
 
+    CORRECT_DRIFT: boolean, if True, the clock drift between the two recordings is
+                    estimated from the artifacts detected, and the external
+                    recording is resampled onto the clock of the intracranial one
+
+    REFINE_ALIGNMENT: boolean, if True, the alignment of the first artifact is refined
+                    below the sampling period of the intracranial recording, by
+                    cross-correlating the artifact envelopes of both recordings
+
     PREPROCESSING: string, 'Perceive' or 'DBScope'. The preprocessing toolbox used
                     to preprocess the LFP data (convert the JSON file to a 
                     Fieldtrip .mat file). If 'DBScope', the trial_idx_lfp parameter
                     will be used to select the correct trial in the DBScope file.
+
+    USE_PYMATREADER: boolean, only used if PREPROCESSING is 'Perceive'. If True,
+                    the Fieldtrip .mat file is read directly with pymatreader
+                    (faster, without creating an MNE object, requires pymatreader).
+                    If False (default), it is read with MNE.
+
+    dtype: string, 'float32' or 'float64'. Data type used to load, synchronize
+                    and save the recordings. 'float32' (default) is the native
+                    format of Poly5 files and halves memory use and output size.
+                    Artifact detection is always computed in float64.
+
+    cache_dir: string or None, folder where decoded recordings are cached
+                    (e.g. "cache"). When a session is re-run, its recordings are
+                    then opened from the cache instead of being decoded again.
+                    Poly5 files are not cached, they are already read lazily.
+                    None (default) disables the cache.
+
+    cache_max_size_gb: float, maximum size of the cache folder. The least recently
+                    used recordings are removed from the cache above this size.
+
+    external_channels: list or None, names of the external channels to keep in
+                    the synchronized recordings (the BIP channel is always kept).
+                    Only these channels are read from .csv files. None (default)
+                    keeps all the channels.
+
+    auto_accept_confidence: float or None, the intracranial artifacts found by the
+                    most consistent automatic method are accepted without asking
+                    when their consistency with the external artifacts (between
+                    0 and 1) is at least this value. None (default) always asks.
+
+    HEADLESS: boolean, if True, the sessions are processed without any figure shown
+                    nor question asked, e.g. overnight on a compute node (Qt
+                    is not needed). The figures are only saved. The external
+                    artifact is accepted as detected, and the intracranial one
+                    when its consistency is at least auto_accept_confidence
+                    (0.9 if None). The sessions that
+                    need a decision are skipped or left without timeshift, and
+                    listed in results/review_queue.csv.
+
+    n_workers: int, number of sessions analyzed in parallel, each in its own
+                    process (HEADLESS mode only). An error in a session does not
+                    stop the others, it is reported in the returned results.
+
+    memory_budget_gb: float or None, largest memory used by the sessions analyzed in
+                    parallel. The peak memory of each session is estimated from
+                    the headers of its recordings (see probe.estimate_session_memory),
+                    and the largest sessions are started first, as long as the
+                    sessions running fit in the budget.
+
+    PHASE: string, "all" (default) analyzes each session from start to end. The
+                    analysis can also be split in 3 runs, so that the operator
+                    reviews all the sessions at once instead of waiting for each
+                    of them to load:
+                    - "detect": loads the recordings and detects the artifacts of
+                    every pending session (in parallel with n_workers), and
+                    saves them with light previews (see review.py). The sessions
+                    already reviewed are skipped: delete their
+                    review_<session_ID>.json file to detect them again
+                    - "review": shows the previews of each detected session, and
+                    saves the artifacts accepted by the user
+                    - "synchronize": synchronizes the reviewed sessions with the
+                    accepted artifacts (in parallel with n_workers)
+                    The detect and synchronize phases run in HEADLESS mode.
+
+    prefetch_memory_gb: float, when the sessions are analyzed one by one (n_workers=1),
+                    the recordings of the next sessions are loaded in the
+                    background while the current one is analyzed and reviewed,
+                    as long as their estimated memory stays under this value.
+                    0 (default) disables the prefetching.
     ...............................................................................
 
     Results
@@ -78,13 +192,57 @@ def main_batch(
     IF the timeshift analysis is also performed, there will be one supplementary figure:
     - Fig A : Timeshift - Intracranial and external recordings aligned - last artifact
 
+    main_batch returns a pd.DataFrame with the status of each session ("done",
+    "review" or "error"), its error and its duration (see batch.run_sessions).
+
     """
 
+    if PHASE not in ("all", "detect", "review", "synchronize"):
+        raise ValueError(f"Unknown PHASE: {PHASE}")
+    if PHASE in ("detect", "synchronize"):
+        HEADLESS = True
+    if n_workers > 1 and PHASE == "review":
+        raise ValueError("The review phase can only be run with 1 worker.")
+    if n_workers > 1 and not HEADLESS:
+        raise ValueError("Sessions can only be run in parallel in HEADLESS mode.")
+    if HEADLESS and auto_accept_confidence is None:
+        auto_accept_confidence = 0.9
+
     excel_file_path = join("sourcedata", excel_fname)
     df = pd.read_excel(excel_file_path)
 
-    # Loop for all recording sessions present in the file provided,
-    # analyze one by one:
+    # Read the headers of all pending recordings before loading anything,
+    # to check them at once (sampling rates, channels, durations):
+    probed = probe_manifest(
+        df, source_path=join(os.getcwd(), "sourcedata"), PREPROCESSING=PREPROCESSING
+    )
+    print(probed.to_string(index=False))
+
+    #  Set cache of decoded recordings
+    cache = None
+    if cache_dir is not None:
+        cache = RecordingCache(join(os.getcwd(), cache_dir), cache_max_size_gb)
+
+    options = {
+        "saving_format": saving_format,
+        "CROP_BOTH": CROP_BOTH,
+        "CHECK_FOR_TIMESHIFT": CHECK_FOR_TIMESHIFT,
+        "CHECK_FOR_PACKET_LOSS": CHECK_FOR_PACKET_LOSS,
+        "CORRECT_DRIFT": CORRECT_DRIFT,
+        "REFINE_ALIGNMENT": REFINE_ALIGNMENT,
+        "PREPROCESSING": PREPROCESSING,
+        "USE_PYMATREADER": USE_PYMATREADER,
+        "dtype": dtype,
+        "cache": cache,
+        "external_channels": external_channels,
+        "auto_accept_confidence": auto_accept_confidence,
+        "HEADLESS": HEADLESS,
+        "USE_REVIEWED_PICKS": PHASE == "synchronize",
+    }
+
+    # List all recording sessions present in the file provided, they are then
+    # analyzed one by one, or in parallel by n_workers processes:
+    sessions = []
     for index, row in df.iterrows():
         session_ID, fname_lfp, fname_external, ch_idx_lfp, trial_idx_lfp, BIP_ch_name, f_name_json, done  = row
         if done == "yes":
@@ -107,212 +265,551 @@ def main_batch(
                 trial_idx_lfp = int(trial_idx_lfp)
         else: trial_idx_lfp = None
 
-        # Set working directory
-        working_path = os.getcwd()
+        sessions.append(
+            {
+                "session_ID": session_ID,
+                "fname_lfp": fname_lfp,
+                "fname_external": fname_external,
+                "ch_idx_lfp": ch_idx_lfp,
+                "trial_idx_lfp": trial_idx_lfp,
+                "BIP_ch_name": BIP_ch_name,
+                "f_name_json": f_name_json,
+                **options,
+            }
+        )
 
-        #  Set saving path
-        results_path = join(working_path, "results")
-        saving_path = join(results_path, session_ID)
-        if not os.path.isdir(saving_path):
-            os.makedirs(saving_path)
+    # Estimate the peak memory of each session from the headers read above:
+    memory_estimates = [
+        estimate_session_memory(
+            probed[probed["session_ID"] == session["session_ID"]], dtype=dtype
+        )
+        for session in sessions
+    ]
+
+    session_function = {
+        "all": process_session,
+        "detect": detect_session,
+        "review": review_batch_session,
+        "synchronize": process_session,
+    }[PHASE]
+    # Load the next sessions in the background during the analysis of the
+    # current one (only when the sessions are analyzed one by one):
+    prefetcher = None
+    if prefetch_memory_gb > 0 and n_workers == 1 and PHASE == "all":
+        prefetcher = SessionPrefetcher(
+            load_session_recordings, sessions, memory_estimates, prefetch_memory_gb
+        )
+        for session in sessions:
+            session["prefetcher"] = prefetcher
+
+    try:
+        results = run_sessions(
+            session_function,
+            sessions,
+            max_workers=n_workers,
+            memory_estimates=memory_estimates,
+            memory_budget_gb=memory_budget_gb,
+        )
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+    print(results.drop(columns="error").to_string(index=False))
+
+    # Save the sessions in the index of all the results (see results_index):
+    results_path = join(os.getcwd(), "results")
+    os.makedirs(results_path, exist_ok=True)
+    for row in results.itertuples(index=False):
+        index_session(
+            session_ID=row.session_ID,
+            results_path=results_path,
+            status=row.status,
+            error=row.error,
+            duration_s=row.duration_s,
+        )
 
-        #  Set source path
-        source_path = join(working_path, "sourcedata")
+    return results
 
-        #  1. LOADING DATASETS
 
-        ##  Intracranial LFP
-        # the resync function needs 4 information about the intracranial recording:
-        # 1. the intracranial recording itself, containing all the recorded channels (LFP_array)
-        # 2. the intracranial recording, but only the channel containing the stimulation artifacts (lfp_sig)
-        # 3. the names of all the channels recorded intracerebrally (LFP_rec_ch_names)
-        # 4. the sampling frequency of the intracranial recording (sf_LFP)
 
-        (
-            LFP_array, 
-            lfp_sig, 
-            LFP_rec_ch_names, 
-            sf_LFP
-        ) = load_intracranial(
+def process_session(
+    session_ID,
+    fname_lfp,
+    fname_external,
+    ch_idx_lfp,
+    trial_idx_lfp,
+    BIP_ch_name,
+    f_name_json,
+    saving_format="brainvision",
+    CROP_BOTH=False,
+    CHECK_FOR_TIMESHIFT=True,
+    CHECK_FOR_PACKET_LOSS=False,
+    CORRECT_DRIFT=False,
+    REFINE_ALIGNMENT=False,
+    PREPROCESSING="Perceive",
+    USE_PYMATREADER=False,
+    dtype="float32",
+    cache=None,
+    external_channels=None,
+    auto_accept_confidence=None,
+    HEADLESS=False,
+    USE_REVIEWED_PICKS=False,
+    prefetcher=None,
+):
+    """
+    Runs the analysis of one session of the batch, from the loading of its
+    recordings to the timeshift and packet loss checks. The parameters of
+    the session are those of its row in the excel file, the other ones are
+    described in main_batch (cache is a RecordingCache or None). With
+    USE_REVIEWED_PICKS, the artifacts accepted in the review phase are used
+    instead of being detected again. With a prefetcher (batch.SessionPrefetcher),
+    the recordings are taken from it instead of being loaded here.
+
+    Returns:
+        - status: str, "done", "review" if the session was added to the
+        review queue before being synchronized (headless mode), or
+        "not reviewed" if USE_REVIEWED_PICKS and the session was not reviewed
+    """
+
+    if HEADLESS:
+        # figures are only saved, plt.show does not open any window
+        plt.switch_backend("Agg")
+
+    # Set working directory
+    working_path = os.getcwd()
+
+    #  Set saving path
+    results_path = join(working_path, "results")
+    saving_path = join(results_path, session_ID)
+    if not os.path.isdir(saving_path):
+        os.makedirs(saving_path)
+
+    # the parameters of the previous session must not be saved with this one:
+    _start_session(session_ID, saving_path)
+
+    #  Set source path
+    source_path = join(working_path, "sourcedata")
+
+    #  1. LOADING DATASETS
+    if prefetcher is not None:
+        # the recordings may already have been loaded in the background,
+        # during the review of the previous session (see batch.SessionPrefetcher)
+        loaded = prefetcher.get(session_ID)
+    else:
+        loaded = load_session_recordings(
             session_ID=session_ID,
             fname_lfp=fname_lfp,
+            fname_external=fname_external,
             ch_idx_lfp=ch_idx_lfp,
             trial_idx_lfp=trial_idx_lfp,
-            saving_path=saving_path,
-            source_path=source_path,
-            PREPROCESSING=PREPROCESSING
+            BIP_ch_name=BIP_ch_name,
+            PREPROCESSING=PREPROCESSING,
+            USE_PYMATREADER=USE_PYMATREADER,
+            dtype=dtype,
+            cache=cache,
+            external_channels=external_channels,
         )
-
-            ##  External data recorder
-        # the resync function needs 5 information about the external recording:
-        # 1. the external recording itself, containing all the recorded channels (external_file)
-        # 2. the channel containing the stimulation artifacts (BIP_channel)
-        # 3. the names of all the channels recorded externally (external_rec_ch_names)
-        # 4. the sampling frequency of the external recording (sf_external)
-        # 5. the index of the bipolar channel in the external recording (ch_index_external)
-
-        (
-            external_file, 
-            BIP_channel, 
-            external_rec_ch_names, 
-            sf_external, 
-            ch_index_external
-            ) = load_external(
-                session_ID=session_ID,
-                fname_external=fname_external,
-                BIP_ch_name=BIP_ch_name,
-                saving_path=saving_path,
-                source_path=source_path
-            )
-
-        #  2. FIND ARTIFACTS IN BOTH RECORDINGS:
-        # 2.1. Find artifacts in external recording:
-        art_start_BIP = detect_artifacts_in_external_recording(
+    (
+        LFP_array,
+        lfp_sig,
+        LFP_rec_ch_names,
+        sf_LFP,
+        external_file,
+        BIP_channel,
+        external_rec_ch_names,
+        sf_external,
+        ch_index_external,
+    ) = loaded["recordings"]
+    # parameters saved while loading (in another thread when prefetched):
+    _update_and_save_multiple_params(loaded["parameters"], session_ID, saving_path)
+    _flush_params()
+
+    #  2. FIND ARTIFACTS IN BOTH RECORDINGS:
+    if USE_REVIEWED_PICKS:
+        # the artifacts were accepted in the review phase:
+        picks = load_reviewed_picks(session_ID, saving_path)
+        if picks is None:
+            print(f"Session {session_ID} was not reviewed yet, it is skipped.")
+            return "not reviewed"
+        _update_and_save_multiple_params(picks, session_ID, saving_path)
+        art_times = (picks["ART_TIME_BIP"], picks["ART_TIME_LFP"])
+    else:
+        art_times = detect_artifacts_in_both_recordings(
             session_ID=session_ID,
+            lfp_sig=lfp_sig,
+            sf_LFP=sf_LFP,
             BIP_channel=BIP_channel,
             sf_external=sf_external,
             saving_path=saving_path,
-            start_index=0,
-        )
-        artifact_correct = _get_input_y_n(
-            "Is the external DBS artifact properly selected ? "
+            results_path=results_path,
+            auto_accept_confidence=auto_accept_confidence,
+            HEADLESS=HEADLESS,
         )
-        if artifact_correct in ("y", "Y"):
-            _update_and_save_params(
-                key="ART_TIME_BIP",
-                value=art_start_BIP,
-                session_ID=session_ID,
-                saving_path=saving_path
-            )
-        else:
-            # if there's an unrelated artifact or if the stimulation is ON at the beginning
-            # of the recording, the user can input the number of seconds to ignore at the
-            # beginning of the recording, and the function will start looking for artifacts
-            # after that time.
-            start_later = _get_user_input(
-                "How many seconds in the beginning should be ignored "
-            )
-            start_later_index = start_later * round(sf_external)
-            art_start_BIP = detect_artifacts_in_external_recording(
-                session_ID=session_ID,
-                BIP_channel=BIP_channel,
-                sf_external=sf_external,
-                saving_path=saving_path,
-                start_index=start_later_index,
-            )
-            _update_and_save_params(
-                key="ART_TIME_BIP",
-                value=art_start_BIP,
-                session_ID=session_ID,
-                saving_path=saving_path,
-            )
-
-            # 2.2. Find artifacts in intracranial recording:
-        methods = ["thresh", "2", "1", "manual"]
-        # thresh takes the last sample that lies within the value distribution of the 
-            # thres_window (aka: baseline window) before the threshold passing
-            # kernel 1 only searches for the steep decrease
-            # kernel 2 is more custom and takes into account the steep decrease and slow recovery
-            # manual kernel is when none of the three previous methods work. Then the artifact
-            # has to be manually selected by the user, in a pop up window that will automatically open.
-        for method in methods:
-            print("Running resync with method = {}...".format(method))
-            art_start_LFP = detect_artifacts_in_intracranial_recording(
-                session_ID=session_ID,
-                lfp_sig=lfp_sig,
-                sf_LFP=sf_LFP,
-                saving_path=saving_path,
-                method=method
-            )
-            artifact_correct = _get_input_y_n(
-                "Is the intracranial DBS artifact properly selected ? "
-            )
-            if artifact_correct in ("y","Y"):
-                dictionary = {"ART_TIME_LFP": art_start_LFP, "METHOD": method}
-                _update_and_save_multiple_params(dictionary,session_ID,saving_path)
-                break
-
-        # 3. SYNCHRONIZE RECORDINGS TOGETHER:
-        (LFP_synchronized, external_synchronized) = synchronize_recordings(
-            LFP_array=LFP_array,
-            external_file=external_file,
+    _flush_params()
+    if art_times is None:
+        return "review"
+    art_start_BIP, art_start_LFP = art_times
+
+    # OPTIONAL : refine the alignment below the intracranial sampling period:
+    if REFINE_ALIGNMENT:
+        (art_start_BIP_refined, offset_ms, confidence, accepted) = refine_alignment(
+            lfp_sig=lfp_sig,
+            BIP_channel=BIP_channel,
             art_start_LFP=art_start_LFP,
             art_start_BIP=art_start_BIP,
             sf_LFP=sf_LFP,
             sf_external=sf_external,
-            CROP_BOTH=CROP_BOTH,
         )
+        print(
+            f"Alignment refined by {offset_ms:.3f} ms (confidence {confidence:.2f})."
+        )
+        if accepted:
+            dictionary = {
+                "ART_TIME_BIP_DETECTED": art_start_BIP,
+                "ART_TIME_BIP": art_start_BIP_refined,
+                "ALIGNMENT_OFFSET_MS": offset_ms,
+                "ALIGNMENT_CONFIDENCE": confidence,
+            }
+            _update_and_save_multiple_params(dictionary, session_ID, saving_path)
+            art_start_BIP = art_start_BIP_refined
+        else:
+            print("WARNING: the refinement is not reliable, the alignment is not refined.")
 
-        # 4. SAVE SYNCHRONIZED RECORDINGS:
-        _update_and_save_params(
-            key="SAVING_FORMAT",
-            value=saving_format,
+    # OPTIONAL : estimate the clock drift to correct it:
+    drift_ppm = None
+    if CORRECT_DRIFT:
+        drift = estimate_drift_from_artifacts(
             session_ID=session_ID,
             saving_path=saving_path,
+            art_start_LFP=art_start_LFP,
+            art_start_BIP=art_start_BIP,
         )
-        save_synchronized_recordings(
+        if drift is None:
+            print("WARNING: the clock drift could not be estimated, it is not corrected.")
+        else:
+            drift_ppm = drift["drift_ppm"]
+    _update_and_save_params(
+        key="DRIFT_CORRECTION_PPM",
+        value=drift_ppm,
+        session_ID=session_ID,
+        saving_path=saving_path,
+    )
+
+    # 3. SYNCHRONIZE RECORDINGS TOGETHER:
+    (LFP_synchronized, external_synchronized) = synchronize_recordings(
+        LFP_array=LFP_array,
+        external_file=external_file,
+        art_start_LFP=art_start_LFP,
+        art_start_BIP=art_start_BIP,
+        sf_LFP=sf_LFP,
+        sf_external=sf_external,
+        CROP_BOTH=CROP_BOTH,
+        dtype=dtype,
+        drift_ppm=drift_ppm,
+    )
+
+    # 4. SAVE SYNCHRONIZED RECORDINGS:
+    _update_and_save_multiple_params(
+        {"SAVING_FORMAT": saving_format, "DTYPE": dtype},
+        session_ID,
+        saving_path,
+    )
+    _flush_params()
+    save_synchronized_recordings(
+        session_ID=session_ID,
+        LFP_synchronized=LFP_synchronized,
+        external_synchronized=external_synchronized,
+        LFP_rec_ch_names=LFP_rec_ch_names,
+        external_rec_ch_names=external_rec_ch_names,
+        sf_LFP=sf_LFP,
+        sf_external=sf_external,
+        saving_format=saving_format,
+        saving_path=saving_path,
+        dtype=dtype,
+    )
+
+    # 5. PLOT SYNCHRONIZED RECORDINGS:
+    plot_LFP_external(
+        session_ID=session_ID,
+        LFP_synchronized=LFP_synchronized,
+        external_synchronized=external_synchronized,
+        sf_LFP=sf_LFP,
+        sf_external=sf_external,
+        ch_idx_lfp=ch_idx_lfp,
+        ch_index_external=ch_index_external,
+        saving_path=saving_path,
+    )
+
+    #  OPTIONAL : check timeshift:
+    if CHECK_FOR_TIMESHIFT:
+        print("Starting timeshift analysis...")
+        timeshift_ms = check_timeshift(
             session_ID=session_ID,
             LFP_synchronized=LFP_synchronized,
-            external_synchronized=external_synchronized,
-            LFP_rec_ch_names=LFP_rec_ch_names,
-            external_rec_ch_names=external_rec_ch_names,
             sf_LFP=sf_LFP,
+            external_synchronized=external_synchronized,
             sf_external=sf_external,
-            saving_format=saving_format,
-            saving_path=saving_path
+            saving_path=saving_path,
+            CROP_BOTH=CROP_BOTH,
+            INTERACTIVE=not HEADLESS,
         )
+        if timeshift_ms is None:
+            _add_to_review_queue(
+                session_ID=session_ID,
+                stage="timeshift",
+                reason="the last artifacts could not be paired automatically",
+                confidence=None,
+                results_path=results_path,
+            )
 
-        # 5. PLOT SYNCHRONIZED RECORDINGS:
-        plot_LFP_external(
+    # OPTIONAL : check for packet loss:
+    if CHECK_FOR_PACKET_LOSS:
+        _update_and_save_params(
+            key="JSON_FILENAME",
+            value=f_name_json,
             session_ID=session_ID,
-            LFP_synchronized=LFP_synchronized,
-            external_synchronized=external_synchronized,
-            sf_LFP=sf_LFP,
-            sf_external=sf_external,
-            ch_idx_lfp=ch_idx_lfp,
-            ch_index_external=ch_index_external,
             saving_path=saving_path,
         )
+        json_object = load_sourceJSON(
+            json_filename=f_name_json, source_path=source_path
+        )
+        check_packet_loss(json_object=json_object)
 
-        #  OPTIONAL : check timeshift:
-        if CHECK_FOR_TIMESHIFT:
-            print("Starting timeshift analysis...")
-            check_timeshift(
-                session_ID=session_ID,
-                LFP_synchronized=LFP_synchronized,
-                sf_LFP=sf_LFP,
-                external_synchronized=external_synchronized,
-                sf_external=sf_external,
-                saving_path=saving_path,
+    """
+        # OPTIONAL : plot cardiac artifact:
+        ecg(
+            session_ID = session_ID, 
+            LFP_synchronized = LFP_synchronized, 
+            sf_LFP = sf_LFP, 
+            external_synchronized = external_synchronized, 
+            sf_external = sf_external, 
+            saving_path = saving_path, 
+            xmin = 0.25, 
+            xmax = 0.36
             )
+    """
 
-        # OPTIONAL : check for packet loss:
-        if CHECK_FOR_PACKET_LOSS:
-            _update_and_save_params(
-                key="JSON_FILENAME",
-                value=f_name_json,
-                session_ID=session_ID,
-                saving_path=saving_path,
-            )
-            json_object = load_sourceJSON(
-                json_filename=f_name_json, source_path=source_path
-            )
-            check_packet_loss(json_object=json_object)
+    _flush_params()
+    if HEADLESS:
+        # free the figures of the session, they are already saved
+        plt.close("all")
+
+    return "done"
+
+
+def load_session_recordings(
+    session_ID,
+    fname_lfp,
+    fname_external,
+    ch_idx_lfp,
+    trial_idx_lfp,
+    BIP_ch_name,
+    PREPROCESSING="Perceive",
+    USE_PYMATREADER=False,
+    dtype="float32",
+    cache=None,
+    external_channels=None,
+    **options,
+):
+    """
+    Loads both recordings of a session (step 1 of process_session), each in
+    its own thread (see batch.run_in_threads). It can be run in a background
+    thread (see batch.SessionPrefetcher): the
+    parameters saved while loading are kept apart from those of the session
+    analyzed in the main thread, and returned without being saved: the
+    caller saves them in the parameters of the session.
+    The other options of process_session are not used here.
+
+    Returns:
+        - loaded: dict, with keys
+            "recordings": (LFP_array, lfp_sig, LFP_rec_ch_names, sf_LFP,
+            external_file, BIP_channel, external_rec_ch_names, sf_external,
+            ch_index_external)
+            "parameters": dict, the parameters saved while loading
+    """
+
+    working_path = os.getcwd()
+    saving_path = join(working_path, "results", session_ID)
+    if not os.path.isdir(saving_path):
+        os.makedirs(saving_path)
+    source_path = join(working_path, "sourcedata")
+
+    # the parameters saved while loading are collected apart:
+    session_parameters = _get_params()
+    _use_params(SessionParameters(session_ID, saving_path))
+
+    ##  Intracranial LFP
+    # the resync function needs 4 information about the intracranial recording:
+    # 1. the intracranial recording itself, containing all the recorded channels (LFP_array)
+    # 2. the intracranial recording, but only the channel containing the stimulation artifacts (lfp_sig)
+    # 3. the names of all the channels recorded intracerebrally (LFP_rec_ch_names)
+    # 4. the sampling frequency of the intracranial recording (sf_LFP)
+
+    load_LFP = functools.partial(
+        load_intracranial,
+        session_ID=session_ID,
+        fname_lfp=fname_lfp,
+        ch_idx_lfp=ch_idx_lfp,
+        trial_idx_lfp=trial_idx_lfp,
+        saving_path=saving_path,
+        source_path=source_path,
+        PREPROCESSING=PREPROCESSING,
+        USE_PYMATREADER=USE_PYMATREADER,
+        dtype=dtype,
+        cache=cache,
+    )
 
+        ##  External data recorder
+    # the resync function needs 5 information about the external recording:
+    # 1. the external recording itself, containing all the recorded channels (external_file)
+    # 2. the channel containing the stimulation artifacts (BIP_channel)
+    # 3. the names of all the channels recorded externally (external_rec_ch_names)
+    # 4. the sampling frequency of the external recording (sf_external)
+    # 5. the index of the bipolar channel in the external recording (ch_index_external)
+
+    load_BIP = functools.partial(
+        load_external,
+        session_ID=session_ID,
+        fname_external=fname_external,
+        BIP_ch_name=BIP_ch_name,
+        saving_path=saving_path,
+        source_path=source_path,
+        dtype=dtype,
+        cache=cache,
+        external_channels=external_channels,
+    )
 
+    # both recordings are read at the same time:
+    try:
+        (
+            (LFP_array, lfp_sig, LFP_rec_ch_names, sf_LFP),
+            (external_file, BIP_channel, external_rec_ch_names, sf_external, ch_index_external),
+        ) = run_in_threads(load_LFP, load_BIP)
+        loaded_parameters = _get_params().as_dict()
+    finally:
+        _use_params(session_parameters)
+
+    return {
+        "recordings": (
+            LFP_array,
+            lfp_sig,
+            LFP_rec_ch_names,
+            sf_LFP,
+            external_file,
+            BIP_channel,
+            external_rec_ch_names,
+            sf_external,
+            ch_index_external,
+        ),
+        "parameters": loaded_parameters,
+    }
+
+
+def detect_session(
+    session_ID,
+    fname_lfp,
+    fname_external,
+    ch_idx_lfp,
+    trial_idx_lfp,
+    BIP_ch_name,
+    f_name_json,
+    PREPROCESSING="Perceive",
+    USE_PYMATREADER=False,
+    dtype="float32",
+    cache=None,
+    external_channels=None,
+    **options,
+):
     """
-            # OPTIONAL : plot cardiac artifact:
-            ecg(
-                session_ID = session_ID, 
-                LFP_synchronized = LFP_synchronized, 
-                sf_LFP = sf_LFP, 
-                external_synchronized = external_synchronized, 
-                sf_external = sf_external, 
-                saving_path = saving_path, 
-                xmin = 0.25, 
-                xmax = 0.36
-                )
+    Detection phase of a session (PHASE="detect" in main_batch): loads its
+    recordings, detects the artifacts of both recordings with all the
+    automatic methods, and saves them with the previews needed to review
+    them (see review.save_detection_candidates). Nothing is shown nor asked.
+    The other options of process_session are not used in this phase.
+    The sessions already reviewed are skipped, so that their candidates stay
+    those that were reviewed.
+
+    Returns:
+        - status: str, "detected" or "already reviewed"
     """
 
+    saving_path = join(os.getcwd(), "results", session_ID)
+    if load_reviewed_picks(session_ID, saving_path) is not None:
+        print(f"Session {session_ID} was already reviewed, it is skipped.")
+        return "already reviewed"
+
+    plt.switch_backend("Agg")
+
+    if not os.path.isdir(saving_path):
+        os.makedirs(saving_path)
+    _start_session(session_ID, saving_path)
+
+    #  1. LOADING DATASETS
+    loaded = load_session_recordings(
+        session_ID=session_ID,
+        fname_lfp=fname_lfp,
+        fname_external=fname_external,
+        ch_idx_lfp=ch_idx_lfp,
+        trial_idx_lfp=trial_idx_lfp,
+        BIP_ch_name=BIP_ch_name,
+        PREPROCESSING=PREPROCESSING,
+        USE_PYMATREADER=USE_PYMATREADER,
+        dtype=dtype,
+        cache=cache,
+        external_channels=external_channels,
+    )
+    (_, lfp_sig, _, sf_LFP, _, BIP_channel, _, sf_external, _) = loaded["recordings"]
+    _update_and_save_multiple_params(loaded["parameters"], session_ID, saving_path)
+    _flush_params()
+
+    #  2. FIND ARTIFACTS IN BOTH RECORDINGS, WITHOUT SELECTING THEM:
+    # both recordings are searched at the same time, the intracranial artifacts
+    # are then scored with the external ones
+    filtered_external = _detrend_data(BIP_channel)
+    external_train, candidates = run_in_threads(
+        functools.partial(
+            find_external_artifact_train, data=filtered_external, sf_external=sf_external
+        ),
+        functools.partial(rank_LFP_detection_methods, data=lfp_sig, sf_LFP=sf_LFP),
+    )
+    if len(external_train) == 0:
+        raise ValueError("No artifact was found in the external recording.")
+    _update_and_save_artifact_train(
+        "external", external_train, sf_external, session_ID, saving_path
+    )
+    candidates = rescore_LFP_candidates(
+        candidates, sf_LFP, external_train, sf_external
+    )
+    save_detection_candidates(
+        session_ID=session_ID,
+        saving_path=saving_path,
+        lfp_sig=lfp_sig,
+        sf_LFP=sf_LFP,
+        filtered_external=filtered_external,
+        sf_external=sf_external,
+        external_train=external_train,
+        candidates=candidates,
+    )
+
+    return "detected"
+
+
+def review_batch_session(session_ID, **options):
+    """
+    Review phase of a session (PHASE="review" in main_batch), see
+    review.review_session. The sessions already reviewed are not shown again.
+
+    Returns:
+        - status: str, "reviewed", "already reviewed" or "not detected"
+    """
+
+    saving_path = join(os.getcwd(), "results", session_ID)
+    if load_reviewed_picks(session_ID, saving_path) is not None:
+        return "already reviewed"
+    print(f"Reviewing session {session_ID}...")
+    picks = review_session(session_ID, saving_path)
+
+    return "not detected" if picks is None else "reviewed"
+
+
 if __name__ == "__main__":
     main_batch()
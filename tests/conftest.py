@@ -0,0 +1,9 @@
+import os
+import sys
+from os.path import abspath, dirname, join
+
+# the tests run without display: the figures are only drawn
+os.environ.setdefault("MPLBACKEND", "Agg")
+
+# the functions are imported as in the scripts (from functions.X import ...)
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), "scripts"))
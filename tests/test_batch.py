@@ -0,0 +1,157 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from functions.batch import SessionPrefetcher, run_sessions
+
+
+# The session functions are sent to worker processes: they are defined at the
+# top level of this module.
+
+
+def record_session(session_ID, log_path, duration_s=0.3, fail=False):
+    "Session that writes when it runs, in log_path/<session_ID>.json"
+    start = time.time()
+    time.sleep(duration_s)
+    with open(os.path.join(log_path, f"{session_ID}.json"), "w") as f:
+        json.dump({"start": start, "end": time.time()}, f)
+    if fail:
+        raise ValueError(f"session {session_ID} failed")
+    return "done"
+
+
+def kill_worker(session_ID, log_path):
+    "Session whose worker process dies (e.g. out of memory)"
+    os._exit(1)
+
+
+def read_log(log_path, session_ID):
+    with open(os.path.join(log_path, f"{session_ID}.json")) as f:
+        return json.load(f)
+
+
+def test_run_sessions_in_current_process(tmp_path):
+    sessions = [
+        {"session_ID": "s1", "log_path": str(tmp_path), "duration_s": 0},
+        {"session_ID": "s2", "log_path": str(tmp_path), "duration_s": 0, "fail": True},
+        {"session_ID": "s3", "log_path": str(tmp_path), "duration_s": 0},
+    ]
+
+    results = run_sessions(record_session, sessions)
+
+    assert list(results["session_ID"]) == ["s1", "s2", "s3"]
+    assert list(results["status"]) == ["done", "error", "done"]
+    assert "session s2 failed" in results["error"][1]
+    assert results["error"][[0, 2]].isna().all()
+    # one after the other, in order
+    assert read_log(tmp_path, "s1")["end"] <= read_log(tmp_path, "s3")["start"]
+
+
+def test_run_sessions_memory_budget(tmp_path):
+    GB = 1e9
+    memory = {"s1": 2 * GB, "s2": 6 * GB, "s3": 3 * GB, "s4": 5 * GB, "s5": 10 * GB, "s6": None}
+    sessions = [{"session_ID": ID, "log_path": str(tmp_path)} for ID in memory]
+
+    results = run_sessions(
+        record_session,
+        sessions,
+        max_workers=3,
+        memory_estimates=list(memory.values()),
+        memory_budget_gb=8,
+    )
+
+    assert list(results["session_ID"]) == list(memory)
+    assert list(results["status"]) == ["done"] * 6
+    logs = {ID: read_log(tmp_path, ID) for ID in memory}
+    # the largest session runs alone, the others never exceed the budget
+    for ID, log in logs.items():
+        running = [
+            other for other, other_log in logs.items()
+            if other_log["start"] < log["end"] and log["start"] < other_log["end"]
+        ]
+        assert len(running) <= 3
+        if ID == "s5":
+            assert running == ["s5"]
+        else:
+            assert sum(memory[other] or 0 for other in running) <= 8 * GB
+    # the largest sessions are started first
+    assert logs["s5"]["start"] < min(logs[ID]["start"] for ID in ("s1", "s3", "s6"))
+
+
+def test_run_sessions_worker_killed(tmp_path):
+    sessions = [
+        {"session_ID": "s1", "log_path": str(tmp_path)},
+        {"session_ID": "s2", "log_path": str(tmp_path), "duration_s": 0},
+    ]
+
+    results = run_sessions(kill_worker, sessions[:1], max_workers=2)
+    assert results["status"][0] == "error"
+    assert "BrokenProcessPool" in results["error"][0]
+
+    results = run_sessions(record_session, sessions, max_workers=2)
+    assert list(results["status"]) == ["done", "done"]
+
+
+class Loader:
+    "load_function of SessionPrefetcher that records the thread loading each session"
+
+    def __init__(self, fail=()):
+        self.threads = {}
+        self.fail = fail
+
+    def __call__(self, session_ID):
+        self.threads.setdefault(session_ID, []).append(threading.current_thread())
+        if session_ID in self.fail:
+            raise OSError(f"cannot load {session_ID}")
+        return "loaded " + session_ID
+
+    def in_background(self, session_ID):
+        return self.threads[session_ID] != [threading.main_thread()]
+
+
+def test_prefetcher_memory_limit():
+    GB = 1e9
+    IDs = ["s1", "s2", "s3", "s4", "s5"]
+    loader = Loader()
+    prefetcher = SessionPrefetcher(
+        loader,
+        [{"session_ID": ID} for ID in IDs],
+        memory_estimates=[1 * GB, 1 * GB, 1 * GB, 5 * GB, None],
+        memory_limit_gb=2.5,
+    )
+
+    try:
+        assert [prefetcher.get(ID) for ID in IDs] == ["loaded " + ID for ID in IDs]
+    finally:
+        prefetcher.close()
+
+    # each session is loaded once, in advance if it fits in the memory limit
+    assert all(len(threads) == 1 for threads in loader.threads.values())
+    assert [loader.in_background(ID) for ID in IDs] == [True, True, True, False, False]
+
+
+def test_prefetcher_skipped_and_failed_sessions():
+    loader = Loader(fail=("s2",))
+    prefetcher = SessionPrefetcher(
+        loader,
+        [{"session_ID": ID} for ID in ("s1", "s2", "s3", "s4")],
+        memory_estimates=[1e9] * 4,
+        memory_limit_gb=10,
+    )
+
+    try:
+        # the error of a session loaded in advance is raised by get
+        with pytest.raises(OSError, match="cannot load s2"):
+            prefetcher.get("s2")
+        # s1 and s3 are skipped: s4 was still loaded in advance
+        assert prefetcher.get("s4") == "loaded s4"
+        # a skipped session is loaded again when it is needed after all
+        assert prefetcher.get("s3") == "loaded s3"
+    finally:
+        prefetcher.close()
+
+    assert loader.in_background("s4")
+    assert loader.threads["s3"][-1] == threading.main_thread()
@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+import pytest
+
+from functions.cache import RecordingCache
+from functions.tmsi_poly5reader import Poly5Reader
+from test_poly5reader import write_poly5
+
+
+@pytest.fixture
+def source_file(tmp_path):
+    file_path = tmp_path / "recording.csv"
+    file_path.write_text("LFP\n1\n2\n")
+    return str(file_path)
+
+
+def test_round_trip(tmp_path, source_file):
+    cache = RecordingCache(str(tmp_path / "cache"))
+    data = np.random.default_rng(0).standard_normal((3, 1000)).astype(np.float32)
+    metadata = {"ch_names": ["a", "b", "c"], "sf": np.int64(250)}
+
+    assert cache.get(source_file, dtype="float32") is None
+    stored, stored_metadata = cache.put(source_file, data, metadata, dtype="float32")
+
+    assert isinstance(stored, np.memmap)
+    np.testing.assert_array_equal(stored, data)
+    assert stored_metadata == {"ch_names": ["a", "b", "c"], "sf": 250}
+
+    cached, cached_metadata = cache.get(source_file, dtype="float32")
+    np.testing.assert_array_equal(cached, data)
+    assert cached_metadata == stored_metadata
+    assert not cached.flags.writeable
+
+    # no temporary file is left
+    assert all(
+        filename.endswith((".npy", ".json"))
+        for filename in os.listdir(tmp_path / "cache")
+    )
+
+
+def test_key(tmp_path, source_file):
+    cache = RecordingCache(str(tmp_path / "cache"), hash_content=True)
+    cache.put(source_file, np.zeros((1, 10)), {}, dtype="float32")
+
+    # other loading options
+    assert cache.get(source_file, dtype="float64") is None
+    assert cache.get(source_file, dtype="float32") is not None
+
+    # modified source file
+    with open(source_file, "a") as f:
+        f.write("3\n")
+    assert cache.get(source_file, dtype="float32") is None
+
+
+def test_put_poly5_view(tmp_path):
+    samples = np.random.default_rng(0).standard_normal((2, 950)).astype(np.float32)
+    file_path = str(tmp_path / "recording.Poly5")
+    write_poly5(file_path, samples)
+    view = Poly5Reader(file_path, mmap=True, verbose=False).samples
+
+    cache = RecordingCache(str(tmp_path / "cache"))
+    stored, _ = cache.put(file_path, view, {})
+
+    np.testing.assert_array_equal(stored, samples)
+
+
+def test_eviction(tmp_path):
+    # room for two entries of 8 kB
+    cache = RecordingCache(str(tmp_path / "cache"), max_size_gb=20e-6)
+    data = np.zeros((1, 1000))
+    source_files = []
+    for name in ("a", "b", "c"):
+        file_path = tmp_path / f"{name}.csv"
+        file_path.write_text(name)
+        source_files.append(str(file_path))
+
+    cache.put(source_files[0], data, {})
+    cache.put(source_files[1], data, {})
+    # the entries of a and b were used at different times, a most recently
+    for source_file, used_at in zip(source_files[:2], (2000, 1000)):
+        npy_path, json_path = cache._paths(cache._key(source_file, {}))
+        os.utime(json_path, (used_at, used_at))
+    cache.put(source_files[2], data, {})
+
+    assert cache.get(source_files[0]) is not None
+    assert cache.get(source_files[1]) is None
+    assert cache.get(source_files[2]) is not None
+
+
+def test_eviction_keeps_new_entry(tmp_path, source_file):
+    # an entry larger than the cache is still returned
+    cache = RecordingCache(str(tmp_path / "cache"), max_size_gb=1e-6)
+    data = np.ones((2, 1000))
+
+    stored, _ = cache.put(source_file, data, {})
+
+    np.testing.assert_array_equal(stored, data)
+    assert cache.get(source_file) is not None
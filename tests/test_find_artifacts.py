@@ -0,0 +1,256 @@
+from itertools import compress
+from os.path import abspath, dirname, join
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.signal import find_peaks
+
+from functions.find_artifacts import (
+    ARTIFACT_TRAIN_DTYPE,
+    find_external_artifact_train,
+    find_external_sync_artifact,
+    find_LFP_artifact_train,
+    find_LFP_sync_artifact,
+    rank_LFP_detection_methods,
+    rescore_LFP_candidates,
+    score_LFP_artifact_train,
+)
+
+SOURCEDATA = join(dirname(dirname(abspath(__file__))), "sourcedata")
+
+
+# Reference implementations: the sample-by-sample detectors that the
+# vectorized ones replaced, kept to check that they find the same artifacts.
+
+
+def reference_external_artifacts(data, sf_external, start_index=0):
+    "All the samples that the former loop of find_external_sync_artifact tested"
+    if abs(max(data[:-1000])) > abs(min(data[:-1000])):
+        data = data * -1
+    thresh_BIP = -1.5 * (np.ptp(data[: int(sf_external * 2)]))
+
+    art_idx = []
+    for q in range(start_index, len(data) - 2):
+        if (
+            (data[q] <= thresh_BIP)
+            and (data[q] < data[q + 1])
+            and (data[q] < data[q - 1])
+        ):
+            art_idx.append(q)
+    return art_idx
+
+
+def reference_LFP_artifacts(data, sf_LFP, use_method):
+    """
+    Artifacts found by the former find_LFP_sync_artifact: all of them for the
+    kernel methods, only the first one for 'thresh'
+    """
+    if use_method == "thresh":
+        thres = np.ptp(data[: sf_LFP * 2])
+        abs_data = np.abs(data)
+        over_thres = np.where(abs_data > thres)[0][0]
+        return [
+            np.where(abs_data[:over_thres] <= np.percentile(abs_data[:over_thres], 95))[0][-1]
+        ]
+
+    ker = {
+        "1": np.array([1, -1]),
+        "2": np.array([1, 0, -1] + list(np.linspace(-1, 0, 20))),
+    }[use_method]
+    res = []
+    for i in np.arange(0, len(data) - len(ker)):
+        res.append(ker @ data[i : i + len(ker)])
+    res = np.array(res)
+    res = res / max(res)
+    pos_idx = find_peaks(x=res, height=0.3 * max(res), distance=sf_LFP)[0]
+    neg_idx = find_peaks(x=-res, height=-0.3 * min(res), distance=sf_LFP)[0]
+
+    signal_inverted = False
+    if neg_idx[0] < pos_idx[0]:
+        signal_inverted = True
+        if (pos_idx[0] - neg_idx[0]) < 50:
+            width_pos = 0
+            r_i = pos_idx[0]
+            while res[r_i] > (max(res) * 0.3):
+                r_i += 1
+                width_pos += 1
+            width_neg = 0
+            r_i = neg_idx[0]
+            while res[r_i] < (min(res) * 0.3):
+                r_i += 1
+                width_neg += 1
+            if width_pos > (2 * width_neg):
+                signal_inverted = False
+    stim_idx = neg_idx if signal_inverted else pos_idx
+
+    abs_heights = [max(abs(data[i - 5 : i + 5])) for i in stim_idx]
+    if not signal_inverted:
+        sel_idx = np.array([min(data[i - 5 : i + 5]) for i in stim_idx]) < (
+            np.median(abs_heights) * -0.5
+        )
+    else:
+        sel_idx = np.array([max(data[i - 5 : i + 5]) for i in stim_idx]) > (
+            np.median(abs_heights) * 0.5
+        )
+    return list(compress(stim_idx, sel_idx))
+
+
+def synthetic_external(sf_external=4096, duration_s=30, polarity=-1, seed=0):
+    """
+    Detrended external channel: noise, then 3 bursts of 130 Hz stimulation
+    pulses (sharp deflections decaying in a few samples)
+    """
+    rng = np.random.default_rng(seed)
+    data = rng.standard_normal(int(duration_s * sf_external))
+    pulse = polarity * 40 * np.exp(-np.arange(8) / 2)
+    for burst_start_s in (5, 12.3, 20.7):
+        for onset_s in np.arange(burst_start_s, burst_start_s + 2, 1 / 130):
+            onset = int(onset_s * sf_external)
+            data[onset : onset + len(pulse)] += pulse
+    return data
+
+
+@pytest.fixture(scope="module", params=[1, 2])
+def lfp_sig(request):
+    file_path = join(
+        SOURCEDATA, f"Intracerebral_LFP_dataset{request.param}_250Hz.csv"
+    )
+    return pd.read_csv(file_path).to_numpy()[:, 0]
+
+
+@pytest.mark.parametrize("use_method", ["1", "2"])
+def test_LFP_kernel_methods_match_reference(lfp_sig, use_method):
+    train = find_LFP_artifact_train(lfp_sig, 250, use_method)
+
+    np.testing.assert_array_equal(
+        train["onset"], reference_LFP_artifacts(lfp_sig, 250, use_method)
+    )
+
+
+def test_LFP_thresh_method_matches_reference(lfp_sig):
+    train = find_LFP_artifact_train(lfp_sig, 250, "thresh")
+
+    assert train["onset"][0] == reference_LFP_artifacts(lfp_sig, 250, "thresh")[0]
+    assert np.all(np.diff(train["onset"]) > 250)
+    assert np.all(train["confidence"] > 1)
+
+
+@pytest.mark.parametrize("use_method", ["1", "2", "thresh"])
+def test_LFP_sync_artifact_is_first_of_train(lfp_sig, use_method):
+    train = find_LFP_artifact_train(lfp_sig, 250, use_method)
+
+    assert find_LFP_sync_artifact(lfp_sig, 250, use_method) == train["onset"][0] / 250
+
+
+@pytest.mark.parametrize("polarity", [-1, 1])
+@pytest.mark.parametrize("start_index", [0, 4096 * 8])
+def test_external_train_groups_pulses(polarity, start_index):
+    data = synthetic_external(polarity=polarity)
+    train = find_external_artifact_train(data, 4096, start_index)
+
+    # one artifact per burst of pulses, starting at its first pulse
+    pulses = np.array(reference_external_artifacts(data, 4096, start_index))
+    artifacts = np.split(pulses, np.flatnonzero(np.diff(pulses) > 4096) + 1)
+    assert len(train) == (3 if start_index == 0 else 2)
+    np.testing.assert_array_equal(train["onset"], [pulses[0] for pulses in artifacts])
+    np.testing.assert_allclose(
+        train["onset"] / 4096, [5, 12.3, 20.7][-len(train) :], atol=1e-3
+    )
+    assert np.all(train["polarity"] == polarity)
+    # amplitude of the largest pulse
+    np.testing.assert_array_equal(
+        train["amplitude"],
+        np.float32([data[pulses[np.argmax(np.abs(data[pulses]))]] for pulses in artifacts]),
+    )
+    assert np.all(train["confidence"] >= 1)
+
+
+def test_external_sync_artifact():
+    data = synthetic_external()
+
+    art_time_BIP = find_external_sync_artifact(data, 4096)
+    assert art_time_BIP == reference_external_artifacts(data, 4096)[0] / 4096
+    assert art_time_BIP == pytest.approx(5, abs=1 / 4096)
+
+    art_times = find_external_sync_artifact(data, 4096, return_all=True)
+    np.testing.assert_array_equal(
+        art_times, np.array(reference_external_artifacts(data, 4096)) / 4096
+    )
+
+
+def test_external_sync_artifact_without_artifact():
+    data = np.random.default_rng(0).standard_normal(4096 * 10)
+
+    with pytest.raises(ValueError):
+        find_external_sync_artifact(data, 4096)
+
+
+def artifact_train(times, sf, confidence=2.0):
+    train = np.zeros(len(times), dtype=ARTIFACT_TRAIN_DTYPE)
+    train["onset"] = np.round(np.asarray(times) * sf)
+    train["confidence"] = confidence
+    return train
+
+
+def test_score_LFP_artifact_train():
+    times = np.array([5.0, 12.3, 20.7, 31.0])
+    external_train = artifact_train(100 + times * (1 + 50e-6), 4096)
+
+    # same artifacts, in another time base and with a clock drift
+    assert score_LFP_artifact_train(
+        artifact_train(times, 250), 250, external_train, 4096
+    ) == 1.0
+    # an artifact missed in the intracranial recording
+    assert score_LFP_artifact_train(
+        artifact_train(times[[0, 1, 3]], 250), 250, external_train, 4096
+    ) == pytest.approx(6 / 7)
+    # a wrong first artifact shifts all the others: only the first ones are
+    # paired
+    assert score_LFP_artifact_train(
+        artifact_train(np.append(2.0, times), 250), 250, external_train, 4096
+    ) == pytest.approx(2 / 9)
+
+
+def test_score_LFP_artifact_train_without_external():
+    assert score_LFP_artifact_train(artifact_train([5.0], 250, 4.0), 250) == 0.75
+    assert score_LFP_artifact_train(artifact_train([5.0], 250, 0.8), 250) == 0.0
+    assert score_LFP_artifact_train(
+        artifact_train([5.0], 250, 4.0), 250, artifact_train([], 4096), 4096
+    ) == 0.75
+
+
+def test_rescore_LFP_candidates():
+    times = np.array([5.0, 12.3, 20.7])
+    candidates = [
+        {"method": "thresh", "train": artifact_train(np.append(2.0, times), 250)},
+        {"method": "2", "train": artifact_train(times, 250, confidence=1.5)},
+        {"method": "1", "train": artifact_train(times, 250, confidence=3.0)},
+    ]
+
+    # the first artifact of 'thresh' is not in the external recording
+    rescored = rescore_LFP_candidates(candidates, 250, artifact_train(times, 4096), 4096)
+    assert [c["method"] for c in rescored] == ["2", "1", "thresh"]
+    assert [c["confidence"] for c in rescored] == [1.0, 1.0, pytest.approx(2 / 7)]
+
+    # without external artifacts, by confidence of the first artifact
+    rescored = rescore_LFP_candidates(candidates, 250)
+    assert [c["method"] for c in rescored] == ["1", "thresh", "2"]
+    assert "confidence" not in candidates[0]
+
+
+def test_rank_LFP_detection_methods(lfp_sig):
+    candidates = rank_LFP_detection_methods(lfp_sig, 250)
+    trains = {c["method"]: c["train"] for c in candidates}
+    for candidate in candidates:
+        np.testing.assert_array_equal(
+            candidate["train"], find_LFP_artifact_train(lfp_sig, 250, candidate["method"])
+        )
+        assert candidate["art_time_LFP"] == candidate["train"]["onset"][0] / 250
+
+    # scored with the external artifacts of the 'thresh' method, 'thresh'
+    # is the most consistent
+    external_train = artifact_train(30 + trains["thresh"]["onset"] / 250, 4096)
+    candidates = rank_LFP_detection_methods(lfp_sig, 250, external_train, 4096)
+    assert candidates[0]["method"] == "thresh"
+    assert candidates[0]["confidence"] == 1.0
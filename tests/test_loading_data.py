@@ -0,0 +1,160 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.io
+
+from functions import loading_data
+from functions.loading_data import (
+    _read_csv_channels,
+    load_data_lfp_DBScope,
+    load_external_csv_file,
+    load_intracranial,
+    load_intracranial_csv_file,
+)
+from functions.utils import _load_params, _use_params
+from test_probe import DBScope_lfp_raw, fieldtrip_data
+
+
+@pytest.fixture(autouse=True)
+def no_current_session():
+    "Each test starts without session, and does not leave one to flush at exit"
+    _use_params(None)
+    yield
+    _use_params(None)
+
+
+@pytest.fixture(params=["pyarrow", "pandas"])
+def csv_parser(request, monkeypatch):
+    "Runs the test with pyarrow, then with the pandas fallback"
+    if request.param == "pyarrow":
+        pytest.importorskip("pyarrow")
+    else:
+        monkeypatch.setattr(loading_data, "pa_csv", None)
+    return request.param
+
+
+@pytest.fixture
+def recording():
+    values = np.round(np.random.default_rng(0).standard_normal((3, 5000)), 5)
+    return pd.DataFrame(values.T, columns=["LFP_L", "BIP 01", "LFP_R"])
+
+
+def test_read_csv_channels(tmp_path, csv_parser, recording):
+    file_path = str(tmp_path / "recording.csv")
+    recording.to_csv(file_path, index=False)
+
+    data, ch_names = _read_csv_channels(file_path)
+    assert ch_names == ["LFP_L", "BIP 01", "LFP_R"]
+    assert data.dtype == np.float32 and data.flags["C_CONTIGUOUS"]
+    np.testing.assert_array_equal(data, recording.to_numpy(np.float32).T)
+
+    # the selected channels are read in the order of the file
+    data, ch_names = _read_csv_channels(
+        file_path, channels=["LFP_R", "LFP_L"], dtype="float64"
+    )
+    assert ch_names == ["LFP_L", "LFP_R"]
+    assert data.dtype == np.float64
+    np.testing.assert_array_equal(data, recording[ch_names].to_numpy().T)
+
+    with pytest.raises(AssertionError, match="missing"):
+        _read_csv_channels(file_path, channels=["missing"])
+
+
+def test_load_intracranial_csv_file(tmp_path, csv_parser, recording):
+    recording.to_csv(tmp_path / "lfp_250Hz.csv", index=False)
+    saving_path = str(tmp_path / "results")
+
+    LFP_array, lfp_sig, LFP_rec_ch_names, sf_LFP = load_intracranial_csv_file(
+        "s1", "lfp_250Hz.csv", 2, saving_path, str(tmp_path)
+    )
+
+    assert sf_LFP == 250
+    assert LFP_rec_ch_names == ["LFP_L", "BIP 01", "LFP_R"]
+    np.testing.assert_array_equal(lfp_sig, recording["LFP_R"].to_numpy(np.float32))
+    assert LFP_array.shape == (3, 5000)
+    assert _load_params("s1", saving_path)["LFP_REC_DURATION"] == 20.0
+
+
+def test_load_external_csv_file(tmp_path, csv_parser, recording):
+    recording.to_csv(tmp_path / "external_4096Hz.csv", index=False)
+    saving_path = str(tmp_path / "results")
+
+    (
+        external_file,
+        BIP_channel,
+        external_rec_ch_names,
+        sf_external,
+        ch_index_external,
+    ) = load_external_csv_file(
+        "s1", "external_4096Hz.csv", "BIP 01", saving_path, str(tmp_path),
+        channels=["LFP_R"],
+    )
+
+    assert sf_external == 4096
+    assert external_rec_ch_names == ["BIP 01", "LFP_R"]
+    assert ch_index_external == 0
+    assert external_file.shape == (2, 5000)
+    np.testing.assert_array_equal(BIP_channel, recording["BIP 01"].to_numpy(np.float32))
+    assert _load_params("s1", saving_path)["CH_IDX_EXTERNAL"] == 0
+
+
+@pytest.mark.parametrize("mat_format", ["5-compressed", "5", "7.3"])
+def test_load_data_lfp_DBScope(tmp_path, mat_format):
+    lfp_raw = DBScope_lfp_raw(n_samples=(3000, 5000, 4000))
+    file_path = str(tmp_path / "lfp.mat")
+    if mat_format == "7.3":
+        hdf5storage = pytest.importorskip("hdf5storage")
+        hdf5storage.savemat(file_path, {"lfp_raw": lfp_raw}, format="7.3")
+    else:
+        scipy.io.savemat(
+            file_path, {"lfp_raw": lfp_raw}, do_compression=mat_format == "5-compressed"
+        )
+    saving_path = str(tmp_path / "results")
+
+    LFP_array, lfp_sig, LFP_rec_ch_names, sf_LFP = load_data_lfp_DBScope(
+        "s1", "lfp.mat", 1.0, 1.0, str(tmp_path), saving_path
+    )
+
+    assert sf_LFP == 250.0
+    assert LFP_rec_ch_names == ["ZERO_THREE_LEFT_1", "ZERO_THREE_RIGHT_1"]
+    assert LFP_array.dtype == np.float32 and LFP_array.flags["C_CONTIGUOUS"]
+    np.testing.assert_array_equal(LFP_array, lfp_raw["trial"][0, 1].astype(np.float32))
+    np.testing.assert_array_equal(lfp_sig, LFP_array[1])
+    assert _load_params("s1", saving_path)["LFP_REC_DURATION"] == 20.0
+
+
+@pytest.mark.filterwarnings("ignore:.*channel:RuntimeWarning")
+@pytest.mark.parametrize("fsample", [True, False])
+def test_load_intracranial_pymatreader(tmp_path, fsample):
+    # the pymatreader route returns the same recording as the MNE one
+    pytest.importorskip("pymatreader")
+    data = fieldtrip_data(sf=250.0, fsample=fsample)
+    scipy.io.savemat(str(tmp_path / "lfp.mat"), {"data": data})
+
+    results = [
+        load_intracranial(
+            "s1", "lfp.mat", 1, None, str(tmp_path / "results"), str(tmp_path),
+            "Perceive", USE_PYMATREADER=USE_PYMATREADER,
+        )
+        for USE_PYMATREADER in (True, False)
+    ]
+
+    (LFP_array, lfp_sig, LFP_rec_ch_names, sf_LFP), mne_results = results
+    np.testing.assert_allclose(LFP_array, data["trial"][0, 0].astype(np.float32))
+    np.testing.assert_array_equal(lfp_sig, LFP_array[1])
+    assert LFP_rec_ch_names == ["LFP_0", "LFP_1", "LFP_2"]
+    assert sf_LFP == 250
+    np.testing.assert_allclose(LFP_array, mne_results[0])
+    assert LFP_rec_ch_names == mne_results[2]
+    assert sf_LFP == mne_results[3]
+
+
+def test_load_intracranial_without_pymatreader(tmp_path, monkeypatch):
+    monkeypatch.setattr(loading_data, "read_mat", None)
+    scipy.io.savemat(str(tmp_path / "lfp.mat"), {"data": fieldtrip_data()})
+
+    with pytest.raises(ImportError, match="USE_PYMATREADER"):
+        load_intracranial(
+            "s1", "lfp.mat", 0, None, str(tmp_path / "results"), str(tmp_path),
+            "Perceive", USE_PYMATREADER=True,
+        )
@@ -0,0 +1,135 @@
+import struct
+
+import numpy as np
+import pytest
+
+from functions.tmsi_poly5reader import Poly5Reader, Poly5SampleView
+
+
+def write_poly5(file_path, samples, sample_rate=4096, samples_per_block=100, ch_names=None):
+    "Writes a (channels, samples) float32 array as a Poly5 file (version 2.03)"
+
+    num_channels, num_samples = samples.shape
+    if ch_names is None:
+        ch_names = [f"CH{i}" for i in range(num_channels)]
+    num_blocks = -(-num_samples // samples_per_block)
+
+    with open(file_path, "wb") as f:
+        f.write(
+            struct.pack(
+                "=31sH81phhBHi4xHHHHHHHiHHH64x",
+                b"POLY SAMPLE FILEversion 2.03\r\n\x1a",
+                203,
+                b"test",
+                sample_rate,
+                sample_rate,
+                0,
+                2 * num_channels,
+                num_samples,
+                2024, 1, 2, 3, 4, 5, 6,
+                num_blocks,
+                samples_per_block,
+                0,
+                0,
+            )
+        )
+        for name in ch_names:
+            # each channel is described twice (low and high words)
+            description = struct.pack(
+                "=41p4x11pffffH62x",
+                ("(Lo) " + name).encode("ascii"),
+                "µVolt".encode("utf-8"),
+                0, 0, 0, 0, 0,
+            )
+            f.write(description)
+            f.write(description)
+        for block in range(num_blocks):
+            block_samples = samples[:, block * samples_per_block : (block + 1) * samples_per_block]
+            f.write(b"\0" * 86)
+            f.write(np.ascontiguousarray(block_samples.T, dtype="<f4").tobytes())
+
+
+@pytest.fixture(params=[1000, 999], ids=["full blocks", "short final block"])
+def poly5_file(request, tmp_path):
+    "Poly5 file of 3 channels, with 10 full blocks or 9 full blocks and 99 samples"
+    samples = np.random.default_rng(0).standard_normal((3, request.param)).astype(np.float32)
+    file_path = str(tmp_path / "recording.Poly5")
+    write_poly5(file_path, samples, ch_names=["BIP 01", "ECG", "EMG"])
+    return file_path, samples
+
+
+def test_header(poly5_file):
+    file_path, samples = poly5_file
+    reader = Poly5Reader(file_path, readAll=False, verbose=False)
+    reader.close()
+
+    assert reader.sample_rate == 4096
+    assert reader.num_channels == 3
+    assert reader.num_samples == samples.shape[1]
+    assert reader.ch_names == ["BIP 01", "ECG", "EMG"]
+
+
+def test_read_all(poly5_file):
+    file_path, samples = poly5_file
+    reader = Poly5Reader(file_path, verbose=False)
+
+    assert reader.samples.dtype == np.float32
+    np.testing.assert_array_equal(reader.samples, samples)
+    np.testing.assert_array_equal(reader.get_channel("ECG"), samples[1])
+    # microvolts are converted to volts
+    np.testing.assert_allclose(reader.read_data_numpy(), samples * 1e-6, rtol=1e-6)
+
+
+def test_read_all_float64(poly5_file):
+    file_path, samples = poly5_file
+    reader = Poly5Reader(file_path, dtype=np.float64, verbose=False)
+
+    assert reader.samples.dtype == np.float64
+    np.testing.assert_array_equal(reader.samples, samples)
+
+
+def test_memmap(poly5_file):
+    file_path, samples = poly5_file
+    reader = Poly5Reader(file_path, mmap=True, verbose=False)
+
+    assert isinstance(reader.samples, Poly5SampleView)
+    assert reader.samples.shape == samples.shape
+    np.testing.assert_array_equal(np.asarray(reader.samples), samples)
+    np.testing.assert_array_equal(reader.get_channel("EMG"), samples[2])
+    np.testing.assert_allclose(
+        np.asarray(reader.read_data_numpy()), samples * 1e-6, rtol=1e-6
+    )
+
+
+@pytest.mark.parametrize(
+    "key",
+    [
+        (0, slice(None)),
+        (slice(None), slice(95, 205)),
+        (slice(1, 3), slice(0, 100)),
+        ([0, 2], slice(899, None)),
+        (1, slice(10, 900, 7)),
+        (2, 0),
+        (slice(None), -1),
+        (0, slice(500, 400)),
+        (slice(None), np.array([3, 950, 120])),
+    ],
+)
+def test_memmap_slicing(poly5_file, key):
+    file_path, samples = poly5_file
+    reader = Poly5Reader(file_path, mmap=True, verbose=False)
+
+    np.testing.assert_array_equal(reader.samples[key], samples[key])
+
+
+def test_read_samples(poly5_file):
+    file_path, samples = poly5_file
+    reader = Poly5Reader(file_path, readAll=False, verbose=False)
+
+    chunks = [reader.readSamples(n_blocks=3) for _ in range(4)]
+    np.testing.assert_array_equal(np.concatenate(chunks, axis=1), samples)
+
+    # the reader is exhausted: no samples are left
+    exhausted = reader.readSamples(n_blocks=3)
+    reader.close()
+    assert exhausted.shape == (3, 0)
@@ -0,0 +1,266 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.io
+
+from functions.probe import (
+    Mat5SkippedArray,
+    _read_mat5_variable,
+    probe_manifest,
+    probe_recording,
+)
+from test_poly5reader import write_poly5
+
+
+def cell(*values, column=False):
+    "MATLAB cell array (1 x n, or n x 1 if column) of the given values"
+    array = np.empty((len(values), 1) if column else (1, len(values)), dtype=object)
+    for i, value in enumerate(values):
+        array.flat[i] = value
+    return array
+
+
+def fieldtrip_data(n_channels=3, n_samples=12000, sf=250.0, fsample=True):
+    "FieldTrip data structure with one trial, as saved by ft_preprocessing"
+    trial = np.random.default_rng(0).standard_normal((n_channels, n_samples))
+    data = {
+        "label": cell(*[f"LFP_{i}" for i in range(n_channels)], column=True),
+        "trial": cell(trial),
+        "time": cell(np.arange(n_samples)[np.newaxis] / sf),
+        "cfg": {"method": "trial", "trl": np.array([[1.0, n_samples, 0.0]])},
+    }
+    if fsample:
+        data["fsample"] = sf
+    return data
+
+
+def DBScope_lfp_raw(n_samples=(3000, 5000), sf=250.0):
+    "lfp_raw structure of DBScope, with one trial per streaming"
+    rng = np.random.default_rng(1)
+    return {
+        "hdr": {
+            "fs": sf,
+            "channel_names": cell(
+                *[cell(f"ZERO_THREE_LEFT_{i}", f"ZERO_THREE_RIGHT_{i}") for i in range(len(n_samples))]
+            ),
+        },
+        "trial": cell(*[rng.standard_normal((2, n)) for n in n_samples]),
+    }
+
+
+@pytest.fixture(params=[True, False], ids=["compressed", "uncompressed"])
+def do_compression(request):
+    return request.param
+
+
+def test_read_mat5_variable(tmp_path, do_compression):
+    file_path = str(tmp_path / "variables.mat")
+    matrix = np.arange(12.0).reshape(3, 4)
+    scipy.io.savemat(
+        file_path,
+        {
+            "before": np.ones(100),
+            "variable": {
+                "number": 4.5,
+                "matrix": matrix,
+                "integers": np.array([[1, -2, 3]], dtype=np.int16),
+                "text": "a label",
+                "rows": np.array(["ab", "cd"]),
+                "empty": "",
+                "nested": cell("x", cell(np.array([[7.0]]))),
+                "items": np.array(
+                    [[(1.0, "one"), (2.0, "two")]], dtype=[("value", "O"), ("name", "O")]
+                ),
+                "samples": np.arange(20000.0),
+            },
+        },
+        do_compression=do_compression,
+    )
+
+    variable = _read_mat5_variable(file_path, "variable")
+
+    assert variable["number"] == 4.5
+    np.testing.assert_array_equal(variable["matrix"], matrix)
+    assert variable["integers"].dtype == np.int16
+    np.testing.assert_array_equal(variable["integers"], [[1, -2, 3]])
+    assert variable["text"] == "a label"
+    assert variable["rows"] == ["ab", "cd"]
+    assert variable["empty"] == ""
+    assert variable["nested"][0] == "x"
+    assert variable["nested"][1][0] == 7.0
+    assert [item["name"] for item in variable["items"]] == ["one", "two"]
+    assert variable["items"][1]["value"] == 2.0
+    # the large arrays are skipped, only their first values are kept
+    assert isinstance(variable["samples"], Mat5SkippedArray)
+    assert variable["samples"].shape == (1, 20000)
+    np.testing.assert_array_equal(variable["samples"].head, np.arange(8.0))
+
+    np.testing.assert_array_equal(_read_mat5_variable(file_path, "before"), np.ones((1, 100)))
+    with pytest.raises(KeyError):
+        _read_mat5_variable(file_path, "missing")
+
+
+def test_read_mat5_variable_fields(tmp_path):
+    file_path = str(tmp_path / "variables.mat")
+    scipy.io.savemat(
+        file_path,
+        {"variable": {"first": 1.0, "second": "skipped", "third": np.arange(3.0), "last": 2.0}},
+        do_compression=False,
+    )
+
+    variable = _read_mat5_variable(file_path, "variable", fields=("first", "third"))
+    assert list(variable) == ["first", "third"]
+    np.testing.assert_array_equal(variable["third"], [[0.0, 1.0, 2.0]])
+
+    # the reading stops after the requested fields: the rest of the file is
+    # not needed
+    with open(file_path, "r+b") as f:
+        f.truncate(os.path.getsize(file_path) - 16)
+    variable = _read_mat5_variable(file_path, "variable", fields=("first", "third"))
+    assert variable["first"] == 1.0
+
+
+def test_read_mat5_variable_items(tmp_path, do_compression):
+    file_path = str(tmp_path / "lfp.mat")
+    lfp_raw = DBScope_lfp_raw(n_samples=(3000, 9000, 4000))
+    scipy.io.savemat(file_path, {"lfp_raw": lfp_raw}, do_compression=do_compression)
+
+    # only the requested element of the cell is returned, in full
+    variable = _read_mat5_variable(
+        file_path, "lfp_raw", fields=("hdr", "trial"), items={"trial": 1}
+    )
+    np.testing.assert_array_equal(variable["trial"], lfp_raw["trial"][0, 1])
+    assert variable["hdr"]["fs"] == 250.0
+
+    with pytest.raises(IndexError):
+        _read_mat5_variable(file_path, "lfp_raw", items={"trial": 3})
+
+
+def test_probe_fieldtrip(tmp_path, do_compression):
+    scipy.io.savemat(
+        str(tmp_path / "lfp.mat"), {"data": fieldtrip_data()}, do_compression=do_compression
+    )
+
+    metadata = probe_recording("lfp.mat", str(tmp_path))
+
+    assert metadata == {
+        "sf": 250.0,
+        "ch_names": ["LFP_0", "LFP_1", "LFP_2"],
+        "n_samples": 12000,
+        "start_time": None,
+        "duration": 48.0,
+    }
+
+
+def test_probe_fieldtrip_without_fsample(tmp_path, do_compression):
+    # the sampling frequency is computed from the time vector, which is large
+    # enough to be skipped
+    scipy.io.savemat(
+        str(tmp_path / "lfp.mat"),
+        {"data": fieldtrip_data(sf=500.0, fsample=False)},
+        do_compression=do_compression,
+    )
+
+    metadata = probe_recording("lfp.mat", str(tmp_path))
+
+    assert metadata["sf"] == pytest.approx(500.0)
+    assert metadata["n_samples"] == 12000
+
+
+def test_probe_fieldtrip_v73(tmp_path):
+    hdf5storage = pytest.importorskip("hdf5storage")
+    hdf5storage.savemat(
+        str(tmp_path / "lfp.mat"), {"data": fieldtrip_data(fsample=False)}, format="7.3"
+    )
+
+    metadata = probe_recording("lfp.mat", str(tmp_path))
+
+    assert metadata["sf"] == pytest.approx(250.0)
+    assert metadata["ch_names"] == ["LFP_0", "LFP_1", "LFP_2"]
+    assert metadata["n_samples"] == 12000
+
+
+@pytest.mark.parametrize("trial_idx_lfp", [0, 1.0])
+def test_probe_DBScope(tmp_path, do_compression, trial_idx_lfp):
+    scipy.io.savemat(
+        str(tmp_path / "lfp.mat"),
+        {"lfp_raw": DBScope_lfp_raw()},
+        do_compression=do_compression,
+    )
+
+    metadata = probe_recording(
+        "lfp.mat", str(tmp_path), PREPROCESSING="DBScope", trial_idx_lfp=trial_idx_lfp
+    )
+
+    i = int(trial_idx_lfp)
+    assert metadata["sf"] == 250.0
+    assert metadata["ch_names"] == [f"ZERO_THREE_LEFT_{i}", f"ZERO_THREE_RIGHT_{i}"]
+    assert metadata["n_samples"] == (3000, 5000)[i]
+
+
+def test_probe_DBScope_v73(tmp_path):
+    hdf5storage = pytest.importorskip("hdf5storage")
+    hdf5storage.savemat(
+        str(tmp_path / "lfp.mat"), {"lfp_raw": DBScope_lfp_raw()}, format="7.3"
+    )
+
+    metadata = probe_recording(
+        "lfp.mat", str(tmp_path), PREPROCESSING="DBScope", trial_idx_lfp=1
+    )
+
+    assert metadata["sf"] == 250.0
+    assert metadata["ch_names"] == ["ZERO_THREE_LEFT_1", "ZERO_THREE_RIGHT_1"]
+    assert metadata["n_samples"] == 5000
+
+
+def test_probe_poly5(tmp_path):
+    write_poly5(str(tmp_path / "external.Poly5"), np.zeros((2, 8192), dtype=np.float32))
+
+    metadata = probe_recording("external.Poly5", str(tmp_path))
+
+    assert metadata["sf"] == 4096
+    assert metadata["ch_names"] == ["CH0", "CH1"]
+    assert metadata["n_samples"] == 8192
+    assert metadata["duration"] == 2.0
+
+
+@pytest.mark.parametrize("n_samples", [1000, 200000])
+def test_probe_csv(tmp_path, n_samples):
+    # the rows are counted in small files, estimated in larger ones
+    values = np.round(np.random.default_rng(0).standard_normal((n_samples, 2)), 4)
+    pd.DataFrame(values, columns=["LFP_L", "LFP_R"]).to_csv(
+        tmp_path / "lfp_250Hz.csv", index=False
+    )
+
+    metadata = probe_recording("lfp_250Hz.csv", str(tmp_path))
+
+    assert metadata["sf"] == 250
+    assert metadata["ch_names"] == ["LFP_L", "LFP_R"]
+    if n_samples == 1000:
+        assert metadata["n_samples"] == 1000
+    else:
+        assert metadata["n_samples"] == pytest.approx(n_samples, rel=0.01)
+
+
+def test_probe_manifest(tmp_path):
+    scipy.io.savemat(str(tmp_path / "lfp.mat"), {"data": fieldtrip_data()})
+    write_poly5(str(tmp_path / "external.Poly5"), np.zeros((2, 4096), dtype=np.float32))
+    df = pd.DataFrame(
+        {
+            "session_ID": ["s1", "s2", "s3"],
+            "fname_lfp": ["lfp.mat", "missing.mat", "lfp.mat"],
+            "fname_external": ["external.Poly5", np.nan, "external.Poly5"],
+            "done": ["no", "no", "yes"],
+        }
+    )
+
+    probed = probe_manifest(df, str(tmp_path))
+
+    assert list(probed["session_ID"]) == ["s1", "s1", "s2"]
+    assert list(probed["recording"]) == ["intracranial", "external", "intracranial"]
+    assert list(probed["n_channels"][:2]) == [3, 2]
+    assert list(probed["duration"][:2]) == [48.0, 1.0]
+    assert probed["error"][:2].isna().all()
+    assert "FileNotFoundError" in probed["error"][2]
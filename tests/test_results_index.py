@@ -0,0 +1,94 @@
+import json
+import os
+
+import pytest
+
+from functions.results_index import (
+    backfill_results_index,
+    index_session,
+    query_results_index,
+)
+
+
+def save_session(results_path, session_ID, parameters):
+    saving_path = os.path.join(results_path, session_ID)
+    os.makedirs(saving_path)
+    with open(os.path.join(saving_path, f"parameters_{session_ID}.json"), "w") as f:
+        json.dump(parameters, f)
+    return saving_path
+
+
+@pytest.fixture
+def results_path(tmp_path):
+    results_path = str(tmp_path / "results")
+    save_session(
+        results_path,
+        "s1",
+        {
+            "SUBJECT_ID": "s1",
+            "METHOD": "thresh",
+            "TIMESHIFT": 150.5,
+            "LFP_REC_CH_NAMES": ["LFP_L", "LFP_R"],
+        },
+    )
+    save_session(results_path, "s2", {"SUBJECT_ID": "s2", "METHOD": "manual", "TIMESHIFT": -20})
+    return results_path
+
+
+def test_index_session(results_path):
+    index_session("s1", results_path, status="done", duration_s=12.5)
+
+    sessions = query_results_index(results_path)
+    assert len(sessions) == 1
+    session = sessions.iloc[0]
+    assert session["session_ID"] == "s1"
+    assert session["method"] == "thresh"
+    assert session["timeshift_ms"] == 150.5
+    assert session["status"] == "done"
+    assert session["duration_s"] == 12.5
+    assert json.loads(session["output_files"]) == ["parameters_s1.json"]
+    assert json.loads(session["parameters"])["LFP_REC_CH_NAMES"] == ["LFP_L", "LFP_R"]
+
+
+def test_index_session_replaces_entry(results_path):
+    index_session("s1", results_path, status="failed", error="ValueError")
+    index_session("s1", results_path, parameters={"METHOD": "1"}, status="done")
+
+    sessions = query_results_index(results_path)
+    assert len(sessions) == 1
+    assert sessions.iloc[0]["method"] == "1"
+    assert sessions.iloc[0]["error"] is None
+
+
+def test_index_session_without_parameters(tmp_path):
+    results_path = str(tmp_path)
+    index_session("s3", results_path, status="failed", error="OSError")
+
+    session = query_results_index(results_path).iloc[0]
+    assert session["status"] == "failed"
+    assert json.loads(session["output_files"]) == []
+
+
+def test_backfill_keeps_runs(results_path):
+    index_session("s2", results_path, status="done", duration_s=3.0)
+
+    assert backfill_results_index(results_path) == 2
+
+    sessions = query_results_index(results_path).set_index("session_ID")
+    assert list(sessions.index) == ["s1", "s2"]
+    assert sessions["status"].isna()["s1"]
+    assert sessions.loc["s2", "status"] == "done"
+    assert sessions.loc["s2", "duration_s"] == 3.0
+    assert sessions.loc["s2", "method"] == "manual"
+
+
+def test_query(results_path):
+    backfill_results_index(results_path)
+
+    shifted = query_results_index(results_path, "abs(timeshift_ms) > 100")
+    assert list(shifted["session_ID"]) == ["s1"]
+    manual = query_results_index(
+        results_path, "method = ?", arguments=("manual",), columns=["session_ID"]
+    )
+    assert list(manual.columns) == ["session_ID"]
+    assert list(manual["session_ID"]) == ["s2"]
@@ -0,0 +1,151 @@
+import numpy as np
+import pytest
+
+from functions.resync_function import _correct_external_drift, refine_alignment
+
+
+SF_EXTERNAL = 4096
+SF_LFP = 250
+
+
+def sines(positions):
+    "Two channels of slow sines, sampled at the given positions (samples)"
+    t = np.asarray(positions) / SF_EXTERNAL
+    return np.stack([np.sin(2 * np.pi * 3 * t), np.cos(2 * np.pi * 7.5 * t + 1)])
+
+
+def test_no_drift_keeps_the_samples():
+    external_file = sines(np.arange(20000))
+
+    external_cropped = _correct_external_drift(
+        external_file,
+        index_start_external=1000,
+        index_first_artifact=5000.0,
+        drift_ppm=0,
+        dtype="float64",
+    )
+
+    assert external_cropped.shape == (19000, 2)
+    np.testing.assert_allclose(external_cropped, external_file[:, 1000:].T, atol=1e-12)
+
+
+@pytest.mark.parametrize("drift_ppm", [-250, 80, 1500])
+def test_drift_matches_analytic_signal(drift_ppm):
+    external_file = sines(np.arange(40000))
+    index_start_external = 1500
+    index_first_artifact = 9000.25
+
+    external_cropped = _correct_external_drift(
+        external_file,
+        index_start_external=index_start_external,
+        index_first_artifact=index_first_artifact,
+        drift_ppm=drift_ppm,
+        dtype="float64",
+    )
+
+    # the n-th output sample is the external signal at anchor + (n - anchor) * ratio
+    ratio = 1 + drift_ppm * 1e-6
+    anchor = index_first_artifact - index_start_external
+    n = np.arange(len(external_cropped))
+    positions = index_start_external + anchor + (n - anchor) * ratio
+    assert positions[-1] <= len(external_file[0]) - 1 < positions[-1] + ratio
+
+    # away from the edges of the recording (filter half width), the samples
+    # before index_start_external are not used
+    inside = (positions > index_start_external + 8) & (
+        positions < len(external_file[0]) - 9
+    )
+    np.testing.assert_allclose(
+        external_cropped[inside], sines(positions[inside]).T, atol=1e-4
+    )
+
+
+def test_drift_in_chunks():
+    # with many channels, the output is computed in several chunks
+    rng = np.random.default_rng(0)
+    external_file = rng.standard_normal((5000, 3000))
+
+    external_cropped = _correct_external_drift(
+        external_file,
+        index_start_external=200,
+        index_first_artifact=700.0,
+        drift_ppm=900,
+        max_samples=2500,
+        dtype="float64",
+    )
+    per_channel = np.concatenate(
+        [
+            _correct_external_drift(
+                external_file[channel : channel + 1],
+                index_start_external=200,
+                index_first_artifact=700.0,
+                drift_ppm=900,
+                max_samples=2500,
+                dtype="float64",
+            )
+            for channel in (0, 2500, 4999)
+        ],
+        axis=1,
+    )
+
+    assert external_cropped.shape == (2500, 5000)
+    np.testing.assert_allclose(
+        external_cropped[:, [0, 2500, 4999]], per_channel, atol=1e-12
+    )
+
+
+def artifact(t):
+    """
+    Artifact seen by both recordings at the times t (s) after its onset: a
+    few sharp deflections decaying in 50 ms, over 1.5 s
+    """
+    deflections = [(0.0, 40.0), (0.31, -18.0), (0.62, 30.0), (1.1, -22.0)]
+    signal = np.zeros(np.shape(t))
+    for start, amplitude in deflections:
+        elapsed = np.clip(t - start, 0, None)
+        signal += amplitude * (1 - np.exp(-elapsed / 0.004)) * np.exp(-elapsed / 0.05)
+    return signal
+
+
+@pytest.mark.parametrize("error_ms", [0, 1.3, -2.7])
+def test_refine_alignment_finds_subsample_shift(error_ms):
+    rng = np.random.default_rng(0)
+    # onset of the artifact in each recording (s), not on a sample of either
+    onset_LFP = 10.0013
+    onset_external = 4.5071
+    times_LFP = np.arange(20 * SF_LFP) / SF_LFP
+    times_external = np.arange(15 * SF_EXTERNAL) / SF_EXTERNAL
+    lfp_sig = 3 + artifact(times_LFP - onset_LFP) + 0.1 * rng.standard_normal(
+        len(times_LFP)
+    )
+    BIP_channel = -150 + artifact(times_external - onset_external) + 0.1 * (
+        rng.standard_normal(len(times_external))
+    )
+    # the detection of the external artifact is wrong by error_ms
+    art_start_LFP = onset_LFP
+    art_start_BIP = onset_external + error_ms / 1000
+
+    art_start_BIP_refined, offset_ms, confidence, accepted = refine_alignment(
+        lfp_sig, BIP_channel, art_start_LFP, art_start_BIP, SF_LFP, SF_EXTERNAL
+    )
+
+    assert accepted
+    assert confidence > 0.95
+    assert offset_ms == pytest.approx(-error_ms, abs=0.5)
+    assert art_start_BIP_refined == pytest.approx(onset_external, abs=5e-4)
+
+
+def test_refine_alignment_rejects_large_shift():
+    times_LFP = np.arange(20 * SF_LFP) / SF_LFP
+    times_external = np.arange(15 * SF_EXTERNAL) / SF_EXTERNAL
+    lfp_sig = artifact(times_LFP - 10)
+    BIP_channel = artifact(times_external - 4.5)
+
+    # the true offset is 7 ms, more than a sampling period of the LFP
+    art_start_BIP_refined, offset_ms, _, accepted = refine_alignment(
+        lfp_sig, BIP_channel, 10, 4.507, SF_LFP, SF_EXTERNAL
+    )
+
+    assert offset_ms == pytest.approx(-7, abs=0.5)
+    assert not accepted
+    assert art_start_BIP_refined == 4.507
@@ -0,0 +1,140 @@
+import json
+import os
+
+import matplotlib.pyplot as plt
+import numpy as np
+import pytest
+
+from functions import review
+from functions.find_artifacts import find_external_artifact_train, rescore_LFP_candidates
+from functions.review import (
+    EXTERNAL_ZOOM_SAMPLES,
+    load_detection_candidates,
+    load_reviewed_picks,
+    review_session,
+    save_detection_candidates,
+)
+from functions.utils import _load_artifact_trains
+from test_find_artifacts import artifact_train, synthetic_external
+
+
+# artifacts of synthetic_external (s), and of the intracranial recording
+ARTIFACTS_EXTERNAL = np.array([5.0, 12.3, 20.7])
+ARTIFACTS_LFP = ARTIFACTS_EXTERNAL + 2
+
+
+@pytest.fixture
+def saving_path(tmp_path):
+    "Session detected in batch: one consistent method, and a wrong one"
+    filtered_external = synthetic_external()
+    external_train = find_external_artifact_train(filtered_external, 4096)
+    lfp_sig = np.random.default_rng(0).standard_normal(30 * 250)
+    candidates = rescore_LFP_candidates(
+        [
+            {"method": "2", "train": artifact_train(np.append(3.0, ARTIFACTS_LFP), 250)},
+            {"method": "thresh", "train": artifact_train(ARTIFACTS_LFP, 250)},
+        ],
+        250,
+        external_train,
+        4096,
+    )
+    save_detection_candidates(
+        session_ID="s1",
+        saving_path=str(tmp_path),
+        lfp_sig=lfp_sig,
+        sf_LFP=250,
+        filtered_external=filtered_external,
+        sf_external=4096,
+        external_train=external_train,
+        candidates=candidates,
+    )
+    return str(tmp_path)
+
+
+@pytest.fixture
+def answers(monkeypatch):
+    "Answers given to the questions of review_session, in order"
+    answers = []
+    monkeypatch.setattr(review, "_get_input_y_n", lambda message: answers.pop(0))
+    monkeypatch.setattr(review, "_get_user_input", lambda message: answers.pop(0))
+    monkeypatch.setattr(review, "select_sample", lambda **kwargs: answers.pop(0))
+    monkeypatch.setattr(plt, "pause", lambda interval: None)
+    yield answers
+    assert answers == []
+    plt.close("all")
+
+
+def test_save_detection_candidates(saving_path):
+    cached = load_detection_candidates("s1", saving_path)
+    filtered_external = synthetic_external()
+
+    assert cached["sf_LFP"] == 250 and cached["sf_external"] == 4096
+    assert list(cached["methods"]) == ["thresh", "2"]
+    assert cached["confidences"][0] == 1.0
+    np.testing.assert_array_equal(cached["train_thresh"], artifact_train(ARTIFACTS_LFP, 250))
+    # a zoom on each external artifact, at full resolution
+    onsets = cached["external_train"]["onset"]
+    np.testing.assert_allclose(onsets / 4096, ARTIFACTS_EXTERNAL, atol=1e-3)
+    np.testing.assert_array_equal(cached["external_zoom_onsets"], onsets)
+    np.testing.assert_array_equal(
+        cached["external_zooms"][1],
+        filtered_external[
+            onsets[1] - EXTERNAL_ZOOM_SAMPLES : onsets[1] + EXTERNAL_ZOOM_SAMPLES + 1
+        ].astype(np.float32),
+    )
+    # overview of the external channel in bins
+    assert cached["external_min"].min() == np.float32(filtered_external.min())
+    assert cached["external_max"].max() == np.float32(filtered_external.max())
+    assert len(cached["external_min"]) * cached["external_bin_size"] >= len(filtered_external)
+
+    assert load_detection_candidates("s2", saving_path) is None
+
+
+def test_review_session(saving_path, answers):
+    # external artifact accepted, then the second method
+    answers.extend(["y", "n", "y"])
+
+    picks = review_session("s1", saving_path)
+
+    assert picks["ART_TIME_BIP"] == pytest.approx(5, abs=1e-3)
+    assert picks["ART_TIME_LFP"] == 3.0
+    assert picks["METHOD"] == "2"
+    assert load_reviewed_picks("s1", saving_path) == picks
+    trains = _load_artifact_trains("s1", saving_path)
+    np.testing.assert_array_equal(trains["intracranial"]["onset"][0], 3 * 250)
+    # the external artifacts were saved during detection
+    assert "external" not in trains
+
+
+def test_review_session_ignores_first_artifacts(saving_path, answers):
+    # the first external artifact is ignored (the first 8 s)
+    answers.extend(["n", 8, "y", "y"])
+
+    picks = review_session("s1", saving_path)
+
+    assert picks["ART_TIME_BIP"] == pytest.approx(12.3, abs=1e-3)
+    assert picks["METHOD"] == "thresh"
+    assert picks["ART_TIME_LFP"] == 7.0
+    # scored again with the 2 external artifacts left: only the first
+    # intracranial artifact is paired
+    assert picks["METHOD_CONFIDENCE"] == pytest.approx(2 / 5)
+    trains = _load_artifact_trains("s1", saving_path)
+    assert len(trains["external"]) == 2
+
+
+def test_review_session_manual(saving_path, answers):
+    answers.extend(["y", "n", "n", 7.012])
+
+    picks = review_session("s1", saving_path)
+
+    assert picks["METHOD"] == "manual"
+    assert picks["METHOD_CONFIDENCE"] is None
+    assert picks["ART_TIME_LFP"] == 7.012
+    with open(os.path.join(saving_path, "review_s1.json")) as f:
+        assert json.load(f) == picks
+    assert _load_artifact_trains("s1", saving_path)["intracranial"]["onset"][0] == 1753
+
+
+def test_review_session_not_detected(tmp_path):
+    assert review_session("s1", str(tmp_path)) is None
+    assert load_reviewed_picks("s1", str(tmp_path)) is None
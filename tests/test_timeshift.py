@@ -0,0 +1,149 @@
+import numpy as np
+import pytest
+
+from functions.find_artifacts import ARTIFACT_TRAIN_DTYPE
+from functions.timeshift import (
+    check_timeshift,
+    estimate_drift,
+    estimate_drift_from_artifacts,
+)
+from functions.utils import (
+    _load_params,
+    _update_and_save_artifact_train,
+    _update_and_save_multiple_params,
+    _use_params,
+)
+
+
+SF_LFP = 250
+SF_EXTERNAL = 4096
+DRIFT_PPM = 500
+# times of the artifacts in the intracranial recording (s)
+ARTIFACTS_LFP = np.array([10.0, 20.0, 30.0, 40.0, 50.0])
+
+
+@pytest.fixture(autouse=True)
+def no_current_session():
+    "Each test starts without session, and does not leave one to flush at exit"
+    _use_params(None)
+    yield
+    _use_params(None)
+
+
+def train(times, sf):
+    train = np.zeros(len(times), dtype=ARTIFACT_TRAIN_DTYPE)
+    train["onset"] = np.round(np.asarray(times) * sf)
+    return train
+
+
+@pytest.fixture
+def saving_path(tmp_path):
+    "Session whose external clock runs DRIFT_PPM faster than the intracranial one"
+    saving_path = str(tmp_path)
+    artifacts_external = 3 + ARTIFACTS_LFP * (1 + DRIFT_PPM * 1e-6)
+    _update_and_save_artifact_train(
+        "intracranial", train(ARTIFACTS_LFP, SF_LFP), SF_LFP, "s1", saving_path
+    )
+    _update_and_save_artifact_train(
+        "external", train(artifacts_external, SF_EXTERNAL), SF_EXTERNAL, "s1", saving_path
+    )
+    _update_and_save_multiple_params(
+        {
+            "CH_IDX_LFP": 0,
+            "CH_IDX_EXTERNAL": 0,
+            "ART_TIME_LFP": ARTIFACTS_LFP[0],
+            "ART_TIME_BIP": np.round(artifacts_external[0] * SF_EXTERNAL) / SF_EXTERNAL,
+        },
+        "s1",
+        saving_path,
+    )
+    return saving_path
+
+
+def test_estimate_drift():
+    artifacts_lfp = np.array([1.0, 5.0, 9.0, 13.0, 20.0])
+    delays = 0.002 + 100e-6 * artifacts_lfp
+    # an external artifact without intracranial counterpart is not paired
+    artifacts_external = np.sort(np.append(artifacts_lfp + delays, 16.0))
+
+    drift = estimate_drift(artifacts_lfp, artifacts_external)
+
+    assert drift["offset_ms"] == pytest.approx(2)
+    assert drift["drift_ppm"] == pytest.approx(100)
+    assert drift["residual_ms"] == pytest.approx(0, abs=1e-9)
+    assert drift["n_artifacts"] == 5
+    assert drift["last_artifact_lfp"] == 20.0
+    assert drift["last_artifact_external"] == pytest.approx(20.004)
+
+
+def test_estimate_drift_not_enough_artifacts():
+    assert estimate_drift(np.array([]), np.array([1.0])) is None
+    assert estimate_drift(np.array([1.0, 5.0]), np.array([1.0])) is None
+    # too far apart to be paired
+    assert estimate_drift(np.array([1.0, 5.0]), np.array([2.0, 6.0])) is None
+
+
+def test_estimate_drift_from_artifacts(saving_path):
+    loaded_dict = _load_params("s1", saving_path)
+
+    drift = estimate_drift_from_artifacts(
+        "s1", saving_path, loaded_dict["ART_TIME_LFP"], loaded_dict["ART_TIME_BIP"]
+    )
+
+    # the onsets are rounded to the samples of each recording
+    assert drift["n_artifacts"] == 5
+    assert drift["drift_ppm"] == pytest.approx(DRIFT_PPM, abs=10)
+    assert drift["last_artifact_external"] - drift["last_artifact_lfp"] == pytest.approx(
+        40 * DRIFT_PPM * 1e-6, abs=5e-4
+    )
+    assert estimate_drift_from_artifacts("s2", saving_path, 10, 13) is None
+
+
+@pytest.mark.parametrize("DRIFT_CORRECTION_PPM", [None, DRIFT_PPM])
+def test_check_timeshift_automatic(saving_path, DRIFT_CORRECTION_PPM):
+    _update_and_save_multiple_params(
+        {"DRIFT_CORRECTION_PPM": DRIFT_CORRECTION_PPM}, "s1", saving_path
+    )
+    # synchronized recordings, cropped 1 s before the first artifact
+    LFP_synchronized = np.zeros((55 * SF_LFP, 1))
+    external_synchronized = np.zeros((55 * SF_EXTERNAL, 1))
+
+    timeshift_ms = check_timeshift(
+        "s1",
+        LFP_synchronized,
+        SF_LFP,
+        external_synchronized,
+        SF_EXTERNAL,
+        saving_path,
+        CROP_BOTH=True,
+        INTERACTIVE=False,
+    )
+
+    # the timeshift is the delay at the last artifact, 40 s after the first
+    # one, unless the external recording was resampled to correct the drift
+    expected_ms = 40 * DRIFT_PPM * 1e-3 if DRIFT_CORRECTION_PPM is None else 0
+    assert timeshift_ms == pytest.approx(expected_ms, abs=0.5)
+    parameters = _load_params("s1", saving_path)
+    assert parameters["TIMESHIFT_MODE"] == "automatic"
+    assert parameters["DRIFT_N_ARTIFACTS"] == 5
+    assert parameters["TIMESHIFT"] == timeshift_ms
+
+
+def test_check_timeshift_without_artifacts(tmp_path):
+    saving_path = str(tmp_path)
+    _update_and_save_multiple_params(
+        {"CH_IDX_LFP": 0, "CH_IDX_EXTERNAL": 0}, "s1", saving_path
+    )
+
+    timeshift_ms = check_timeshift(
+        "s1",
+        np.zeros((1000, 1)),
+        SF_LFP,
+        np.zeros((16384, 1)),
+        SF_EXTERNAL,
+        saving_path,
+        INTERACTIVE=False,
+    )
+
+    assert timeshift_ms is None
+    assert _load_params("s1", saving_path)["TIMESHIFT_MODE"] == "failed"
@@ -0,0 +1,97 @@
+import json
+import os
+import threading
+
+import pytest
+
+from functions.utils import (
+    SessionParameters,
+    _flush_params,
+    _get_params,
+    _load_params,
+    _start_session,
+    _update_and_save_multiple_params,
+    _update_and_save_params,
+    _use_params,
+)
+
+
+def read_json(saving_path, session_ID):
+    with open(os.path.join(saving_path, f"parameters_{session_ID}.json")) as f:
+        return json.load(f)
+
+
+@pytest.fixture(autouse=True)
+def no_current_session():
+    "Each test starts without session, and does not leave one to flush at exit"
+    _use_params(None)
+    yield
+    _use_params(None)
+
+
+def test_flush(tmp_path):
+    session_parameters = SessionParameters("s1", str(tmp_path))
+    session_parameters.flush()
+    assert os.listdir(tmp_path) == []
+
+    session_parameters.update({"sf_LFP": 250, "SUBJECT_ID": "s1"})
+    session_parameters.update({"sf_LFP": 500})
+    assert session_parameters.modified
+    session_parameters.flush()
+
+    assert not session_parameters.modified
+    assert read_json(tmp_path, "s1") == {"sf_LFP": 500, "SUBJECT_ID": "s1"}
+    assert os.listdir(tmp_path) == ["parameters_s1.json"]
+
+
+def test_context_manager(tmp_path):
+    with SessionParameters("s1", str(tmp_path)) as session_parameters:
+        session_parameters.update({"METHOD": "thresh"})
+        assert not os.path.isfile(tmp_path / "parameters_s1.json")
+
+    assert read_json(tmp_path, "s1") == {"METHOD": "thresh"}
+
+
+def test_updates_are_buffered(tmp_path):
+    _start_session("s1", str(tmp_path))
+    _update_and_save_params("ART_TIME_BIP", 5.0, "s1", str(tmp_path))
+    _update_and_save_multiple_params({"ART_TIME_LFP": 2.0}, "s1", str(tmp_path))
+
+    # not written yet, but loaded with the updates
+    assert not os.path.isfile(tmp_path / "parameters_s1.json")
+    assert _load_params("s1", str(tmp_path)) == {"ART_TIME_BIP": 5.0, "ART_TIME_LFP": 2.0}
+
+    _flush_params()
+    assert read_json(tmp_path, "s1") == {"ART_TIME_BIP": 5.0, "ART_TIME_LFP": 2.0}
+
+
+def test_new_session_flushes_previous(tmp_path):
+    path_1, path_2 = str(tmp_path / "s1"), str(tmp_path / "s2")
+    os.makedirs(path_1)
+    os.makedirs(path_2)
+
+    _update_and_save_params("SUBJECT_ID", "s1", "s1", path_1)
+    # updating another session starts it, the first one is written
+    _update_and_save_params("SUBJECT_ID", "s2", "s2", path_2)
+
+    assert read_json(path_1, "s1") == {"SUBJECT_ID": "s1"}
+    assert not os.path.isfile(os.path.join(path_2, "parameters_s2.json"))
+    assert _get_params().session_ID == "s2"
+    _flush_params()
+    assert read_json(path_2, "s2") == {"SUBJECT_ID": "s2"}
+
+
+def test_parameters_per_thread(tmp_path):
+    session_parameters = _start_session("s1", str(tmp_path))
+
+    def update_in_thread():
+        _use_params(session_parameters)
+        _update_and_save_params("sf_EXTERNAL", 4096, "s1", str(tmp_path))
+
+    thread = threading.Thread(target=update_in_thread)
+    thread.start()
+    thread.join()
+    _update_and_save_params("sf_LFP", 250, "s1", str(tmp_path))
+    _flush_params()
+
+    assert read_json(tmp_path, "s1") == {"sf_EXTERNAL": 4096, "sf_LFP": 250}